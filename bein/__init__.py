@@ -45,8 +45,30 @@ import sqlite3
 import time
 import shutil
 import threading
+import multiprocessing
+import Queue
+import pickle
+import hashlib
+import json
+import gzip
+import zlib
+import errno
+import fcntl
+import stat
+import atexit
+import resource
+import StringIO
+import functools
+from multiprocessing.pool import ThreadPool
 from contextlib import contextmanager
 
+from bein import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 __version__ = '1.1.0'
 
 ################################################################################
@@ -57,13 +79,41 @@ class ProgramOutput(object):
     finished to create a return value from their output.  The output
     is passed as a ``ProgramObject``, containing all the information
     available to bein about that program.
+
+    Besides the program's output, it carries the resources it used,
+    where they could be measured (otherwise they are ``None``): the
+    times it started and finished (*started_at* and *finished_at*, in
+    seconds since the epoch), the user and system CPU time it and its
+    children consumed (*user_time* and *system_time*, in seconds), its
+    peak resident memory (*max_rss*, in kilobytes), and the number of
+    bytes it read and wrote through system calls (*read_bytes* and
+    *write_bytes*).  *via* names how the program was run: ``'blocking'``
+    when the program was called directly, the ``via`` argument of
+    ``nonblocking`` otherwise, or ``'checkpoint'`` if it was restored
+    from a checkpoint instead of running.
     """
-    def __init__(self, return_code, pid, arguments, stdout, stderr):
+    def __init__(self, return_code, pid, arguments, stdout, stderr,
+                 started_at=None, finished_at=None, user_time=None,
+                 system_time=None, max_rss=None, read_bytes=None,
+                 write_bytes=None, via=None):
         self.return_code = return_code
         self.pid = pid
         self.arguments = arguments
         self.stdout = stdout
         self.stderr = stderr
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+        self.via = via
+
+# The resource usage and backend recorded for each program, in the
+# order of the columns of the program table.
+_accounting_fields = ['started_at', 'finished_at', 'user_time', 'system_time',
+                      'max_rss', 'read_bytes', 'write_bytes', 'via']
 
 ################################################################################
 class ProgramFailed(Exception):
@@ -77,24 +127,297 @@ class ProgramFailed(Exception):
         return message
 
 ################################################################################
+# The working directory of the execution running in each thread.
+_context = threading.local()
+
+def _current_directory():
+    """Return the directory relative filenames are resolved against in this thread.
+
+    Inside an execution, this is its working directory, even if the
+    execution did not change the process's current directory;
+    elsewhere it is the current directory.
+    """
+    return getattr(_context, 'working_directory', None) or os.getcwd()
+
+# Working directories of finished executions are deleted by a
+# background thread, so leaving an execution does not wait on the
+# deletion of a large tree.
+_reaper_queue = Queue.Queue()
+_reaper_lock = threading.Lock()
+_reaper_pid = None
+
+def _reap(queue):
+    while True:
+        path = queue.get()
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            queue.task_done()
+
+def _remove_later(path):
+    """Delete the directory *path* in the background.
+
+    It is first renamed to a hidden name next to it, so *path* itself
+    is gone as soon as this returns.
+    """
+    global _reaper_pid, _reaper_queue
+    hidden = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.reaping')
+    try:
+        os.rename(path, hidden)
+        path = hidden
+    except OSError:
+        pass
+    with _reaper_lock:
+        # A forked child does not inherit the parent's thread, and
+        # the queue it inherits counts the parent's pending work.
+        if _reaper_pid != os.getpid():
+            _reaper_queue = Queue.Queue()
+            t = threading.Thread(target=_reap, args=(_reaper_queue,))
+            t.daemon = True
+            t.start()
+            _reaper_pid = os.getpid()
+    _reaper_queue.put(path)
+
+def wait_for_cleanup():
+    """Block until the working directories of finished executions are deleted.
+
+    This happens automatically when the interpreter exits.
+    """
+    if _reaper_pid == os.getpid():
+        _reaper_queue.join()
+atexit.register(wait_for_cleanup)
+
 def unique_filename_in(path=None):
     """Return a random filename unique in the given path.
 
     The filename returned is twenty alphanumeric characters which are
     not already serving as a filename in *path*.  If *path* is
-    omitted, it defaults to the current working directory.
+    omitted, it defaults to the working directory of the execution
+    running in this thread, or if there is none, to the current
+    working directory.  The name is drawn from that execution's
+    ``random`` generator, or from the ``random`` module outside
+    executions.
     """
     if path == None:
-        path = os.getcwd()
+        path = _current_directory()
+    generator = getattr(_context, 'random', None) or random
     def random_string():
-        return "".join([random.choice(string.letters + string.digits)
+        return "".join([generator.choice(string.letters + string.digits)
                         for x in range(20)])
+    with metrics.timer('unique_filename_in'):
+        while True:
+            filename = random_string()
+            files = [f for f in os.listdir(path) if f.startswith(filename)]
+            if files == []:
+                break
+    return filename
+
+################################################################################
+def _new_hash(algorithm):
+    """Return a new hash object for *algorithm*.
+
+    *algorithm* is any name ``hashlib`` knows (``'md5'``,
+    ``'sha256'``, ...), or ``'blake2b'`` or ``'blake2s'``, which need
+    either a Python with BLAKE2 in ``hashlib`` or the ``pyblake2``
+    package.
+    """
+    if algorithm in ('blake2b', 'blake2s') and not(hasattr(hashlib, algorithm)):
+        try:
+            import pyblake2
+        except ImportError:
+            raise ValueError("BLAKE2 needs Python >= 3.6 or the pyblake2 package.")
+        return getattr(pyblake2, algorithm)()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise ValueError("Unknown checksum algorithm %s" % algorithm)
+
+def checksum(filename, algorithm='md5', buffer_size=1024*1024):
+    """Return the hex digest of the contents of *filename*.
+
+    The file is read in blocks of *buffer_size* bytes, so it is never
+    held in memory.  *algorithm* can be anything ``hashlib`` provides,
+    such as ``'md5'`` or ``'sha256'``, or ``'blake2b'``.
+    """
+    h = _new_hash(algorithm)
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(buffer_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def checksums(filenames, algorithm='md5', workers=4, buffer_size=1024*1024):
+    """Return the hex digests of all *filenames*, in the same order.
+
+    The files are hashed by a pool of *workers* threads.  ``hashlib``
+    releases the interpreter lock while it hashes large blocks, so the
+    threads do run in parallel.
+    """
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda f: checksum(f, algorithm, buffer_size),
+                        filenames, chunksize=1)
+    finally:
+        pool.close()
+
+
+################################################################################
+# Repository blobs may be stored compressed.  These are the codecs
+# bein knows; 'zstd' needs the zstandard package.
+compression_codecs = ['gzip', 'zstd']
+
+def _check_codec(compression):
+    if compression == 'zstd' and zstandard == None:
+        raise ValueError("zstd compression needs the zstandard package.")
+    elif compression != None and not(compression in compression_codecs):
+        raise ValueError("Unknown compression %s; use one of %s." % \
+                             (compression, ", ".join(compression_codecs)))
+
+def _open_blob(path, compression=None):
+    """Open the blob at *path* for reading, decompressing it on the fly.
+
+    Returns a file-like object with a ``read`` method.  Nothing is
+    decompressed ahead of what is read, so arbitrarily large files can
+    be streamed.
+    """
+    _check_codec(compression)
+    if compression == None:
+        return open(path, 'rb')
+    elif compression == 'gzip':
+        return gzip.GzipFile(path, 'rb')
+    elif compression == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+
+def _write_blob(dst, compression=None):
+    """Open *dst* for writing a blob compressed with *compression*."""
+    _check_codec(compression)
+    if compression == None:
+        return open(dst, 'wb')
+    elif compression == 'gzip':
+        return gzip.GzipFile(dst, 'wb', compresslevel=6, mtime=0)
+    elif compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(open(dst, 'wb'))
+
+def _copy_stream(fsrc, fdst, h=None, buffer_size=1024*1024):
+    """Copy the file object *fsrc* to *fdst*, updating the hash *h* if given."""
     while True:
-        filename = random_string()
-        files = [f for f in os.listdir(path) if f.startswith(filename)]
-        if files == []:
+        block = fsrc.read(buffer_size)
+        if not block:
             break
-    return filename
+        if h != None:
+            h.update(block)
+        fdst.write(block)
+
+def _export_blob(path, compression, dst):
+    """Write the decompressed contents of the blob at *path* to the file *dst*."""
+    if compression == None:
+        shutil.copyfile(path, dst)
+    else:
+        fsrc = _open_blob(path, compression)
+        try:
+            with open(dst, 'wb') as fdst:
+                _copy_stream(fsrc, fdst)
+        finally:
+            fsrc.close()
+
+# The Linux ioctl which makes a file share the extents of another
+# (what ``cp --reflink`` uses), on filesystems such as Btrfs and XFS.
+_FICLONE = 0x40049409
+
+def _clone_blob(path, dst):
+    """Copy the blob at *path* as is to *dst*.
+
+    Where the filesystem supports it, *dst* shares *path*'s extents
+    (a reflink) until either is written to, so the copy is instant.
+    Otherwise the contents are copied.
+    """
+    with open(path, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return
+            except (IOError, OSError):
+                pass
+            _copy_stream(fsrc, fdst)
+
+def _check_blob(path, digest, size, mtime, full=False, compression=None):
+    """Check the blob at *path* against the *digest*, *size* and *mtime* recorded for it.
+
+    The digest is of the decompressed contents if the blob is stored
+    with *compression*.  Returns a pair of a status and the result of
+    ``os.stat`` on the blob (or ``None`` if it is missing).  The status is ``'missing'``,
+    ``'unverified'`` if no digest was recorded, ``'ok'`` if the blob
+    has the recorded size and mtime (or matches the digest, if
+    *full*), ``'changed'`` if its size or mtime changed but it still
+    matches the digest, or ``'corrupted'``.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ('missing', None)
+    if digest == None:
+        return ('unverified', st)
+    unchanged = st.st_size == size and st.st_mtime == mtime
+    if unchanged and not(full):
+        return ('ok', st)
+    (algorithm, hexdigest) = digest.split(':', 1)
+    h = _new_hash(algorithm)
+    try:
+        f = _open_blob(path, compression)
+        try:
+            while True:
+                block = f.read(1024*1024)
+                if not block:
+                    break
+                h.update(block)
+        finally:
+            f.close()
+    except (IOError, zlib.error):
+        return ('corrupted', st)
+    if h.hexdigest() != hexdigest:
+        return ('corrupted', st)
+    elif unchanged:
+        return ('ok', st)
+    else:
+        return ('changed', st)
+
+def _rename_into(src, dst):
+    """Rename *src* to *dst* in the repository, and return ``os.stat`` of it.
+
+    The modification time is set to now: ``_stale_blobs`` takes blobs
+    younger than its *min_age* for blobs in flight, and a file moved in
+    would otherwise keep the time it was last written, however long
+    ago that was.
+    """
+    os.rename(src, dst)
+    os.utime(dst, None)
+    return os.stat(dst)
+
+def _stale_blobs(directory, known, min_age):
+    """Return the paths of the blobs in *directory* not named in *known*.
+
+    Names starting with a dot are skipped, and so are blobs modified
+    less than *min_age* seconds ago: they may belong to a file being
+    imported or written at this moment, whose row is not committed yet.
+    Blobs are renamed into the repository with ``_rename_into`` so
+    that this holds for them too.
+    """
+    if not(os.path.isdir(directory)):
+        return []
+    now = time.time()
+    found = []
+    for f in os.listdir(directory):
+        path = os.path.join(directory, f)
+        if f.startswith('.') or f in known:
+            continue
+        try:
+            if now - os.path.getmtime(path) >= min_age:
+                found.append(path)
+        except OSError:
+            pass # Removed by someone else meanwhile.
+    return found
 
 
 ################################################################################
@@ -123,34 +446,100 @@ class Execution(object):
         self.started_at = int(time.time())
         self.finished_at = None
         self.id = None
-
-    def path_to_file(self, id_or_alias):
+        self.resumable = False
+        self.checkpoint_id = None
+        self.resumed_from = None
+        self.seed = None
+        # The execution's own random number generator, which
+        # unique_filename_in draws from in this execution.
+        self.random = random.Random()
+        self.stage = False
+        self._stager = None
+        self._lease = None
+
+    def path_to_file(self, id_or_alias, writable=False):
         """Fetch the path to *id_or_alias* in the attached LIMS."""
         if self.lims == None:
             raise ValueError("Cannot use path_to_file; no attached LIMS.")
         else:
-            return self.lims.path_to_file(id_or_alias)
+            return self.lims.path_to_file(id_or_alias, writable)
 
     def report(self, program):
         """Add a ProgramOutput object to the execution.
 
         When the Execution finishes, all programs added to the
         Execution with 'report', in the order the were added, are
-        written into the MiniLIMS repository.
+        written into the MiniLIMS repository.  In a resumable
+        execution, programs which succeeded are also checkpointed to
+        the MiniLIMS immediately.
         """
         self.programs.append(program)
+        if getattr(program, 'checkpoint', None) != None and program.return_code == 0:
+            self.lims._checkpoint_program(self, len(self.programs)-1, program)
+
+    def _snapshot(self):
+        """Return the size and mtime of every file in the working directory."""
+        snapshot = {}
+        for f in os.listdir(self.working_directory):
+            p = os.path.join(self.working_directory, f)
+            if os.path.isfile(p):
+                st = os.stat(p)
+                snapshot[f] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def _input_signature(self, arguments):
+        """Describe the content of the files named in *arguments*.
+
+        Returns a JSON string listing every argument which names an
+        existing file, with the file's size and MD5 digest.
+        """
+        inputs = []
+        for a in arguments:
+            p = os.path.join(self.working_directory, a)
+            if os.path.isfile(p):
+                inputs.append([a, os.path.getsize(p), checksum(p)])
+        return json.dumps(inputs)
+
+    def _begin_program(self, arguments):
+        """Prepare to run a program with *arguments* in this execution.
+
+        Called by ``@program`` before starting a program.  Returns a
+        pair ``(restored, checkpoint)``.  If the execution resumes a
+        failed one which already ran the same program on the same
+        inputs, *restored* is the ``ProgramOutput`` recorded then, its
+        output files are back in the working directory, and the program
+        should not be run again.  Otherwise *restored* is ``None``, and
+        *checkpoint* must be attached to the program's
+        ``ProgramOutput`` so ``report`` can checkpoint it.
+
+        *arguments* are the program's own, not the command line of a
+        backend such as LSF, which names things (like the working
+        directory) that differ from one retry to the next.
+        """
+        if not(self.resumable):
+            return (None, None)
+        inputs = self._input_signature(arguments)
+        restored = self.lims._restore_checkpoint(self, arguments, inputs)
+        if restored != None:
+            return (restored, None)
+        else:
+            return (None, (arguments, inputs, self._snapshot()))
 
     def add(self, filename, description="", associate_to_id=None,
-            associate_to_filename=None, template=None, alias=None):
+            associate_to_filename=None, template=None, alias=None,
+            compress=None):
         """Add a file to the MiniLIMS object from this execution.
 
         filename is the name of the file in the execution's working
         directory to import.  description is an optional argument to
         assign a string or a dictionary to describe that file in the MiniLIMS
-        repository.
+        repository.  compress sets how the file is stored in the
+        repository, as for ``MiniLIMS.import_file``.
 
         Note that the file is not actually added to the repository
-        until the execution finishes.
+        until the execution finishes.  If the execution was created
+        with *stage* (see ``execution``), the work of storing the file
+        starts right away in the background.
         """
         if isinstance(description,dict): description=str(description)
         if filename == None:
@@ -158,11 +547,22 @@ class Execution(object):
                 raise(IOError("Tried to add None to repository."))
             else:
                 raise(IOError("Tried to add None to repository, with description '" + description +"' ."))
-        elif not(os.path.exists(filename)):
+        elif not(os.path.exists(os.path.join(self.working_directory, filename))):
             raise IOError("No such file or directory: '"+filename+"'")
         else:
+            if compress:
+                _check_codec(compress)
+            staged = None
+            if self.stage and self.lims != None:
+                if self._stager == None:
+                    self._stager = ThreadPool(2)
+                    self._lease = self.lims._open_lease()
+                src = os.path.abspath(os.path.join(self.working_directory, filename))
+                staged = self._stager.apply_async(self.lims._stage_blob,
+                                                  (src, self.lims._compression_for(filename, compress),
+                                                   self._lease))
             self.files.append((filename,description,associate_to_id,
-                               associate_to_filename,template,alias))
+                               associate_to_filename,template,alias,compress,staged))
     def finish(self):
         """Set the time when the execution finished."""
         self.finished_at = int(time.time())
@@ -177,21 +577,21 @@ class Execution(object):
         filename it copied the file into.
         """
         fileid = self.lims.resolve_alias(file_or_alias)
-        try:
-            filename = [x for (x,) in
-                        self.lims.db.execute("select exportfile(?,?)",
-                                             (fileid, self.working_directory))][0]
-            for (f,t) in self.lims.associated_files_of(fileid):
-                self.lims.db.execute("select exportfile(?,?)",
-                                     (f, os.path.join(self.working_directory,t % filename)))
-            self.used_files.append(fileid)
-            return filename
-        except ValueError, v:
+        filename = self.lims._export_file_from_repository(fileid, self.working_directory)
+        if filename == None:
             raise ValueError("Tried to use a nonexistent file id " + str(fileid))
+        for (f,t) in self.lims.associated_files_of(fileid):
+            if self.lims._export_file_from_repository(f, os.path.join(self.working_directory,
+                                                                      t % filename)) == None:
+                raise ValueError("Tried to use a nonexistent file id " + str(f))
+        self.used_files.append(fileid)
+        return filename
 
 ################################################################################
 @contextmanager
-def execution(lims = None, description="", remote_working_directory=None):
+def execution(lims = None, description="", remote_working_directory=None,
+              resumable=False, resume=None, chdir=True,
+              working_directory_base=None, stage=False):
     """Create an ``Execution`` connected to the given MiniLIMS object.
 
     ``execution`` is a ``contextmanager``, so it can be used in a ``with``
@@ -207,6 +607,23 @@ def execution(lims = None, description="", remote_working_directory=None):
     MiniLIMS repository and deletes the temporary directory after all
     is finished.
 
+    The temporary directory is created in *working_directory_base* if
+    it is given (a fast local disk, for instance), and otherwise in the
+    current directory.  Files added with ``Execution.add`` are moved
+    into the repository rather than copied when they are on the same
+    filesystem.  The rest of the directory is deleted by a background
+    thread; call ``wait_for_cleanup`` to wait for it.
+
+    With *stage*, files start on their way into the repository as soon
+    as they are passed to ``Execution.add``, in background threads,
+    rather than all at once when the execution finishes.  Files on the
+    repository's filesystem are checksummed, and those elsewhere (or
+    to be compressed) are copied to a staging area in the repository.
+    The execution is still recorded in one step at the end, and a file
+    which changed after it was added is stored afresh then.  This
+    overlaps the cost of storing many or large outputs with the rest
+    of the execution.
+
     The ``Execution`` has field ``id`` set to ``None`` during the
     ``with`` block, but afterwards ``id`` is set to the execution ID
     it ran as.  For example::
@@ -231,18 +648,76 @@ def execution(lims = None, description="", remote_working_directory=None):
     an execution may create a directory lK4321fdr21 in /scratch/abc.
     On the worker node, it would be /nfs/boris/scratch/abc/lK4321fd21,
     so you pass /nfs/boris/scratch/abc as *remote_working_directory*.
+
+    If *resumable* is ``True``, the execution is recorded in the
+    MiniLIMS as soon as it starts, and every program which succeeds is
+    checkpointed there along with the files it created or modified in
+    the working directory.  If the execution fails, you can retry it by
+    running the same code in an execution with *resume* set to the ID
+    of the failed execution::
+
+        try:
+            with execution(M, resumable=True) as ex:
+                long_pipeline(ex)
+        except:
+            with execution(M, resume=ex.id) as ex2:
+                long_pipeline(ex2)
+
+    In the retry, each program whose arguments and input files match a
+    program checkpointed by the failed execution (or by any execution
+    it in turn resumed) is not run again: its output files are copied
+    back into the working directory, and its recorded output is used.
+    Each execution has its own random number generator, ``ex.random``,
+    which ``unique_filename_in`` draws from.  Resumable executions
+    seed it so that ``unique_filename_in`` hands out the same names in a retry as in
+    the original run; the code in the ``with`` block must be
+    deterministic for steps to match.  Programs running concurrently
+    via ``nonblocking`` are each checkpointed with every file that
+    changed while they ran.  The retry is itself resumable, and is
+    linked to the execution it resumed (see ``fetch_execution``).
+    Once an execution in such a chain succeeds, the checkpoints of the
+    whole chain are deleted.
+
+    By default, the process's current directory is changed to the
+    execution's working directory for the duration of the ``with``
+    block.  Since the current directory is shared by all threads, only
+    one such execution can run at a time in a process.  With *chdir*
+    set to ``False``, the current directory is left alone, and
+    executions can run concurrently in several threads.  Programs
+    still run in the working directory, and ``unique_filename_in``,
+    ``Execution.add``, the ``stdout`` and ``stderr`` arguments of
+    programs, and the helpers in ``bein.util`` all resolve filenames
+    against it in the thread which opened the execution.  Python code
+    in the ``with`` block which opens files must do so itself, for
+    instance with ``os.path.join(ex.working_directory, filename)``.
     """
-    execution_dir = unique_filename_in(os.getcwd())
-    os.mkdir(os.path.join(os.getcwd(), execution_dir))
-    ex = Execution(lims,os.path.join(os.getcwd(), execution_dir))
+    if (resumable or resume != None) and lims == None:
+        raise ValueError("A resumable execution needs a MiniLIMS to checkpoint to.")
+    if working_directory_base == None:
+        base = _current_directory()
+    else:
+        base = os.path.abspath(working_directory_base)
+    execution_dir = unique_filename_in(base)
+    os.mkdir(os.path.join(base, execution_dir))
+    ex = Execution(lims,os.path.join(base, execution_dir))
+    ex.stage = stage
     if remote_working_directory == None:
         ex.remote_working_directory = ex.working_directory
     else:
         ex.remote_working_directory = os.path.join(remote_working_directory,
                                                    execution_dir)
-    os.chdir(os.path.join(os.getcwd(), execution_dir))
+    previous_directory = getattr(_context, 'working_directory', None)
+    previous_random = getattr(_context, 'random', None)
+    _context.working_directory = ex.working_directory
+    _context.random = ex.random
+    if chdir:
+        previous_cwd = os.getcwd()
+        os.chdir(ex.working_directory)
     exception_string = None
     try:
+        if resumable or resume != None:
+            lims._start_resumable(ex, description, resume)
+            ex.random.seed(ex.seed)
         yield ex
     except:
         (exc_type, exc_value, exc_traceback) = sys.exc_info()
@@ -253,13 +728,84 @@ def execution(lims = None, description="", remote_working_directory=None):
         ex.finish()
         try:
             if lims is not None:
-                ex.id = lims.write(ex, description, exception_string)
+                ex.id = lims.write(ex, description, exception_string, move=True)
         finally:
-            os.chdir("..")
-            shutil.rmtree(ex.working_directory, ignore_errors=True)
+            _context.working_directory = previous_directory
+            _context.random = previous_random
+            if chdir:
+                os.chdir(previous_cwd)
+            _remove_later(ex.working_directory)
             cleaned_up = True
         assert(cleaned_up)
 
+################################################################################
+def _read_proc_io(pid):
+    """Return the bytes read and written by process *pid*, or ``(None, None)``.
+
+    Reads the ``rchar`` and ``wchar`` counters of ``/proc/<pid>/io``,
+    which only exist on Linux.
+    """
+    try:
+        with open('/proc/%d/io' % pid) as f:
+            fields = dict([l.split(':') for l in f if ':' in l])
+        return (int(fields['rchar']), int(fields['wchar']))
+    except (IOError, KeyError, ValueError):
+        return (None, None)
+
+def _is_zombie(pid):
+    """Is *pid* a process which has exited but not been waited for?"""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # The state follows the command name, which is in parentheses.
+            return f.read().rsplit(')', 1)[1].split()[0] == 'Z'
+    except (IOError, IndexError):
+        return True
+
+def _run_and_account(arguments, stdout, stderr, cwd, via):
+    """Run *arguments*, wait for it, and return its ``ProgramOutput``.
+
+    The process is reaped with ``os.wait4`` to get its CPU time and
+    peak memory.  Where ``/proc`` is available, we poll until the
+    process has exited but before reaping it, so its I/O counters can
+    still be read.  Raises ``OSError`` if the program cannot be started.
+    """
+    started_at = time.time()
+    with metrics.timer('program.launch'):
+        sp = subprocess.Popen(arguments, bufsize=-1, stdout=stdout,
+                              stderr=stderr, cwd=cwd)
+    (read_bytes, write_bytes) = (None, None)
+    if os.path.exists('/proc/%d/io' % sp.pid):
+        delay = 0.001
+        while not(_is_zombie(sp.pid)):
+            time.sleep(delay)
+            delay = min(2*delay, 0.05)
+        (read_bytes, write_bytes) = _read_proc_io(sp.pid)
+    (pid, status, rusage) = os.wait4(sp.pid, 0)
+    finished_at = time.time()
+    metrics.increment('program.runs')
+    metrics.timing('program.run', finished_at - started_at)
+    if os.WIFSIGNALED(status):
+        sp.returncode = -os.WTERMSIG(status)
+    else:
+        sp.returncode = os.WEXITSTATUS(status)
+
+    if isinstance(stdout,file):
+        stdout_value = None
+    else:
+        stdout_value = sp.stdout.readlines()
+
+    if isinstance(stderr,file):
+        stderr_value = None
+    else:
+        stderr_value = sp.stderr.readlines()
+
+    return ProgramOutput(sp.returncode, sp.pid, arguments,
+                         stdout_value, stderr_value,
+                         started_at=started_at, finished_at=finished_at,
+                         user_time=rusage.ru_utime, system_time=rusage.ru_stime,
+                         max_rss=rusage.ru_maxrss, read_bytes=read_bytes,
+                         write_bytes=write_bytes, via=via)
+
 ################################################################################
 class program(object):
     """Decorator to wrap external programs for use by bein.
@@ -356,13 +902,13 @@ class program(object):
             raise SyntaxError("Program being called on an execution that has already terminated.")
 
         if kwargs.has_key('stdout'):
-            stdout = open(kwargs['stdout'],'w')
+            stdout = open(os.path.join(ex.working_directory, kwargs['stdout']),'w')
             kwargs.pop('stdout')
         else:
             stdout = subprocess.PIPE
 
         if kwargs.has_key('stderr'):
-            stderr = open(kwargs['stderr'],'w')
+            stderr = open(os.path.join(ex.working_directory, kwargs['stderr']),'w')
             kwargs.pop('stderr')
         else:
             stderr = subprocess.PIPE
@@ -373,29 +919,18 @@ class program(object):
 
         d = self.gen_args(*args, **kwargs)
 
-        try:
-            sp = subprocess.Popen(d["arguments"], bufsize=-1, stdout=stdout,
-                                  stderr=stderr,
-                                  cwd = ex.working_directory)
-        except OSError, ose:
-            raise ValueError("Program %s does not seem to exist in your $PATH." % d['arguments'][0])
-
-        return_code = sp.wait()
-        if isinstance(stdout,file):
-            stdout_value = None
-        else:
-            stdout_value = sp.stdout.readlines()
-
-        if isinstance(stderr,file):
-            stderr_value = None
+        (restored, checkpoint) = ex._begin_program(d["arguments"])
+        if restored != None:
+            po = restored
         else:
-            stderr_value = sp.stderr.readlines()
-
-        po = ProgramOutput(return_code, sp.pid,
-                           d["arguments"],
-                           stdout_value, stderr_value)
+            try:
+                po = _run_and_account(d["arguments"], stdout, stderr,
+                                      ex.working_directory, 'blocking')
+            except OSError, ose:
+                raise ValueError("Program %s does not seem to exist in your $PATH." % d['arguments'][0])
+            po.checkpoint = checkpoint
         ex.report(po)
-        if return_code == 0:
+        if po.return_code == 0:
             z = d["return_value"]
             if callable(z):
                 return z(po)
@@ -465,13 +1000,13 @@ class program(object):
         function, you will have to call this method directly.
         """
         if kwargs.has_key('stdout'):
-            stdout = open(kwargs['stdout'],'w')
+            stdout = open(os.path.join(ex.working_directory, kwargs['stdout']),'w')
             kwargs.pop('stdout')
         else:
             stdout = subprocess.PIPE
 
         if kwargs.has_key('stderr'):
-            stderr = open(kwargs['stderr'],'w')
+            stderr = open(os.path.join(ex.working_directory, kwargs['stderr']),'w')
             kwargs.pop('stderr')
         else:
             stderr = subprocess.PIPE
@@ -495,32 +1030,19 @@ class program(object):
                     return self.return_value
         f = Future()
         v = threading.Event()
+        (restored, checkpoint) = ex._begin_program(d["arguments"])
         def g():
             try:
-                try:
-                    sp = subprocess.Popen(d["arguments"], bufsize=-1,
-                                          stdout=stdout,
-                                          stderr=stderr,
-                                          cwd = ex.working_directory)
-                except OSError, ose:
-                    raise ValueError("Program %s does not seem to exist in your $PATH." % d['arguments'][0])
-
-                return_code = sp.wait()
-                if isinstance(stdout,file):
-                    stdout_value = None
+                if restored != None:
+                    f.program_output = restored
                 else:
-                    stdout_value = sp.stdout.readlines()
-
-                if isinstance(stderr,file):
-                    stderr_value = None
-                else:
-                    stderr_value = sp.stderr.readlines()
-
-                f.program_output = ProgramOutput(return_code, sp.pid,
-                                                 d["arguments"],
-                                                 stdout_value,
-                                                 stderr_value)
-                if return_code == 0:
+                    try:
+                        f.program_output = _run_and_account(d["arguments"], stdout, stderr,
+                                                            ex.working_directory, 'local')
+                    except OSError, ose:
+                        raise ValueError("Program %s does not seem to exist in your $PATH." % d['arguments'][0])
+                    f.program_output.checkpoint = checkpoint
+                if f.program_output.return_code == 0:
                     z = d["return_value"]
                     if callable(z):
                         f.return_value = z(f.program_output)
@@ -600,32 +1122,48 @@ class program(object):
                     return self.return_value
         f = Future()
         v = threading.Event()
+        # Not cmds: the remote working directory in it changes on retry.
+        (restored, checkpoint) = ex._begin_program(d["arguments"])
         def g():
             try:
-                nullout = open(os.path.devnull, 'w')
-                sp = subprocess.Popen(cmds, bufsize=-1, stdout=nullout,
-                                      stderr=nullout)
-                return_code = sp.wait()
-                while not(os.path.exists(os.path.join(ex.working_directory,
-                                                      stdout))):
-                    time.sleep(10) # We need to wait until the files actually show up
-                if load_stdout:
-                    with open(os.path.join(ex.working_directory,stdout), 'r') as fo:
-                        stdout_value = fo.readlines()
+                if restored != None:
+                    f.program_output = restored
                 else:
-                    stdout_value = None
-
-                while not(os.path.exists(os.path.join(ex.working_directory,stderr))):
-                    time.sleep(10) # We need to wait until the files actually show up
-                if load_stderr:
-                    with open(os.path.join(ex.working_directory,stderr), 'r') as fe:
-                        stderr_value = fe.readlines()
-                else:
-                    stderr_value = None
+                    nullout = open(os.path.devnull, 'w')
+                    started_at = time.time()
+                    with metrics.timer('program.launch'):
+                        sp = subprocess.Popen(cmds, bufsize=-1, stdout=nullout,
+                                              stderr=nullout)
+                    return_code = sp.wait()
+                    finished_at = time.time()
+                    metrics.increment('program.runs')
+                    metrics.timing('program.run', finished_at - started_at)
+                    while not(os.path.exists(os.path.join(ex.working_directory,
+                                                          stdout))):
+                        time.sleep(10) # We need to wait until the files actually show up
+                    if load_stdout:
+                        with open(os.path.join(ex.working_directory,stdout), 'r') as fo:
+                            stdout_value = fo.readlines()
+                    else:
+                        stdout_value = None
 
-                f.program_output = ProgramOutput(return_code, sp.pid,
-                                                 cmds, stdout_value, stderr_value)
-                if return_code == 0:
+                    while not(os.path.exists(os.path.join(ex.working_directory,stderr))):
+                        time.sleep(10) # We need to wait until the files actually show up
+                    if load_stderr:
+                        with open(os.path.join(ex.working_directory,stderr), 'r') as fe:
+                            stderr_value = fe.readlines()
+                    else:
+                        stderr_value = None
+
+                    # Only the wall time is known: the job's CPU and
+                    # memory were spent on another node.
+                    f.program_output = ProgramOutput(return_code, sp.pid,
+                                                     cmds, stdout_value, stderr_value,
+                                                     started_at=started_at,
+                                                     finished_at=finished_at,
+                                                     via='lsf')
+                    f.program_output.checkpoint = checkpoint
+                if f.program_output.return_code == 0:
                     z = d["return_value"]
                     if callable(z):
                         f.return_value = z(f.program_output)
@@ -640,6 +1178,266 @@ class program(object):
         a.start()
         return(f)
 
+################################################################################
+def _resolve_function(module, name):
+    """Return the function *name* of *module*, unwrapping a ``pyprogram``."""
+    if not(module in sys.modules):
+        __import__(module)
+    f = getattr(sys.modules[module], name)
+    if isinstance(f, pyprogram):
+        f = f.function
+    return f
+
+def _run_python(module, name, args, kwargs, cwd):
+    """Run the function *name* of *module* in *cwd*, accounting for it.
+
+    Runs in the worker process.  Returns a tuple ``(return_code,
+    value, pid, stdout, stderr, accounting)``, where *accounting* is a
+    dictionary of the resource usage fields of ``ProgramOutput``.  What
+    the function prints is captured as its stdout and stderr.  If it
+    raises an exception, the return code is 1 and the traceback ends
+    stderr.
+    """
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    (out, err) = (StringIO.StringIO(), StringIO.StringIO())
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    (read_before, written_before) = _read_proc_io(os.getpid())
+    started_at = time.time()
+    sys.stdout, sys.stderr = out, err
+    try:
+        # Workers only run pyprograms, and each one changes to its own
+        # directory, so the previous one need not be restored (it may
+        # well have been deleted since).
+        os.chdir(cwd)
+        try:
+            value = _resolve_function(module, name)(*args, **kwargs)
+            return_code = 0
+        except BaseException:
+            # SystemExit and KeyboardInterrupt too: letting them out
+            # would kill the worker, and the caller would wait forever.
+            traceback.print_exc()
+            value = None
+            return_code = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    finished_at = time.time()
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    (read_after, written_after) = _read_proc_io(os.getpid())
+    accounting = {'started_at': started_at, 'finished_at': finished_at,
+                  'user_time': after.ru_utime - before.ru_utime,
+                  'system_time': after.ru_stime - before.ru_stime,
+                  # The peak of the worker, which may predate this call.
+                  'max_rss': after.ru_maxrss,
+                  'read_bytes': (read_after - read_before) if read_before != None else None,
+                  'write_bytes': (written_after - written_before) if written_before != None else None}
+    return (return_code, value, os.getpid(), out.getvalue().splitlines(True),
+            err.getvalue().splitlines(True), accounting)
+
+def _run_python_from_file(call_file, result_file):
+    """Run the call pickled in *call_file*, and pickle its result to *result_file*.
+
+    This is the command a ``pyprogram`` runs through batch systems
+    such as LSF.  Exits with the function's return code.
+    """
+    with open(call_file, 'rb') as f:
+        (module, name, args, kwargs) = pickle.load(f)
+    result = _run_python(module, name, args, kwargs, '.')
+    with open(result_file, 'wb') as f:
+        pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+    sys.stdout.writelines(result[3])
+    sys.stderr.writelines(result[4])
+    sys.exit(result[0])
+
+_python_pool = (None, None)
+_python_pool_lock = threading.Lock()
+
+def _pyprogram_pool():
+    """Return this process's pool of workers for ``pyprogram``."""
+    global _python_pool
+    with _python_pool_lock:
+        # A forked child inherits the pool, but not its workers.
+        (pid, pool) = _python_pool
+        if pid != os.getpid():
+            pool = multiprocessing.Pool(multiprocessing.cpu_count())
+            _python_pool = (os.getpid(), pool)
+        return pool
+
+class pyprogram(object):
+    """Decorator to run a Python function as a program of an execution.
+
+    ``@program`` records external commands.  ``@pyprogram`` does the
+    same for Python functions, which are run in a pool of worker
+    processes, so CPU heavy Python uses several cores and still leaves
+    a trace in the MiniLIMS::
+
+        @pyprogram
+        def gc_content(filename):
+            ...
+            return fraction
+
+        with execution(M) as ex:
+            a = gc_content(ex, 'reads1.fastq')
+            futures = [gc_content.nonblocking(ex, f) for f in pieces]
+            b = [f.wait() for f in futures]
+
+    As with ``@program``, the execution is inserted as the first
+    argument, and ``nonblocking`` returns a Future.  The function is
+    recorded as a program whose arguments are its qualified name and
+    the ``repr`` of its arguments, with what it printed as stdout and
+    stderr, and its CPU time.  It runs in the working directory of the
+    execution.  If it raises an exception, its traceback is recorded
+    in stderr, and ``ProgramFailed`` is raised.
+
+    The function must be defined at the top level of a module, and
+    its arguments and return value must be picklable.  ``via="local"``
+    (the default for ``nonblocking``) runs it in the worker pool.  Any
+    other *via* runs it with this Python interpreter as a program
+    through that backend (such as LSF), which then needs the
+    interpreter, bein and the function's module to be available on
+    the other side.  Python programs are not
+    checkpointed; a resumed execution runs them again.
+    """
+    def __init__(self, function):
+        self.function = function
+        self.__doc__ = function.__doc__
+        self.__name__ = function.__name__
+        self.__module__ = function.__module__
+
+    def _arguments(self, args, kwargs):
+        return ["%s.%s" % (self.function.__module__, self.function.__name__)] + \
+            [repr(a) for a in args] + \
+            ["%s=%r" % (k, v) for (k, v) in sorted(kwargs.items())]
+
+    def __call__(self, ex, *args, **kwargs):
+        """Run the function in a worker process, and block until it returns."""
+        return self._local(ex, 'blocking', *args, **kwargs).wait()
+
+    def nonblocking(self, ex, *args, **kwargs):
+        """Run the function, but return a Future object instead of blocking.
+
+        If you need to pass a keyword argument ``via`` to your
+        function, call ``_local`` or ``_via`` directly.
+        """
+        via = kwargs.pop('via', 'local')
+        if via == 'local':
+            return self._local(ex, via, *args, **kwargs)
+        else:
+            return self._via(ex, via, *args, **kwargs)
+
+    def _check(self, ex):
+        if not(isinstance(ex,Execution)):
+            raise ValueError("First argument to pyprogram " + self.__name__ + " must be an Execution.")
+        elif ex.id != None:
+            raise SyntaxError("Program being called on an execution that has already terminated.")
+
+    def _local(self, ex, via, *args, **kwargs):
+        """Run the function in this process's worker pool."""
+        self._check(ex)
+        arguments = self._arguments(args, kwargs)
+        result = _pyprogram_pool().apply_async(_run_python,
+                                               (self.function.__module__,
+                                                self.function.__name__,
+                                                args, kwargs, ex.working_directory))
+        metrics.increment('program.runs')
+        def finish():
+            (return_code, value, pid, stdout, stderr, accounting) = result.get()
+            po = ProgramOutput(return_code, pid, arguments, stdout, stderr,
+                               via=via, **accounting)
+            ex.report(po)
+            return (po, value)
+        return _PythonFuture(finish)
+
+    def _via(self, ex, via, *args, **kwargs):
+        """Run the function as a Python program through the backend *via*."""
+        self._check(ex)
+        call_file = unique_filename_in(ex.working_directory)
+        result_file = unique_filename_in(ex.working_directory)
+        with open(os.path.join(ex.working_directory, call_file), 'wb') as f:
+            pickle.dump((self.function.__module__, self.function.__name__, args, kwargs),
+                        f, pickle.HIGHEST_PROTOCOL)
+        arguments = self._arguments(args, kwargs)
+        def load_result(p):
+            with open(os.path.join(ex.working_directory, result_file), 'rb') as f:
+                return pickle.load(f)[1]
+        @program
+        def run_python():
+            return {'arguments': [sys.executable, '-c',
+                                  'import sys, bein; bein._run_python_from_file(sys.argv[1], sys.argv[2])',
+                                  call_file, result_file],
+                    'return_value': load_result}
+        future = run_python.nonblocking(ex, via=via)
+        def finish():
+            try:
+                value = future.wait()
+            finally:
+                # Record the function and its arguments, as _local
+                # does, rather than the interpreter's command line.
+                if future.program_output != None:
+                    future.program_output.arguments = arguments
+            return (future.program_output, value)
+        return _PythonFuture(finish)
+
+class _PythonFuture(object):
+    """The Future a ``pyprogram`` returns.
+
+    *finish* waits for the function, reports it to the execution, and
+    returns its ``ProgramOutput`` and return value.  It is only called
+    once, however many times ``wait`` is, so the program is reported
+    once; later calls return the same value or raise the same
+    exception.
+    """
+    def __init__(self, finish):
+        self._finish = finish
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+
+    def wait(self):
+        with self._lock:
+            if self._result == None and self._exc_info == None:
+                try:
+                    self._result = self._finish()
+                except Exception:
+                    self._exc_info = sys.exc_info()
+        if self._exc_info != None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        (po, value) = self._result
+        if po.return_code != 0:
+            raise ProgramFailed(po)
+        return value
+
+# Functions called as f(lims, fileids) after files are deleted.
+_deletion_listeners = []
+
+def add_deletion_listener(f):
+    """Call *f* whenever files are deleted from any MiniLIMS.
+
+    *f* is called after the deletion is committed, as ``f(lims,
+    fileids)`` with the MiniLIMS and the list of IDs of the deleted
+    files (including those deleted along with an execution or a file
+    they were associated to).  This lets caches of file contents drop
+    them.
+    """
+    _deletion_listeners.append(f)
+
+def remove_deletion_listener(f):
+    """Stop calling *f* when files are deleted."""
+    _deletion_listeners.remove(f)
+
+def _serialized(method):
+    """Run *method* holding its MiniLIMS's lock.
+
+    Threads share a MiniLIMS's connection, and with it its open
+    transaction and ``last_insert_rowid()``, so methods which write to
+    the database must not interleave: one's commit would commit
+    another's half-finished transaction.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 ################################################################################
 class MiniLIMS(object):
     """Encapsulates a database and directory to track executions and files.
@@ -667,6 +1465,8 @@ class MiniLIMS(object):
     Deleting files and executions:
       * :meth:`delete_file`
       * :meth:`delete_execution`
+      * :meth:`delete_files`
+      * :meth:`delete_executions`
 
     Searching files and executions:
       * :meth:`search_files`
@@ -683,8 +1483,22 @@ class MiniLIMS(object):
       * :meth:`associate_file`
       * :meth:`delete_file_association`
       * :meth:`associated_files_of`
+
+    Maintenance:
+      * :meth:`verify_file`
+      * :meth:`fsck`
+      * :meth:`gc`
     """
 
+    # Algorithm used for the digests recorded for each file.
+    digest_algorithm = 'md5'
+
+    # How files entering the repository are compressed, unless told
+    # otherwise: None, a codec name ('gzip' or 'zstd'), a dictionary
+    # from lowercase extensions (such as '.sam') to codecs, or a
+    # function taking the file's name and returning a codec or None.
+    compression_policy = None
+
     def __init__(self, path):
         self.db_path = path
         self.db = sqlite3.connect(path, check_same_thread=False,timeout=6000)
@@ -692,6 +1506,11 @@ class MiniLIMS(object):
         if not(os.path.exists(self.file_path)):
             self.initialize_database(self.db)
             os.mkdir(self.file_path)
+        self.upgrade_database()
+        self.checkpoint_path = os.path.join(self.file_path, '.checkpoints')
+        self.staging_path = os.path.join(self.file_path, '.staging')
+        self._reserve_lock = threading.Lock()
+        self._lock = threading.RLock()
         self.db.create_function("importfile",1,self._copy_file_to_repository)
         self.db.create_function("deletefile",1,self._delete_repository_file)
         self.db.create_function("exportfile",2,self._export_file_from_repository)
@@ -710,6 +1529,9 @@ class MiniLIMS(object):
     def initialize_database(self, db):
         """Sets up a new MiniLIMS database.
         """
+        # Only takes effect before the first table is created.  It
+        # lets gc return free pages to the filesystem cheaply.
+        self.db.execute("pragma auto_vacuum = incremental")
         self.db.execute("""
         CREATE TABLE execution (
              id integer primary key,
@@ -806,7 +1628,7 @@ class MiniLIMS(object):
         SELECT eo.execution as id, ifnull(max(fi.immutable),0) as immutable from
         execution_outputs as eo left join file_immutability as fi
         on eo.file = fi.id
-        group by id
+        group by eo.execution
         """)
         self.db.execute("""
         CREATE TRIGGER prevent_file_delete BEFORE DELETE ON file
@@ -880,6 +1702,90 @@ class MiniLIMS(object):
         """)
         self.db.commit()
 
+    def upgrade_database(self):
+        """Bring a MiniLIMS database created by an older bein up to date.
+
+        Adds the columns and tables introduced since the database was
+        created.  It is run every time a MiniLIMS is opened, and does
+        nothing if the database is already current.
+        """
+        def columns(table):
+            return [c for (_,c,_,_,_,_) in
+                    self.db.execute("pragma table_info(%s)" % table)]
+        if not('resumed_from' in columns('execution')):
+            self.db.execute("""alter table execution add column
+                               resumed_from integer references execution(id) default null""")
+        if not('seed' in columns('execution')):
+            self.db.execute("""alter table execution add column seed integer default null""")
+        for (c,t) in [('started_at','real'), ('finished_at','real'),
+                      ('user_time','real'), ('system_time','real'),
+                      ('max_rss','integer'), ('read_bytes','integer'),
+                      ('write_bytes','integer'), ('via','text')]:
+            if not(c in columns('program')):
+                self.db.execute("alter table program add column %s %s default null" % (c,t))
+        for (c,t) in [('digest','text'), ('size','integer'), ('mtime','real'),
+                      ('compression','text')]:
+            if not(c in columns('file')):
+                self.db.execute("alter table file add column %s %s default null" % (c,t))
+        self.db.execute("""CREATE INDEX IF NOT EXISTS file_repository_name
+                           ON file(repository_name)""")
+        # For following associations, uses and outputs when deleting.
+        self.db.execute("""CREATE INDEX IF NOT EXISTS file_origin
+                           ON file(origin_value, origin)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS file_association_associated_to
+                           ON file_association(associated_to)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS execution_use_file
+                           ON execution_use(file)""")
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS checkpoint (
+               execution integer references execution(id),
+               program integer,
+               arguments text not null,
+               inputs text not null,
+               pid integer,
+               stdout text default null,
+               stderr text default null,
+               primary key (execution,program)
+        )""")
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS checkpoint_file (
+               execution integer references execution(id),
+               program integer,
+               filename text not null,
+               repository_name text not null
+        )""")
+        # Databases created before this check had a trigger referring
+        # to a nonexistent column, which made every update of an
+        # execution fail.
+        [trigger] = [x for (x,) in self.db.execute("""select sql from sqlite_master
+                                                      where name='prevent_execution_update'""")]
+        if 'temp_dir' in trigger:
+            self.db.execute("drop trigger prevent_execution_update")
+            self.db.execute("""
+            CREATE TRIGGER prevent_execution_update BEFORE UPDATE ON execution
+            FOR EACH ROW WHEN
+                (SELECT immutable FROM execution_immutability WHERE id = OLD.id) = 1 AND
+                (OLD.id != NEW.id OR OLD.started_at != NEW.started_at OR OLD.finished_at != NEW.finished_at
+                 OR OLD.working_directory != NEW.working_directory)
+            BEGIN
+                SELECT RAISE(FAIL, 'Execution is immutable; cannot update anything but description.');
+            END
+            """)
+        # Older databases grouped this view by fi.id, which merged
+        # every execution without output files into a single row.
+        [view] = [x for (x,) in self.db.execute("""select sql from sqlite_master
+                                                   where name='execution_immutability'""")]
+        if not('group by eo.execution' in view):
+            self.db.execute("drop view execution_immutability")
+            self.db.execute("""
+            CREATE VIEW execution_immutability AS
+            SELECT eo.execution as id, ifnull(max(fi.immutable),0) as immutable from
+            execution_outputs as eo left join file_immutability as fi
+            on eo.file = fi.id
+            group by eo.execution
+            """)
+        self.db.commit()
+
     def _copy_file_to_repository(self,src):
         """Copy a file src into the MiniLIMS repository.
 
@@ -887,9 +1793,230 @@ class MiniLIMS(object):
         using .. and other such shortcuts.  This function should only
         be called from SQLite3, not Python.
         """
-        filename = unique_filename_in(self.file_path)
-        shutil.copyfile(src,os.path.abspath(os.path.join(self.file_path,filename)))
-        return filename
+        return self._import_blob(src)[0]
+
+    def _import_blob(self, src, compression=None, move=False):
+        """Copy *src* into the repository, checksumming it on the way.
+
+        With *move*, *src* is renamed into the repository instead if it
+        is a regular file on the same filesystem, has no other hard
+        links, and is not to be compressed.  It is then read once to
+        checksum it, but never written again.
+
+        Returns ``(filename, digest, size, mtime, compression)``: the
+        new file's name in the repository, the digest of its contents as
+        ``algorithm:hexdigest`` using *digest_algorithm*, the size and
+        modification time of the copy, and how it was compressed.  The
+        digest is always of the uncompressed contents.
+        """
+        filename = self._reserve_blob_name()
+        dst = os.path.abspath(os.path.join(self.file_path,filename))
+        if move and compression == None:
+            st = os.lstat(src)
+            if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+                try:
+                    with metrics.timer('lims.import_move'):
+                        st = _rename_into(src, dst)
+                    metrics.observe('lims.import_bytes', st.st_size)
+                    return (filename, "%s:%s" % (self.digest_algorithm,
+                                                 checksum(dst, self.digest_algorithm)),
+                            st.st_size, st.st_mtime, compression)
+                except OSError, e:
+                    if e.errno != errno.EXDEV:
+                        os.remove(dst)
+                        raise
+        h = _new_hash(self.digest_algorithm)
+        try:
+            with metrics.timer('lims.import_copy'):
+                with open(src, 'rb') as fsrc:
+                    fdst = _write_blob(dst, compression)
+                    try:
+                        _copy_stream(fsrc, fdst, h)
+                    finally:
+                        fdst.close()
+        except:
+            os.remove(dst)
+            raise
+        st = os.stat(dst)
+        metrics.observe('lims.import_bytes', st.st_size)
+        return (filename, "%s:%s" % (self.digest_algorithm, h.hexdigest()),
+                st.st_size, st.st_mtime, compression)
+
+    def _reserve_blob_name(self, lease=None):
+        """Create an empty blob with a fresh name in the repository and return its name.
+
+        Creating the file claims the name, so threads importing in
+        parallel never pick the same one.  With *lease* (see
+        ``_open_lease``), the name is also written to it.
+        """
+        with self._reserve_lock:
+            while True:
+                filename = unique_filename_in(self.file_path)
+                try:
+                    os.close(os.open(os.path.join(self.file_path, filename),
+                                     os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            if lease != None:
+                lease.write(filename + '\n')
+                lease.flush()
+            return filename
+
+    def _open_lease(self):
+        """Open a lease on the staging area for an execution, and return it.
+
+        A staging execution's copies wait in the staging area, and the
+        names they reserve in the repository stay empty, for as long as
+        the execution runs, which can be much longer than the *min_age*
+        of ``gc`` and ``fsck``.  Their names are written to the lease,
+        a file in the staging area locked until ``_release_lease`` (or
+        the death of the process) unlocks it, and ``_leased_blobs``
+        tells ``gc`` and ``fsck`` to leave them alone meanwhile.
+        """
+        if not(os.path.exists(self.staging_path)):
+            try:
+                os.mkdir(self.staging_path)
+            except OSError:
+                pass # Another thread made it first.
+        while True:
+            path = os.path.join(self.staging_path,
+                                '.%s.lease' % unique_filename_in(self.staging_path))
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        lease = open(path, 'a')
+        fcntl.flock(lease.fileno(), fcntl.LOCK_EX)
+        return lease
+
+    def _release_lease(self, lease):
+        """Remove and unlock a lease returned by ``_open_lease``."""
+        try:
+            os.remove(lease.name)
+        except OSError:
+            pass
+        lease.close()
+
+    def _leased_blobs(self, min_age=None):
+        """Return the names of the blobs held by leases of running executions.
+
+        A lease still locked belongs to a running execution.  With
+        *min_age*, those no execution holds any more are removed once
+        they are that many seconds old; younger ones may have just been
+        created and not locked yet.
+        """
+        names = set()
+        if not(os.path.isdir(self.staging_path)):
+            return names
+        for f in os.listdir(self.staging_path):
+            if not(f.startswith('.') and f.endswith('.lease')):
+                continue
+            path = os.path.join(self.staging_path, f)
+            try:
+                lease = open(path)
+            except IOError:
+                continue # Released meanwhile.
+            try:
+                try:
+                    fcntl.flock(lease.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    names.update(lease.read().split())
+                    continue
+                if min_age != None and time.time() - os.fstat(lease.fileno()).st_mtime >= min_age:
+                    os.remove(path)
+            finally:
+                lease.close()
+        return names
+
+    def _stage_blob(self, src, compression=None, lease=None):
+        """Start storing *src* in the repository ahead of ``write``.
+
+        Called in the background by ``Execution.add`` in staging
+        executions.  If *src* is an uncompressed regular file on the
+        repository's filesystem, it will be moved in, so it is only
+        checksummed now.  Otherwise it is copied (and compressed) into
+        the staging directory under a name reserved in the repository.
+        The reserved name is written to *lease* (see ``_open_lease``).
+        Returns what ``_claim_staged`` needs to finish the job.
+        """
+        before = os.stat(src)
+        key = (before.st_dev, before.st_ino, before.st_size, before.st_mtime)
+        if compression == None and stat.S_ISREG(before.st_mode) and \
+                before.st_nlink == 1 and before.st_dev == os.stat(self.file_path).st_dev:
+            return ('checksummed', key,
+                    "%s:%s" % (self.digest_algorithm, checksum(src, self.digest_algorithm)))
+        if not(os.path.exists(self.staging_path)):
+            try:
+                os.mkdir(self.staging_path)
+            except OSError:
+                pass # Another thread made it first.
+        filename = self._reserve_blob_name(lease)
+        dst = os.path.join(self.staging_path, filename)
+        h = _new_hash(self.digest_algorithm)
+        try:
+            with metrics.timer('lims.stage_copy'):
+                with open(src, 'rb') as fsrc:
+                    fdst = _write_blob(dst, compression)
+                    try:
+                        _copy_stream(fsrc, fdst, h)
+                    finally:
+                        fdst.close()
+        except:
+            self._unlink([dst, os.path.join(self.file_path, filename)])
+            raise
+        st = os.stat(dst)
+        return ('copied', key, (filename, "%s:%s" % (self.digest_algorithm, h.hexdigest()),
+                                st.st_size, st.st_mtime, compression))
+
+    def _claim_staged(self, src, staged, move):
+        """Finish storing *src* from what ``_stage_blob`` returned.
+
+        Returns the same as ``_import_blob``, or ``None`` if *src*
+        changed since it was staged and must be stored afresh.
+        """
+        (kind, key, value) = staged
+        st = os.stat(src)
+        if key != (st.st_dev, st.st_ino, st.st_size, st.st_mtime):
+            if kind == 'copied':
+                self._unlink([os.path.join(self.staging_path, value[0]),
+                              os.path.join(self.file_path, value[0])])
+            return None
+        if kind == 'copied':
+            # Replaces the empty file reserving the name.
+            st = _rename_into(os.path.join(self.staging_path, value[0]),
+                              os.path.join(self.file_path, value[0]))
+            return (value[0], value[1], st.st_size, st.st_mtime, value[4])
+        elif move:
+            filename = self._reserve_blob_name()
+            st = _rename_into(src, os.path.join(self.file_path, filename))
+            return (filename, value, st.st_size, st.st_mtime, None)
+        else:
+            return None
+
+    def _compression_for(self, filename, compress=None):
+        """Decide how to compress *filename* when it enters the repository.
+
+        An explicit *compress* wins (``False`` meaning no
+        compression); otherwise *compression_policy* decides.
+        """
+        if compress == None:
+            policy = self.compression_policy
+            if callable(policy):
+                compress = policy(filename)
+            elif isinstance(policy, dict):
+                compress = policy.get(os.path.splitext(filename)[1].lower())
+            else:
+                compress = policy
+        if not(compress):
+            return None
+        _check_codec(compress)
+        return compress
 
     def _delete_repository_file(self,filename):
         """Delete a file from the MiniLIMS repository.
@@ -909,15 +2036,151 @@ class MiniLIMS(object):
         else:
             filename = ""
         try:
-            [repository_filename] = [x for (x,) in self.db.execute("select repository_name from file where id=?",
-                                                                   (fileid,))]
-            shutil.copyfile(os.path.abspath(os.path.join(self.file_path,repository_filename)),
-                            os.path.abspath(os.path.join(dst, filename)))
+            (repository_filename, compression) = self._blob_of(fileid)
+            src = os.path.abspath(os.path.join(self.file_path,repository_filename))
+            with metrics.timer('lims.export_copy'):
+                _export_blob(src, compression, os.path.abspath(os.path.join(dst, filename)))
+            if metrics.enabled():
+                metrics.observe('lims.export_bytes', os.path.getsize(src))
             return filename
         except ValueError, v:
             return None
 
-    def write(self, ex, description = "", exception_string=None):
+    def _blob_of(self, fileid):
+        """Return the repository name and compression of the blob of *fileid*.
+
+        Raises ``ValueError`` if there is no such file.
+        """
+        row = self.db.execute("select repository_name,compression from file where id=?",
+                              (fileid,)).fetchone()
+        if row == None:
+            raise ValueError("No such file " + str(fileid) + " in MiniLIMS.")
+        return row
+
+    @_serialized
+    def _start_resumable(self, ex, description, resume=None):
+        """Record a resumable execution in the MiniLIMS as it starts.
+
+        Sets the execution's *checkpoint_id* to the row it will be
+        written to when it finishes.  If *resume* is the ID of an
+        earlier execution, the new execution is linked to it and reuses
+        its random seed.
+        """
+        ex.resumable = True
+        ex.resumed_from = resume
+        if resume != None:
+            row = self.db.execute("select seed from execution where id=?",
+                                  (resume,)).fetchone()
+            if row == None:
+                raise ValueError("No such execution with id %d" % (resume,))
+            ex.seed = row[0]
+        if ex.seed == None:
+            ex.seed = random.randint(0, sys.maxint)
+        self.db.execute("""insert into execution
+                           (started_at, working_directory, description,
+                            resumed_from, seed)
+                           values (?,?,?,?,?)""",
+                        (ex.started_at, ex.working_directory, str(description),
+                         resume, ex.seed))
+        ex.checkpoint_id = self.db.execute("select last_insert_rowid()").fetchone()[0]
+        self.db.commit()
+
+    def _resume_chain(self, exid):
+        """Return *exid* and all the executions it resumed, newest first."""
+        chain = []
+        while exid != None and not(exid in chain):
+            chain.append(exid)
+            row = self.db.execute("select resumed_from from execution where id=?",
+                                  (exid,)).fetchone()
+            exid = row and row[0]
+        return chain
+
+    @_serialized
+    def _checkpoint_program(self, ex, pos, program):
+        """Checkpoint the program *program* at position *pos* of *ex*.
+
+        The files it created or modified in the working directory are
+        copied to the checkpoint area of the repository.
+        """
+        (arguments, inputs, before) = program.checkpoint
+        if isinstance(before, dict):
+            filenames = [f for (f,stat) in ex._snapshot().iteritems()
+                         if before.get(f) != stat]
+        else:
+            filenames = before
+        if not(os.path.exists(self.checkpoint_path)):
+            os.mkdir(self.checkpoint_path)
+        for i,f in enumerate(filenames):
+            # Not unique_filename_in: that would consume the random
+            # numbers which must be replayed identically on a retry.
+            repository_name = "%d-%d-%d" % (ex.checkpoint_id, pos, i)
+            shutil.copyfile(os.path.join(ex.working_directory, f),
+                            os.path.join(self.checkpoint_path, repository_name))
+            self.db.execute("""insert into checkpoint_file(execution,program,
+                                                           filename,repository_name)
+                               values (?,?,?,?)""",
+                            (ex.checkpoint_id, pos, f, repository_name))
+        self.db.execute("""insert into checkpoint(execution,program,arguments,
+                                                  inputs,pid,stdout,stderr)
+                           values (?,?,?,?,?,?,?)""",
+                        (ex.checkpoint_id, pos, json.dumps(arguments), inputs,
+                         program.pid,
+                         program.stdout != None and "".join(program.stdout) or None,
+                         program.stderr != None and "".join(program.stderr) or None))
+        self.db.commit()
+
+    def _restore_checkpoint(self, ex, arguments, inputs):
+        """Restore a checkpointed program matching *arguments* and *inputs*.
+
+        Looks through the executions *ex* resumes for a checkpoint of a
+        program with the same arguments, run on inputs with the same
+        signature.  If there is one, its files are copied back into the
+        working directory and its ``ProgramOutput`` is returned.
+        Otherwise returns ``None``.
+        """
+        chain = self._resume_chain(ex.resumed_from)
+        if chain == []:
+            return None
+        row = self.db.execute("""select execution,program,pid,stdout,stderr
+                                 from checkpoint
+                                 where arguments=? and inputs=? and execution in (%s)
+                                 order by execution desc limit 1""" % \
+                                  ",".join(["?" for e in chain]),
+                              [json.dumps(arguments), inputs] + chain).fetchone()
+        if row == None:
+            return None
+        (exid, pos, pid, stdout, stderr) = row
+        filenames = []
+        for (f, repository_name) in self.db.execute("""select filename,repository_name
+                                                       from checkpoint_file
+                                                       where execution=? and program=?""",
+                                                    (exid, pos)).fetchall():
+            shutil.copyfile(os.path.join(self.checkpoint_path, repository_name),
+                            os.path.join(ex.working_directory, f))
+            filenames.append(f)
+        po = ProgramOutput(0, pid, arguments,
+                           stdout != None and stdout.splitlines(True) or None,
+                           stderr != None and stderr.splitlines(True) or None,
+                           via='checkpoint')
+        po.checkpoint = (arguments, inputs, filenames)
+        return po
+
+    @_serialized
+    def _delete_checkpoints(self, exids):
+        """Delete all checkpoints recorded by the executions *exids*."""
+        for exid in exids:
+            for (repository_name,) in self.db.execute("""select repository_name from checkpoint_file
+                                                         where execution=?""", (exid,)).fetchall():
+                try:
+                    os.remove(os.path.join(self.checkpoint_path, repository_name))
+                except OSError:
+                    pass
+            self.db.execute("delete from checkpoint_file where execution=?", (exid,))
+            self.db.execute("delete from checkpoint where execution=?", (exid,))
+        self.db.commit()
+
+    @metrics.timed('lims.write')
+    def write(self, ex, description = "", exception_string=None, move=False):
         """Write an execution to the MiniLIMS.
 
         The overall Execution object is recorded in the execution
@@ -927,20 +2190,56 @@ class MiniLIMS(object):
         were used in the execution from the MiniLIMS repository are
         added to the execution_use table.  Any files which were added
         to the repository are copied to the repository and entered in
-        the file table.
+        the file table.  With *move*, they are moved instead where
+        possible, which ``execution`` does since it deletes the working
+        directory afterwards anyway.
         """
-        sqlite3.OptimizedUnicode  #self.db.text_factory = 'unicode'
-        description = str(description)
-        self.db.execute("""insert into execution
-                           (started_at, finished_at, working_directory,
-                            description, exception)
-                           values (?,?,?,?,?)""",
-                        (ex.started_at, ex.finished_at, ex.working_directory,
-                         description, exception_string))
-        exid = self.db.execute("select last_insert_rowid()").fetchone()[0]
+        if ex._stager != None:
+            ex._stager.close()
+        try:
+            blobs = self._store_blobs(ex, move)
+            return self._record_execution(self._execution_record(ex, description,
+                                                                 exception_string, blobs))
+        finally:
+            if ex._lease != None:
+                self._release_lease(ex._lease)
+                ex._lease = None
 
-        # Write all the programs
+    def _store_blobs(self, ex, move=False):
+        """Store the files added to *ex* in the repository.
 
+        Returns the blob of each entry of *ex.files*, in order, as
+        ``_import_blob`` does.  This is all of ``write`` which touches
+        the files, and none of it touches the database.
+        """
+        # A file added several times can only be moved the last time.
+        adds_left = {}
+        for f in ex.files:
+            adds_left[f[0]] = adds_left.get(f[0], 0) + 1
+        blobs = []
+        for (filename,description,associate_to_id,associate_to_filename,
+             template,alias,compress,staged) in ex.files:
+            adds_left[filename] -= 1
+            src = os.path.abspath(os.path.join(ex.working_directory,filename))
+            blob = None
+            if staged != None:
+                try:
+                    blob = self._claim_staged(src, staged.get(),
+                                              move and adds_left[filename] == 0)
+                except Exception:
+                    blob = None # Store it afresh below.
+            if blob == None:
+                blob = self._import_blob(src, self._compression_for(filename, compress),
+                                         move and adds_left[filename] == 0)
+            blobs.append(blob)
+        return blobs
+
+    def _execution_record(self, ex, description, exception_string, blobs):
+        """Return everything ``_record_execution`` needs to know about *ex*.
+
+        The record holds only strings, numbers, lists, tuples and
+        dictionaries, so it can be sent to a ``bein.server``.
+        """
         # If the program is not found, the following will return an AttributeError.
         # We avoid this case by replacing the program failed by a fake program instance.
         class failed_program(object):
@@ -951,6 +2250,7 @@ class MiniLIMS(object):
                 self.return_code = exception_string
                 self.arguments = []
 
+        programs = []
         for i,p in enumerate(ex.programs):
             if p is None:
                 p = failed_program(i)
@@ -962,82 +2262,172 @@ class MiniLIMS(object):
                 stderr_value = ""
             else:
                 stderr_value = ("".join(p.stderr))[0:2000]
-
-            self.db.execute("""insert into program(pos,execution,pid,
-                                                   return_code,stdout,stderr)
-                               values (?,?,?,?,?,?)""",
-                            (i, exid, p.pid, p.return_code,
-                             stdout_value.decode('utf-8'), stderr_value.decode('utf-8')))
-            for j,a in enumerate(p.arguments):
-                self.db.execute("""insert into argument(pos,program,execution,
-                                   argument) values (?,?,?,?)""",
-                                (j,i,exid,a))
-
-        # Write the files
-
-        # This section is rather complicated due to the necessity of
-        # handling hierarchies of associations correctly.  The
-        # algorithm is roughly as follows:
-
-        # remaining = files which have yet to be inserted
-        # removed = those files already processed
-        # while True:
-        #     these = all files to be processed this round,
-        #             defined as those whose associate_to_file field
-        #             (field 3 of the tuple) is in removed.
-        #     for file in these:
-        #         insert the file
-        #         add any alias
-        #         associate the file, renaming it so association namings are
-        #             preserved even in the repository
-
-        fileids = {}
-        removed = [(None,)]
-        remaining = ex.files
-        while remaining != []:
-            these = [k for k in ex.files if k[3] in [x[0] for x in removed]]
-
-            for (filename,description,associate_to_id,associate_to_filename,
-                 template,alias) in these:
-
-                fileids[filename] = self._insert_file(ex, exid, filename, description)
-
-                if alias != None:
-                    self.add_alias(fileids[filename], alias)
-
-                if associate_to_id != None or associate_to_filename != None:
-                    if template == None:
-                        raise ValueError("Must provide a template for an association.")
-                    elif template == "%s":
-                        raise ValueError("Template must be more than just %s")
-                    elif template.index("%s") == -1:
-                        raise ValueError("Template must contain %s")
-                    elif associate_to_id != None:
-                        self._associate_file(fileids[filename], associate_to_id, template)
-                    else:
-                        self._associate_file(fileids[filename], fileids[associate_to_filename], template)
-
-            [remaining.remove(t) for t in these]
-            removed.extend(these)
-
-
-        for used_file in set(ex.used_files):
-            self.db.execute("""insert into execution_use(execution,file)
-                               values (?,?)""", (exid,used_file))
-        self.db.commit()
+            program = {'pid': p.pid,
+                       'return_code': p.return_code,
+                       'stdout': stdout_value.decode('utf-8'),
+                       'stderr': stderr_value.decode('utf-8'),
+                       'arguments': list(p.arguments)}
+            for k in _accounting_fields:
+                program[k] = getattr(p, k, None)
+            programs.append(program)
+
+        files = []
+        for ((filename,description_,associate_to_id,associate_to_filename,
+              template,alias,compress,staged), blob) in zip(ex.files, blobs):
+            files.append({'filename': filename,
+                          'description': description_,
+                          'associate_to_id': associate_to_id,
+                          'associate_to_filename': associate_to_filename,
+                          'template': template,
+                          'alias': alias,
+                          'blob': tuple(blob)})
+
+        return {'checkpoint_id': ex.checkpoint_id,
+                'resumable': ex.resumable,
+                'started_at': ex.started_at,
+                'finished_at': ex.finished_at,
+                'working_directory': ex.working_directory,
+                'description': str(description),
+                'exception': exception_string,
+                'programs': programs,
+                'files': files,
+                'used_files': list(set(ex.used_files))}
+
+    @_serialized
+    def _record_execution(self, record):
+        """Enter the execution described by *record* in the database, and return its ID.
+
+        *record* is what ``_execution_record`` returns; the files it
+        adds are already stored in the repository.
+        """
+        sqlite3.OptimizedUnicode  #self.db.text_factory = 'unicode'
+        try:
+            if record['checkpoint_id'] != None:
+                # Resumable executions were recorded when they started.
+                exid = record['checkpoint_id']
+                self.db.execute("""update execution set finished_at=?, description=?,
+                                   exception=? where id=?""",
+                                (record['finished_at'], record['description'],
+                                 record['exception'], exid))
+            else:
+                self.db.execute("""insert into execution
+                                   (started_at, finished_at, working_directory,
+                                    description, exception)
+                                   values (?,?,?,?,?)""",
+                                (record['started_at'], record['finished_at'],
+                                 record['working_directory'], record['description'],
+                                 record['exception']))
+                exid = self.db.execute("select last_insert_rowid()").fetchone()[0]
+
+            # Write all the programs
+
+            for i,p in enumerate(record['programs']):
+                self.db.execute("""insert into program(pos,execution,pid,
+                                                       return_code,stdout,stderr,
+                                                       started_at,finished_at,
+                                                       user_time,system_time,max_rss,
+                                                       read_bytes,write_bytes,via)
+                                   values (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                                (i, exid, p['pid'], p['return_code'], p['stdout'], p['stderr'])+
+                                tuple([p[k] for k in _accounting_fields]))
+                for j,a in enumerate(p['arguments']):
+                    self.db.execute("""insert into argument(pos,program,execution,
+                                       argument) values (?,?,?,?)""",
+                                    (j,i,exid,a))
+
+            # Write the files
+
+            # This section is rather complicated due to the necessity of
+            # handling hierarchies of associations correctly.  The
+            # algorithm is roughly as follows:
+
+            # remaining = files which have yet to be inserted
+            # removed = those files already processed
+            # while True:
+            #     these = all files to be processed this round,
+            #             defined as those whose associate_to_file field
+            #             is in removed.
+            #     for file in these:
+            #         rename the file's blob so association namings are
+            #             preserved even in the repository
+            #         insert the file
+            #         add any alias
+            #         associate the file
+
+            fileids = {}
+            names = {}
+            removed = [None]
+            remaining = list(record['files'])
+            while remaining != []:
+                these = [k for k in remaining if k['associate_to_filename'] in removed]
+                if these == []:
+                    raise ValueError("Files associated to files never added: %s" % \
+                                         ", ".join([k['filename'] for k in remaining]))
+
+                for f in these:
+                    filename = f['filename']
+                    (repository_name, digest, size, mtime, compression) = f['blob']
+                    template = f['template']
+                    associated = f['associate_to_id'] != None or f['associate_to_filename'] != None
+                    if associated:
+                        if template == None:
+                            raise ValueError("Must provide a template for an association.")
+                        elif template == "%s":
+                            raise ValueError("Template must be more than just %s")
+                        elif template.find("%s") == -1:
+                            raise ValueError("Template must contain %s")
+                        elif f['associate_to_id'] != None:
+                            target = f['associate_to_id']
+                            target_name = self._blob_of(target)[0]
+                        else:
+                            target = fileids[f['associate_to_filename']]
+                            target_name = names[f['associate_to_filename']]
+                        # Name the blob after the one it is associated to, so
+                        # association namings are preserved in the repository.
+                        # Its file row does not exist yet, so renaming it
+                        # touches nothing this transaction might roll back.
+                        st = _rename_into(os.path.join(self.file_path, repository_name),
+                                          os.path.join(self.file_path, template % target_name))
+                        (repository_name, mtime) = (template % target_name, st.st_mtime)
+                    self.db.execute("""insert into file(external_name,repository_name,
+                                                        description,origin,origin_value,
+                                                        digest,size,mtime,compression)
+                                       values (?,?,?,?,?,?,?,?,?)""",
+                                    (filename, repository_name, f['description'], 'execution', exid,
+                                     digest, size, mtime, compression))
+                    fileids[filename] = self.db.execute("select last_insert_rowid()").fetchone()[0]
+                    names[filename] = repository_name
+
+                    # Not add_alias and associate_file, which commit.
+                    if f['alias'] != None:
+                        self.db.execute("""insert into file_alias(alias,file) values (?,?)""",
+                                        (f['alias'], fileids[filename]))
+                    if associated:
+                        self.db.execute("""insert into file_association(fileid,associated_to,template)
+                                           values (?,?,?)""", (fileids[filename], target, template))
+
+                [remaining.remove(t) for t in these]
+                removed.extend([t['filename'] for t in these])
+
+
+            for used_file in record['used_files']:
+                self.db.execute("""insert into execution_use(execution,file)
+                                   values (?,?)""", (exid,used_file))
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        if record['resumable'] and record['exception'] == None:
+            self._delete_checkpoints(self._resume_chain(exid))
         return exid
 
-    def _insert_file(self, ex, exid, filename, description):
-        self.db.execute("""insert into file(external_name,repository_name,
-                                            description,origin,origin_value)
-                           values (?,importfile(?),?,?,?)""",
-                        (filename, os.path.abspath(os.path.join(ex.working_directory,filename)),
-                         description, 'execution', exid))
-        return self.db.execute("""select last_insert_rowid()""").fetchone()[0]
-
-    def _rename_in_repository(self, fileid, new_repository_name):
-        old_target_name = self.db.execute("""select repository_name from file
-                                             where id=?""", (fileid,)).fetchone()[0]
+    def _references_to(self, repository_name):
+        """Return how many files share the blob *repository_name*."""
+        return self.db.execute("select count(*) from file where repository_name=?",
+                               (repository_name,)).fetchone()[0]
+
+    @_serialized
+    def _set_repository_name(self, fileid, new_repository_name):
         self.db.execute("""drop trigger if exists prevent_repository_name_change""")
         self.db.execute("""update file set repository_name=? where id=?""",
                         (new_repository_name, fileid))
@@ -1046,17 +2436,8 @@ class MiniLIMS(object):
                            FOR EACH ROW WHEN (OLD.repository_name != NEW.repository_name) BEGIN
                            SELECT RAISE(FAIL, 'Cannot change the repository name of a file.');
                            END""")
-        shutil.move(os.path.join(self.file_path, old_target_name),
-                    os.path.join(self.file_path, new_repository_name))
-
-    def _associate_file(self, thisid, targetid, template):
-        # Make the filename in the repository match this association
-        raw_name = self.db.execute("""select repository_name from file where id=?""",
-                                   (targetid,)).fetchone()[0]
-        new_target_name = template % raw_name
-        self._rename_in_repository(thisid, new_target_name)
-        self.associate_file(thisid, targetid, template)
 
+    @metrics.timed('lims.search_files')
     def search_files(self, with_text=None, with_description=None, older_than=None, newer_than=None, source=None):
         """Find files matching given criteria in the LIMS.
 
@@ -1120,6 +2501,7 @@ class MiniLIMS(object):
               source[1], source[1]))
         return [x for (x,) in matching_files]
 
+    @metrics.timed('lims.search_executions')
     def search_executions(self, with_text=None, with_description=None, started_before=None,
                           started_after=None, ended_before=None, ended_after=None, fails=None):
         """Find executions matching the given criteria.
@@ -1275,14 +2657,15 @@ class MiniLIMS(object):
         """Returns a dictionary describing the given file."""
         fileid = self.resolve_alias(id_or_alias)
         fields = self.db.execute("""select external_name, repository_name,
-                                    created, description, origin, origin_value
+                                    created, description, origin, origin_value,
+                                    digest, compression
                                     from file where id=?""",
                                  (fileid,)).fetchone()
         if fields == None:
             raise ValueError("No such file " + str(id_or_alias) + " in MiniLIMS.")
         else:
             [external_name, repository_name, created, description,
-             origin_type, origin_value] = fields
+             origin_type, origin_value, digest, compression] = fields
         if origin_type == 'copy':
             origin = ('copy',origin_value)
         elif origin_type == 'execution':
@@ -1306,35 +2689,58 @@ class MiniLIMS(object):
                 'aliases': aliases,
                 'associations': associations,
                 'associated_to': associated_to,
+                'digest': digest,
+                'compression': compression,
                 'immutable': immutable == 1}
 
 
     def fetch_execution(self, exid):
-        """Returns a dictionary of all the data corresponding to the given execution id."""
+        """Returns a dictionary of all the data corresponding to the given execution id.
+
+        Each program carries the resources it used and how it was run
+        (see ``ProgramOutput``), and its *wall_time* in seconds.  The
+        execution's ``'resources'`` entry sums the wall time, CPU time,
+        and bytes read and written over all its programs, and gives the
+        largest *max_rss* among them.  Fields which were not measured
+        are ``None``.
+        """
         def fetch_program(exid, progid):
-            fields = self.db.execute("""select pid,return_code,stdout,stderr
-                                        from program where execution=? and pos=?""",
+            fields = self.db.execute("""select pid,return_code,stdout,stderr,%s
+                                        from program where execution=? and pos=?""" % \
+                                         ",".join(_accounting_fields),
                                      (exid, progid)).fetchone()
             if fields == None:
                 raise ValueError("No such program: execution %d, program %d" % (exid, progid))
             else:
-                [pid, return_code, stdout, stderr] = fields
+                [pid, return_code, stdout, stderr] = fields[:4]
             arguments = [a for (a,) in self.db.execute("""select argument from argument
                                                           where execution=? and program=?
                                                           order by pos asc""", (exid,progid))]
-            return {'pid': pid,
-                    'return_code': return_code,
-                    'stdout': stdout,
-                    'stderr': stderr,
-                    'arguments': arguments}
+            program = {'pid': pid,
+                       'return_code': return_code,
+                       'stdout': stdout,
+                       'stderr': stderr,
+                       'arguments': arguments}
+            program.update(zip(_accounting_fields, fields[4:]))
+            if program['started_at'] != None and program['finished_at'] != None:
+                program['wall_time'] = program['finished_at'] - program['started_at']
+            else:
+                program['wall_time'] = None
+            return program
+        def total(progs, field, combine=sum):
+            values = [p[field] for p in progs if p[field] != None]
+            if values == []:
+                return None
+            else:
+                return combine(values)
         exfields = self.db.execute("""select started_at, finished_at, working_directory,
-                                           description, exception from execution
+                                           description, exception, resumed_from from execution
                                     where id=?""", (exid,)).fetchone()
         if exfields == None:
             raise ValueError("No such execution with id %d" % (exid,))
         else:
             (started_at,finished_at,working_directory,
-             description, exception) = exfields
+             description, exception, resumed_from) = exfields
         progids = [a for (a,) in self.db.execute("""select pos from program where execution=?
                                                   order by pos asc""", (exid,))]
         progs = [fetch_program(exid,i) for i in progids]
@@ -1345,6 +2751,12 @@ class MiniLIMS(object):
                                                        where execution=?""", (exid,))]
         immutability = self.db.execute("""select immutable from execution_immutability
             where id=?""", (exid,)).fetchone()[0]
+        resources = {'wall_time': total(progs, 'wall_time'),
+                     'user_time': total(progs, 'user_time'),
+                     'system_time': total(progs, 'system_time'),
+                     'max_rss': total(progs, 'max_rss', max),
+                     'read_bytes': total(progs, 'read_bytes'),
+                     'write_bytes': total(progs, 'write_bytes')}
 
         return {'started_at': started_at,
                 'finished_at': finished_at,
@@ -1354,97 +2766,617 @@ class MiniLIMS(object):
                 'programs': progs,
                 'added_files': added_files,
                 'used_files': used_files,
+                'resumed_from': resumed_from,
+                'resources': resources,
                 'immutable': immutability == 1}
 
-    def copy_file(self, file_or_alias):
+    def export_trace(self, exid, dst):
+        """Write the timeline of execution *exid* to *dst* as a Chrome trace.
+
+        The file is JSON in the Trace Event Format, which can be opened
+        in Chrome's ``about:tracing`` or in Perfetto
+        (https://ui.perfetto.dev).  The execution as a whole is drawn on
+        its own track, and each program on one of a set of slot tracks,
+        so that programs which overlapped in time (because they were run
+        with ``nonblocking``) are on different slots.  The number of
+        slots is the largest number of programs that ran at once.
+        Programs with no recorded start and end times (restored from a
+        checkpoint, or written by an older bein) are left out.
+        """
+        ex = self.fetch_execution(exid)
+        def us(t):
+            return int(round(t*1000000))
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': exid, 'tid': 0,
+                   'args': {'name': 'execution %d %s' % (exid, ex['description'])}},
+                  {'name': 'thread_name', 'ph': 'M', 'pid': exid, 'tid': 0,
+                   'args': {'name': 'execution'}}]
+        if ex['finished_at'] != None:
+            events.append({'name': 'execution %d' % exid, 'cat': 'execution',
+                           'ph': 'X', 'pid': exid, 'tid': 0,
+                           'ts': us(ex['started_at']),
+                           'dur': us(ex['finished_at'] - ex['started_at']),
+                           'args': {'exception': ex['exception_string']}})
+        timed = [(p['started_at'], i, p) for (i,p) in enumerate(ex['programs'])
+                 if p['started_at'] != None and p['finished_at'] != None]
+        slot_ends = []
+        for (started_at, i, p) in sorted(timed):
+            free = [k for (k,end) in enumerate(slot_ends) if end <= started_at]
+            if free == []:
+                slot = len(slot_ends)
+                slot_ends.append(p['finished_at'])
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': exid,
+                               'tid': slot+1, 'args': {'name': 'slot %d' % slot}})
+            else:
+                slot = free[0]
+                slot_ends[slot] = p['finished_at']
+            args = dict([(k, p[k]) for k in _accounting_fields])
+            args['program'] = i
+            args['arguments'] = " ".join(p['arguments'])
+            args['return_code'] = p['return_code']
+            events.append({'name': p['arguments'] != [] and os.path.basename(p['arguments'][0]) or str(i),
+                           'cat': p['via'] or 'program', 'ph': 'X',
+                           'pid': exid, 'tid': slot+1,
+                           'ts': us(p['started_at']), 'dur': us(p['wall_time']),
+                           'args': args})
+        with open(dst, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def verify_file(self, file_or_alias, full=False):
+        """Check that a file in the repository still has the contents it was stored with.
+
+        Returns ``True`` if the file matches the digest recorded when it
+        entered the repository, ``False`` if it does not (or is
+        missing), and ``None`` if no digest was recorded (files stored
+        by older versions of bein).  Unless *full* is ``True``, a file
+        whose size and modification time are those recorded is assumed
+        unchanged without reading it.
+        """
+        fileid = self.resolve_alias(file_or_alias)
+        (repository_name, digest, size, mtime, compression) = \
+            self.db.execute("""select repository_name,digest,size,mtime,compression
+                               from file where id=?""", (fileid,)).fetchone()
+        status = _check_blob(os.path.join(self.file_path, repository_name),
+                             digest, size, mtime, full, compression)[0]
+        if status == 'unverified':
+            return None
+        else:
+            return status in ('ok', 'changed')
+
+    def fsck(self, repair=False, full=False, workers=4, batch_size=1000,
+             progress=None, state_file=None, min_age=3600):
+        """Check the consistency of the repository and its database.
+
+        Every file in the database is checked: its blob must exist in
+        the repository and match the digest recorded when it was stored
+        (see ``verify_file``; with *full* every blob is hashed, not just
+        those whose size or modification time changed).  Then every
+        blob in the repository directory which no file refers to is an
+        orphan, unless it was modified less than *min_age* seconds ago:
+        as in ``gc``, it may belong to a file being imported or written
+        at this moment.  Blobs staged by running executions are not
+        orphans either.
+
+        Files are read from the database in batches of *batch_size*,
+        and the blobs of each batch are checked by *workers* threads.
+        If *progress* is given, it is called after each batch with the
+        number of files checked so far and the total.  If *state_file*
+        is given, the results so far are saved to it after each batch,
+        and an interrupted ``fsck`` given the same *state_file* resumes
+        where it stopped.  The state file is removed when the check
+        completes.
+
+        With *repair*, orphans are moved to a quarantine directory next
+        to the repository (the database path with ``.quarantine``
+        appended), and files whose content matches their digest but
+        whose size or modification time changed (for instance after
+        being restored from a backup) have their recorded size and
+        time updated.  Missing and corrupted files cannot be repaired
+        and are only reported.
+
+        Returns a dictionary with the number of files *checked*, lists
+        of the ids of *missing*, *corrupted*, *unverified* (no digest
+        recorded) and *refreshed* files, and lists of the *orphans*
+        and of those which were *quarantined*.
+        """
+        report = {'last_id': 0, 'checked': 0, 'missing': [], 'corrupted': [],
+                  'unverified': [], 'refreshed': []}
+        if state_file != None and os.path.exists(state_file):
+            with open(state_file) as f:
+                report = json.load(f)
+        total = self.db.execute("select count(*) from file").fetchone()[0]
+        def check(row):
+            (fileid, name, digest, size, mtime, compression) = row
+            return _check_blob(os.path.join(self.file_path, name),
+                               digest, size, mtime, full, compression)
+        pool = ThreadPool(workers)
+        try:
+            while True:
+                # One query per batch rather than one cursor for the
+                # whole table: committing repairs would reset it.
+                rows = self.db.execute("""select id,repository_name,digest,size,mtime,
+                                                 compression
+                                          from file where id > ? order by id limit ?""",
+                                       (report['last_id'], batch_size)).fetchall()
+                if rows == []:
+                    break
+                statuses = pool.map(check, rows, chunksize=1)
+                changed = []
+                for ((fileid,_,_,_,_,_), (status, st)) in zip(rows, statuses):
+                    if status == 'changed':
+                        changed.append((st.st_size, st.st_mtime, fileid))
+                    elif status != 'ok':
+                        report[status].append(fileid)
+                if repair and changed != []:
+                    # Only the repairs hold the lock, not the whole check.
+                    with self._lock:
+                        self.db.executemany("update file set size=?, mtime=? where id=?",
+                                            changed)
+                        self.db.commit()
+                    report['refreshed'].extend([fileid for (_,_,fileid) in changed])
+                report['checked'] += len(rows)
+                report['last_id'] = rows[-1][0]
+                if state_file != None:
+                    with open(state_file, 'w') as f:
+                        json.dump(report, f)
+                if progress != None:
+                    progress(report['checked'], total)
+        finally:
+            pool.close()
+
+        known = set([name for (name,) in self.db.execute("select repository_name from file")])
+        known.update(self._leased_blobs())
+        report['orphans'] = sorted([os.path.basename(f) for f in
+                                    _stale_blobs(self.file_path, known, min_age)])
+        report['quarantined'] = []
+        if repair and report['orphans'] != []:
+            quarantine = os.path.abspath(self.db_path + '.quarantine')
+            if not(os.path.exists(quarantine)):
+                os.mkdir(quarantine)
+            for f in report['orphans']:
+                shutil.move(os.path.join(self.file_path, f), os.path.join(quarantine, f))
+                report['quarantined'].append(f)
+        if state_file != None and os.path.exists(state_file):
+            os.remove(state_file)
+        del report['last_id']
+        return report
+
+    @_serialized
+    def gc(self, vacuum=True, analyze=True, min_age=3600):
+        """Remove what deleted files and executions left behind, and shrink the database.
+
+        Deleting files and executions can leave rows referring to them
+        in other tables (aliases, associations, uses, programs,
+        arguments, checkpoints), blobs in the repository directory which
+        no file refers to, and decompressed copies of deleted files in
+        the cache.  Executions which crashed can leave files in the
+        staging area.  ``gc`` deletes all the dangling rows in one
+        transaction, then removes the orphaned blobs.  Blobs younger
+        than *min_age* seconds are left alone, since they may belong to
+        a file being imported at this moment, and so are those staged
+        by executions still running, however old.
+
+        With *vacuum*, the free pages of the database are returned to
+        the filesystem.  Databases created by older versions of bein
+        are converted to incremental vacuuming the first time, which
+        rewrites the whole database once; afterwards it is cheap.  With
+        *analyze*, SQLite's statistics are refreshed so its query
+        planner keeps choosing good plans as the repository grows.
+
+        Returns a dictionary with the number of rows deleted from each
+        table, the list of *orphans* removed, and the bytes reclaimed
+        from the repository (*blob_bytes*), the database
+        (*database_bytes*), and in total (*reclaimed_bytes*).
+        """
+        def database_size():
+            (pages,) = self.db.execute("pragma page_count").fetchone()
+            (size,) = self.db.execute("pragma page_size").fetchone()
+            return pages*size
+        before = database_size()
+        statements = [('file_alias', """delete from file_alias
+                                        where file not in (select id from file)"""),
+                      ('file_association', """delete from file_association
+                                              where fileid not in (select id from file)
+                                              or associated_to not in (select id from file)"""),
+                      ('execution_use', """delete from execution_use
+                                           where execution not in (select id from execution)
+                                           or file not in (select id from file)"""),
+                      ('argument', """delete from argument
+                                      where execution not in (select id from execution)"""),
+                      ('program', """delete from program
+                                     where execution not in (select id from execution)"""),
+                      ('checkpoint', """delete from checkpoint
+                                        where execution not in (select id from execution)"""),
+                      ('checkpoint_file', """delete from checkpoint_file
+                                             where execution not in (select id from execution)"""),
+                      ('resumed_from', """update execution set resumed_from = null
+                                          where resumed_from not in (select id from execution)""")]
+        report = {}
+        try:
+            for (table, sql) in statements:
+                report[table] = self.db.execute(sql).rowcount
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+
+        # Blobs go only once the rows are gone, so a failure above
+        # never leaves rows without their blobs.
+        files = set([x for (x,) in self.db.execute("select repository_name from file")])
+        checkpoints = set([x for (x,) in self.db.execute("select repository_name from checkpoint_file")])
+        staged = self._leased_blobs(min_age)
+        orphans = _stale_blobs(self.file_path, files | staged, min_age)
+        leftovers = _stale_blobs(os.path.join(self.file_path, '.cache'), files, min_age) + \
+            _stale_blobs(self.checkpoint_path, checkpoints, min_age) + \
+            _stale_blobs(self.staging_path, staged, min_age)
+        report['orphans'] = sorted([os.path.basename(f) for f in orphans])
+        report['blob_bytes'] = 0
+        for path in orphans + leftovers:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                report['blob_bytes'] += size
+            except OSError:
+                pass
+
+        if vacuum:
+            (mode,) = self.db.execute("pragma auto_vacuum").fetchone()
+            if mode != 2:
+                self.db.execute("pragma auto_vacuum = incremental")
+                self.db.execute("vacuum")
+            else:
+                self.db.execute("pragma incremental_vacuum").fetchall()
+        if analyze:
+            self.db.execute("analyze")
+        self.db.commit()
+        report['database_bytes'] = max(0, before - database_size())
+        report['reclaimed_bytes'] = report['blob_bytes'] + report['database_bytes']
+        return report
+
+    @_serialized
+    def copy_file(self, file_or_alias, share=True):
         """Copy the given file in the MiniLIMS repository.
 
         A copy of the file corresponding to the given fileid is made
         in the MiniLIMS repository, and the file id of the copy is
         returned.  This is most useful to create a mutable copy of an
         immutable file.
+
+        The copy shares its contents with the original in the
+        repository, so copying is cheap whatever the size of the file.
+        The shared blob is made read-only, and ``path_to_file`` with
+        ``writable=True`` gives a file contents of its own before it is
+        written to.  With *share* ``False``, the copy gets contents of
+        its own right away, cloned rather than copied on filesystems
+        which support it (such as Btrfs and XFS).
         """
         fileid = self.resolve_alias(file_or_alias)
-        try:
-            sql = """select external_name,repository_name,description
-                     from file where id = ?"""
-            [(external_name,
-              repository_name,
-              description)] = [x for x in self.db.execute(sql, (fileid, ))]
-            new_repository_name = unique_filename_in(self.file_path)
-            sql = """insert into file(external_name,repository_name,
-                                      origin,origin_value) values (?,?,?,?)"""
-            [x for x in self.db.execute(sql, (external_name,
-                                              new_repository_name,
-                                              'copy', fileid))]
-            [new_id] = [x for (x,) in
-                        self.db.execute("select last_insert_rowid()")]
-            shutil.copyfile(os.path.join(self.file_path, repository_name),
-                            os.path.join(self.file_path, new_repository_name))
-            self.db.commit()
-            return new_id
-        except ValueError, v:
+        (filename, compression) = self._blob_of(fileid)
+        if share:
+            path = os.path.join(self.file_path, filename)
+            os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~0222)
+            (size, mtime) = (None, None)
+        else:
+            private = self._reserve_blob_name()
+            try:
+                _clone_blob(os.path.join(self.file_path, filename),
+                            os.path.join(self.file_path, private))
+                st = os.stat(os.path.join(self.file_path, private))
+            except:
+                os.remove(os.path.join(self.file_path, private))
+                raise
+            (filename, size, mtime) = (private, st.st_size, st.st_mtime)
+        sql = """insert into file(external_name,repository_name,
+                                  origin,origin_value,digest,size,mtime,
+                                  compression)
+                 select external_name,?,'copy',id,
+                        digest,coalesce(?,size),coalesce(?,mtime),compression
+                 from file where id = ?"""
+        if self.db.execute(sql, (filename, size, mtime, fileid)).rowcount != 1:
+            if not(share):
+                os.remove(os.path.join(self.file_path, filename))
             raise ValueError("No such file id " + str(fileid))
+        [new_id] = [x for (x,) in
+                    self.db.execute("select last_insert_rowid()")]
+        self.db.commit()
+        return new_id
 
     def delete_file(self, file_or_alias):
-        """Delete a file from the repository."""
-        fileid = self.resolve_alias(file_or_alias)
-        try:
-            try:
-                for (f,t) in self.associated_files_of(fileid):
-                    self.delete_file(f)
-            except ValueError, v:
-                pass
-            sql = "select repository_name from file where id = ?"
-            [repository_name] = [x for (x,) in self.db.execute(sql, (fileid,))]
-            sql = "delete from file where id = ?"
-            [x for (x,) in self.db.execute(sql, (fileid, ))]
-            os.remove(os.path.join(self.file_path, repository_name))
-            sql = "delete from file_alias where file=?"
-            self.db.execute(sql, (fileid,)).fetchone()
-            self.db.commit()
-        except ValueError:
-            raise ValueError("No such file id " + str(fileid))
+        """Delete a file from the repository.
+
+        The files associated to it are deleted as well.
+        """
+        self.delete_files([file_or_alias])
 
     def delete_execution(self, execution_id):
-        """Delete an execution from the MiniLIMS repository."""
+        """Delete an execution from the MiniLIMS repository.
+
+        The files it created are deleted as well.
+        """
+        self.delete_executions([execution_id])
+
+    def delete_files(self, files_or_aliases, workers=4):
+        """Delete many files from the repository at once.
+
+        Every file associated to one of *files_or_aliases* (and to
+        those, and so on) is deleted as well.  The files are checked
+        and removed from the database in a single transaction, so
+        either all of them are deleted or, if any is immutable, none
+        are and ``sqlite3.IntegrityError`` is raised.  Their blobs are
+        then removed from the repository by *workers* threads.
+        """
+        fileids = [self.resolve_alias(f) for f in files_or_aliases]
+        self._delete([], fileids, workers)
+
+    def delete_executions(self, execution_ids, workers=4):
+        """Delete many executions from the repository at once.
+
+        The files they created are deleted with them, as in
+        ``delete_files``.  Either all the executions are deleted or, if
+        any is immutable, none are and ``sqlite3.IntegrityError`` is
+        raised.  Executions which do not exist are ignored.
+        """
+        self._delete(list(execution_ids), [], workers)
+
+    @contextmanager
+    def _transaction(self):
+        """Run the body of a ``with`` statement in one explicit transaction.
+
+        Unlike the transactions the sqlite3 module opens on its own,
+        this one also covers creating and dropping triggers and tables.
+        It is committed if the body finishes, and rolled back if it
+        raises.
+        """
+        self.db.commit()
+        isolation_level = self.db.isolation_level
+        self.db.isolation_level = None
         try:
-            files = self.search_files(source=('execution',execution_id))
-            for i in files:
-                try:
-                    self.delete_file(i)
-                except ValueError, v:
-                    pass
-            self.db.execute("delete from argument where execution = ?",
-                            (execution_id,))
-            self.db.execute("delete from program where execution = ?",
-                            (execution_id,))
-            self.db.execute("delete from execution where id = ?",
-                            (execution_id,))
-            self.db.execute("delete from execution_use where execution=?",
-                            (execution_id,))
-            self.db.commit()
-        except ValueError, v:
-            raise ValueError("No such execution id " + str(execution_id) + ": " + v.message)
+            self.db.execute("begin immediate")
+            try:
+                yield
+                self.db.execute("commit")
+            except:
+                self.db.execute("rollback")
+                raise
+        finally:
+            self.db.isolation_level = isolation_level
+
+    @_serialized
+    def _delete(self, exids, fileids, workers):
+        """Delete the executions *exids*, the files *fileids*, and everything depending on them.
 
-    def import_file(self, src, description=""):
+        Returns the IDs of all the files deleted.
+        """
+        # The triggers guarding against deleting immutable rows
+        # recompute immutability for every row deleted, which is
+        # prohibitive for large deletions.  The check is done once for
+        # the whole set instead, and the triggers are suspended.
+        triggers = ['prevent_file_delete', 'prevent_argument_delete',
+                    'prevent_command_delete', 'prevent_execution_delete']
+        with self._transaction():
+            db = self.db
+            db.execute("create temp table if not exists doomed_execution(id integer primary key)")
+            db.execute("create temp table if not exists doomed_file(id integer primary key)")
+            db.execute("delete from doomed_execution")
+            db.execute("delete from doomed_file")
+            db.executemany("insert or ignore into doomed_execution(id) values (?)",
+                           [(i,) for i in exids])
+            db.executemany("insert or ignore into doomed_file(id) values (?)",
+                           [(i,) for i in fileids])
+            db.execute("""insert or ignore into doomed_file(id)
+                          select file.id from file, doomed_execution
+                          where file.origin_value = doomed_execution.id
+                          and file.origin = 'execution'""")
+            db.execute("""with recursive closure(id) as (
+                              select id from doomed_file
+                              union
+                              select fa.fileid from file_association as fa, closure
+                              where fa.associated_to = closure.id)
+                          insert or ignore into doomed_file(id) select id from closure""")
+
+            # A file is immutable if it, or a file it is associated
+            # to, is used by an execution which is not being deleted.
+            # An execution is immutable if any of its outputs is.
+            immutable = db.execute("""select f.origin, f.origin_value in
+                                          (select id from doomed_execution)
+                                      from doomed_file as d, file as f
+                                      where f.id = d.id and exists
+                                          (select 1 from execution_use as eu
+                                           where (eu.file = d.id or eu.file in
+                                                  (select associated_to from file_association
+                                                   where fileid = d.id))
+                                           and eu.execution not in
+                                               (select id from doomed_execution))
+                                      limit 1""").fetchone()
+            if immutable != None:
+                if immutable[0] == 'execution' and immutable[1]:
+                    raise sqlite3.IntegrityError('Execution is immutable; cannot delete.')
+                else:
+                    raise sqlite3.IntegrityError('File is immutable; cannot delete it.')
+
+            files = [x for (x,) in db.execute("select id from doomed_file")]
+
+            # Copies share their blob, which goes only with the last
+            # file referring to it.
+            db.execute("create temp table if not exists doomed_blob(name text primary key)")
+            db.execute("delete from doomed_blob")
+            db.execute("""insert or ignore into doomed_blob(name)
+                          select repository_name from file
+                          where id in (select id from doomed_file)""")
+            checkpoints = [x for (x,) in db.execute("""select repository_name from checkpoint_file
+                                                       where execution in
+                                                           (select id from doomed_execution)""")]
+            definitions = db.execute("""select sql from sqlite_master where type = 'trigger'
+                                        and name in (%s)""" % ",".join(["?"]*len(triggers)),
+                                     triggers).fetchall()
+            for t in triggers:
+                db.execute("drop trigger if exists %s" % t)
+            for (table, column, doomed) in [('file_alias', 'file', 'doomed_file'),
+                                            ('file_association', 'fileid', 'doomed_file'),
+                                            ('file_association', 'associated_to', 'doomed_file'),
+                                            ('execution_use', 'file', 'doomed_file'),
+                                            ('execution_use', 'execution', 'doomed_execution'),
+                                            ('file', 'id', 'doomed_file'),
+                                            ('argument', 'execution', 'doomed_execution'),
+                                            ('program', 'execution', 'doomed_execution'),
+                                            ('checkpoint_file', 'execution', 'doomed_execution'),
+                                            ('checkpoint', 'execution', 'doomed_execution'),
+                                            ('execution', 'id', 'doomed_execution')]:
+                db.execute("delete from %s where %s in (select id from %s)" % \
+                               (table, column, doomed))
+            db.execute("""update execution set resumed_from = null
+                          where resumed_from in (select id from doomed_execution)""")
+            db.execute("""delete from doomed_blob
+                          where name in (select repository_name from file)""")
+            blobs = [x for (x,) in db.execute("select name from doomed_blob")]
+            for (sql,) in definitions:
+                db.execute(sql)
+
+        paths = [os.path.join(self.file_path, b) for b in blobs] + \
+            [os.path.join(self.file_path, '.cache', b) for b in blobs] + \
+            [os.path.join(self.checkpoint_path, c) for c in checkpoints]
+        self._unlink(paths, workers)
+        for listener in list(_deletion_listeners):
+            listener(self, files)
+        return files
+
+    def _unlink(self, paths, workers=4):
+        """Remove the files *paths*, ignoring those which do not exist."""
+        def unlink(path):
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if workers > 1 and len(paths) > 1:
+            pool = ThreadPool(min(workers, len(paths)))
+            try:
+                pool.map(unlink, paths, chunksize=64)
+            finally:
+                pool.close()
+        else:
+            for p in paths:
+                unlink(p)
+
+    def import_file(self, src, description="", compress=None):
         """Add an external file *src* to the MiniLIMS repository.
 
         *src* should be the path to the file to be added.
         *description* is an optional string or dictionary that will be attached to
         the file in the repository.  ``import_file`` returns the file id
         in the repository of the newly imported file.
+
+        *compress* can be ``'gzip'`` or ``'zstd'`` to store the file
+        compressed, or ``False`` to store it as is.  If it is ``None``,
+        the MiniLIMS's *compression_policy* decides.  Compression is
+        invisible to users of the file: ``Execution.use``,
+        ``export_file`` and ``path_to_file`` all give the original
+        contents, and ``open_file`` streams them.
         """
-        if isinstance(description,dict):
-            description = str(description)
-        self.db.execute("""insert into file(external_name,repository_name,
-                                            description,origin,origin_value)
-                           values (?,importfile(?),?,?,?)""",
-                        (os.path.basename(src),os.path.abspath(src),
-                         description,'import',None))
-        self.db.commit()
-        return [x for (x,) in
-                self.db.execute("""select last_insert_rowid()""")][0]
+        return self.import_files([src], [description], compress=compress, workers=1)[0]
+
+    def import_files(self, paths, descriptions=None, aliases=None, workers=4,
+                     compress=None):
+        """Add many external files to the MiniLIMS repository at once.
+
+        *paths* is a list (or any iterable) of paths to files.
+        *descriptions* and *aliases*, if given, are lists of the same
+        length giving each file's description and alias (``None`` for
+        no alias), or dictionaries mapping some of the paths to them.
+        *compress* is as for ``import_file``.
+
+        The files are copied into the repository by *workers* threads,
+        and then all of them are recorded in a single transaction,
+        which is much faster than calling ``import_file`` for each.
+        Either all the files are imported or, if any copy or the
+        transaction fails, none are, and the copies already made are
+        removed.  Returns the list of the new file ids, in the order of
+        *paths*.
+        """
+        paths = list(paths)
+        def lookup(values, i, path):
+            if values == None:
+                return None
+            elif isinstance(values, dict):
+                return values.get(path)
+            else:
+                return values[i]
+        rows = []
+        for (i,path) in enumerate(paths):
+            description = lookup(descriptions, i, path) or ""
+            if isinstance(description,dict):
+                description = str(description)
+            rows.append((path, description, lookup(aliases, i, path),
+                         self._compression_for(path, compress)))
+
+        def copy((path, description, alias, compression)):
+            try:
+                return (True, self._import_blob(os.path.abspath(path), compression))
+            except Exception, e:
+                return (False, e)
+        if workers > 1 and len(rows) > 1:
+            pool = ThreadPool(min(workers, len(rows)))
+            try:
+                copies = pool.map(copy, rows, chunksize=1)
+            finally:
+                pool.close()
+        else:
+            copies = []
+            for r in rows:
+                copies.append(copy(r))
+                if not(copies[-1][0]):
+                    break
+        blobs = [b for (ok,b) in copies if ok]
+        def discard():
+            for b in blobs:
+                try:
+                    os.remove(os.path.join(self.file_path, b[0]))
+                except OSError:
+                    pass
+        failures = [e for (ok,e) in copies if not(ok)]
+        if failures != []:
+            discard()
+            raise failures[0]
+
+        try:
+            return self._record_imports([(os.path.basename(path), description, alias, b)
+                                         for ((path, description, alias, _), b)
+                                         in zip(rows, blobs)])
+        except:
+            discard()
+            raise
+
+    @_serialized
+    def _record_imports(self, imports):
+        """Enter imported files in the database in one transaction.
+
+        *imports* is a list of ``(external_name, description, alias,
+        blob)``, where *blob* is what ``_import_blob`` returned.
+        Returns the new file IDs, in order.
+        """
+        try:
+            self.db.executemany("""insert into file(external_name,repository_name,
+                                                    description,origin,origin_value,
+                                                    digest,size,mtime,compression)
+                                   values (?,?,?,?,?,?,?,?,?)""",
+                                [(name, b[0], description, 'import', None) + tuple(b[1:])
+                                 for (name, description, alias, b) in imports])
+            ids = {}
+            names = [b[0] for (_, _, _, b) in imports]
+            # SQLite limits the number of parameters in a statement.
+            for i in range(0, len(names), 500):
+                chunk = names[i:i+500]
+                ids.update(self.db.execute("""select repository_name,id from file
+                                              where repository_name in (%s)""" % \
+                                               ",".join(["?"]*len(chunk)), chunk).fetchall())
+            fileids = [ids[n] for n in names]
+            self.db.executemany("insert into file_alias(alias,file) values (?,?)",
+                                [(alias, fileid) for ((_, _, alias, _), fileid)
+                                 in zip(imports, fileids) if alias != None])
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        return fileids
 
     def export_file(self, file_or_alias, dst, with_associated=False):
         """Write *file_or_alias* from the MiniLIMS repository to *dst*.
@@ -1454,31 +3386,101 @@ class MiniLIMS(object):
         a filename, in which case the file will be copied to that
         filename.
         Associated files will also be copied if *with_associated=True*.
+        Raises ``ValueError`` if the file, or one of its associated
+        files, is deleted meanwhile.
         """
-        src = self.path_to_file(file_or_alias)
-        shutil.copy(src, dst)
+        fileid = self.resolve_alias(file_or_alias)
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, self.fetch_file(fileid)['repository_name'])
+        if self._export_file_from_repository(fileid, dst) == None:
+            raise ValueError("No such file " + str(fileid) + " in MiniLIMS.")
         if with_associated:
-            if os.path.isdir(dst):
-                dst = os.path.join(dst, self.fetch_file(file_or_alias)['repository_name'])
-            for association in self.fetch_file(file_or_alias)['associations']:  #association = (id,template)
-                fileid = association[0]
-                template = association[1][2:] #removes %s
-                dst = dst + template
-                shutil.copy(src,dst)
-
-    def path_to_file(self, file_or_alias):
+            for (associated_id, template) in self.associated_files_of(fileid):
+                if self._export_file_from_repository(associated_id, template % dst) == None:
+                    raise ValueError("No such file " + str(associated_id) + " in MiniLIMS.")
+
+    def path_to_file(self, file_or_alias, writable=False):
         """Return the full path to a file in the repository.
 
         It is often useful to be able to read a file in the repository
-        without actually copying it.  If you are not planning to write
-        to it, this presents no problem.
+        without actually copying it.  Files in the repository must not
+        be written to through this path unless *writable* is ``True``:
+        copies made by ``copy_file`` share their contents (and their
+        blobs are read-only), and compressed files are read from a
+        cache.
+
+        If the file is stored compressed, it is decompressed once into
+        a cache in the repository (the ``.cache`` directory), and the
+        path to the decompressed copy is returned.  Use ``open_file``
+        to read it without decompressing it all.
+
+        With *writable*, the file is first given contents of its own,
+        stored uncompressed, and the path returned can be modified in
+        place.  Its recorded digest is cleared, since it is about to
+        change.  Immutable files cannot be written to.
         """
         fileid = self.resolve_alias(file_or_alias)
-        filename = [x for (x,) in
-                    self.db.execute("""select repository_name
-                                       from file where id = ?""",
-                                    (fileid, ))][0]
-        return(os.path.join(self.file_path,filename))
+        if writable:
+            return self._make_writable(fileid)
+        (filename, compression) = self._blob_of(fileid)
+        if compression == None:
+            return(os.path.join(self.file_path,filename))
+        cache_path = os.path.join(self.file_path, '.cache')
+        cached = os.path.join(cache_path, filename)
+        if not(os.path.exists(cached)):
+            if not(os.path.exists(cache_path)):
+                try:
+                    os.mkdir(cache_path)
+                except OSError:
+                    pass # Another process made it first.
+            # Decompress under a temporary name so no reader ever
+            # sees a partial file.
+            partial = os.path.join(cache_path, '.' + unique_filename_in(cache_path))
+            _export_blob(os.path.join(self.file_path, filename), compression, partial)
+            os.rename(partial, cached)
+        return cached
+
+    @_serialized
+    def _make_writable(self, fileid):
+        """Give *fileid* an uncompressed, writable blob of its own and return its path."""
+        if self.db.execute("select immutable from file_immutability where id=?",
+                           (fileid,)).fetchone()[0] == 1:
+            raise ValueError("File %d is immutable; it cannot be written to." % fileid)
+        (filename, compression) = \
+            self.db.execute("""select repository_name,compression
+                               from file where id = ?""", (fileid,)).fetchone()
+        references = self._references_to(filename)
+        if compression != None or references > 1:
+            private = self._reserve_blob_name()
+            _export_blob(os.path.join(self.file_path, filename), compression,
+                         os.path.join(self.file_path, private))
+            self._set_repository_name(fileid, private)
+            if references == 1:
+                # Nothing else needs the compressed blob, nor its
+                # decompressed copy.
+                self._unlink([os.path.join(self.file_path, filename),
+                              os.path.join(self.file_path, '.cache', filename)],
+                             workers=1)
+            filename = private
+        else:
+            # A blob once shared by copies is left read-only.
+            path = os.path.join(self.file_path, filename)
+            os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) | stat.S_IWUSR)
+        self.db.execute("""update file set digest=null, size=null, mtime=null,
+                           compression=null where id=?""", (fileid,))
+        self.db.commit()
+        return os.path.join(self.file_path, filename)
+
+    def open_file(self, file_or_alias):
+        """Open a file in the repository for reading.
+
+        Returns a read-only, binary file-like object giving the file's
+        original contents.  Files stored compressed are decompressed as
+        they are read, so even very large files are never held in
+        memory or on disk whole.  Close it when you are done.
+        """
+        (filename, compression) = self._blob_of(self.resolve_alias(file_or_alias))
+        return _open_blob(os.path.join(self.file_path, filename), compression)
 
     def resolve_alias(self, alias):
         """Resolve an alias to an integer file id.
@@ -1500,6 +3502,7 @@ class MiniLIMS(object):
             else:
                 return x[0]
 
+    @_serialized
     def add_alias(self, fileid, alias):
         """Make the string *alias* an alias for *fileid* in the repository.
 
@@ -1510,6 +3513,7 @@ class MiniLIMS(object):
                         (alias, self.resolve_alias(fileid)))
         self.db.commit()
 
+    @_serialized
     def delete_alias(self, alias):
         """Delete the alias *alias* from the repository.
 
@@ -1527,6 +3531,7 @@ class MiniLIMS(object):
         f = self.resolve_alias(file_or_alias)
         return self.db.execute("""select fileid,template from file_association where associated_to = ?""", (f,)).fetchall()
 
+    @_serialized
     def associate_file(self, file_or_alias, associate_to, template):
         """Add a file association from *file_or_alias* to *associate_to*.
 
@@ -1546,6 +3551,7 @@ class MiniLIMS(object):
             self.db.execute("""insert into file_association(fileid,associated_to,template) values (?,?,?)""", (src, dst, template))
             self.db.commit()
 
+    @_serialized
     def delete_file_association(self, file_or_alias, associated_to):
         """Remove the file association from *file_or_alias* to *associated_to*.
 
@@ -1565,7 +3571,8 @@ def task(f):
     first argument to be an execution.  The function produced by @task
     instead expects a MiniLIMS (or ``None``) in its place.
     You can also pass a ``description`` keyword argument, which will
-    be used to set the description of the execution.  For example,::
+    be used to set the description of the execution, and a ``chdir``
+    keyword argument, passed on to ``execution``.  For example,::
 
         @task
         def f(ex, filename):
@@ -1611,9 +3618,10 @@ def task(f):
             description = kwargs.pop('description')
         except KeyError, k:
             description = ""
+        chdir = kwargs.pop('chdir', True)
 
         # Wrap the function to run in an execution.
-        with execution(lims, description=description) as ex:
+        with execution(lims, description=description, chdir=chdir) as ex:
             v = f(ex, *args, **kwargs)
 
         # Pull together the return value.
@@ -1628,3 +3636,263 @@ def task(f):
     wrapper.__doc__ = f.__doc__
     wrapper.__name__ = f.__name__
     return wrapper
+
+################################################################################
+class WorkflowFailed(Exception):
+    """Thrown by ``Workflow.run`` when one or more tasks failed.
+
+    *results* holds the return values of the tasks that succeeded,
+    keyed by their ``TaskNode``, *failed* maps each failed node to the
+    traceback it raised, and *skipped* lists the nodes which were never
+    run because something they depended on failed.
+    """
+    def __init__(self, results, failed, skipped):
+        self.results = results
+        self.failed = failed
+        self.skipped = skipped
+    def __str__(self):
+        message = "%d task(s) failed, %d skipped:\n" % (len(self.failed),
+                                                        len(self.skipped))
+        for node, tb in self.failed.iteritems():
+            message += "%s failed with:\n%s" % (node.name, tb)
+        return message
+
+class TaskOutput(object):
+    """Placeholder for a file produced by another task in a ``Workflow``.
+
+    Created by ``TaskNode.output``.  When the task it depends on has
+    finished, the placeholder is replaced by the integer file id of the
+    file in the MiniLIMS.
+    """
+    def __init__(self, node, key=None):
+        self.node = node
+        self.key = key
+
+    def resolve(self, lims, result):
+        """Return the file id this placeholder refers to in *result*.
+
+        *key* is looked up first among the descriptions of the files
+        the task added, then as an alias in *lims*.  An alias only
+        matches if the file was created by the task's own execution.
+        """
+        files = result['files']
+        if self.key == None:
+            if len(files) != 1:
+                raise ValueError("Task %s added %d files; give output() a description or alias." % \
+                                     (self.node.name, len(files)))
+            return files.values()[0]
+        elif files.has_key(self.key):
+            return files[self.key]
+        elif lims != None:
+            fileid = lims.resolve_alias(self.key)
+            if lims.fetch_file(fileid)['origin'] == ('execution', result['execution']):
+                return fileid
+        raise ValueError("Task %s produced no file with description or alias %s." % \
+                             (self.node.name, self.key))
+
+class TaskNode(object):
+    """A call to a ``@task`` function scheduled in a ``Workflow``.
+
+    Returned by ``Workflow.add``.  Pass ``node.output(...)`` as an
+    argument to another task to make it depend on this one.
+    """
+    def __init__(self, f, args, kwargs, after, name):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.after = after
+        self.name = name
+
+    def output(self, key=None):
+        """Refer to a file added by this task.
+
+        *key* is the description or alias the file was added with.
+        It can be omitted if the task adds exactly one file.
+        """
+        return TaskOutput(self, key)
+
+    def dependencies(self):
+        """Return the set of nodes this node must wait for."""
+        deps = set(self.after)
+        def collect(st):
+            if isinstance(st, TaskOutput):
+                deps.add(st.node)
+            elif isinstance(st, (list, tuple)):
+                [collect(q) for q in st]
+            elif isinstance(st, dict):
+                [collect(q) for q in st.itervalues()]
+        collect(self.args)
+        collect(self.kwargs)
+        return deps
+
+    def __repr__(self):
+        return '<TaskNode %s>' % self.name
+
+def _resolve_task_outputs(st, lims, results):
+    if isinstance(st, TaskOutput):
+        return st.resolve(lims, results[st.node])
+    elif isinstance(st, list):
+        return [_resolve_task_outputs(q, lims, results) for q in st]
+    elif isinstance(st, tuple):
+        return tuple([_resolve_task_outputs(q, lims, results) for q in st])
+    elif isinstance(st, dict):
+        return dict([(k, _resolve_task_outputs(v, lims, results))
+                     for k,v in st.iteritems()])
+    else:
+        return st
+
+def _run_task_in_child(index, f, lims_path, args, kwargs, queue, chdir=True):
+    """Body of the worker process (or thread) which runs one task of a ``Workflow``."""
+    try:
+        if lims_path == None:
+            lims = None
+        else:
+            lims = MiniLIMS(lims_path)
+        kwargs = dict(kwargs, chdir=chdir)
+        result = f(lims, *args, **kwargs)
+        message = (index, True, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    except:
+        message = (index, False, traceback.format_exc())
+    if chdir:
+        # Worker processes exit without running atexit handlers.
+        wait_for_cleanup()
+    queue.put(message)
+
+class Workflow(object):
+    """Run ``@task`` functions as a graph of dependent executions.
+
+    Tasks are added with ``add``, which returns a ``TaskNode``.  A
+    task's inputs can be the outputs of other tasks, referred to with
+    ``node.output(description_or_alias)``; the placeholder is replaced
+    by the file id once the task producing it has finished.  For
+    instance::
+
+        w = Workflow(M, max_concurrent=4)
+        qcs = [w.add(quality_control, f) for f in fastqs]
+        report = w.add(summarize, [q.output('report') for q in qcs])
+        results = w.run()
+        print results[report]['value']
+
+    ``run`` starts every task whose dependencies have finished, each in
+    its own execution and its own worker process, never more than
+    *max_concurrent* at once.  The quality control tasks above run in
+    parallel, and ``summarize`` starts when all of them are done.
+
+    If a task fails, everything which depends on it, directly or
+    indirectly, is skipped, while independent branches run to the end.
+    ``run`` then raises ``WorkflowFailed``.  Otherwise it returns a
+    dictionary mapping each ``TaskNode`` to the value its task
+    returned (see ``task``).  Those values travel back from the worker
+    processes, so the functions wrapped by ``@task`` must return
+    picklable values.
+
+    With *kind* set to ``'thread'``, tasks run in threads of this
+    process instead, in executions which do not change the current
+    directory (see ``execution``).  This avoids starting a process per
+    task, but tasks must then open their files relative to
+    ``ex.working_directory``, and Python code in them does not run in
+    parallel.
+    """
+    def __init__(self, lims, max_concurrent=4, kind='process'):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1.")
+        if not(kind in ['process', 'thread']):
+            raise ValueError("kind must be 'process' or 'thread'.")
+        self.lims = lims
+        self.max_concurrent = max_concurrent
+        self.kind = kind
+        self.nodes = []
+
+    def add(self, f, *args, **kwargs):
+        """Schedule the ``@task`` function *f* to run with *args*.
+
+        Arguments are passed to *f* exactly as they would be when
+        calling it directly, minus the MiniLIMS, which the workflow
+        supplies.  ``TaskOutput`` placeholders may appear anywhere in
+        the arguments, including inside lists, tuples and
+        dictionaries.  An optional keyword argument *after* gives a
+        list of nodes this task must wait for even though it does not
+        use their outputs.
+        """
+        after = kwargs.pop('after', [])
+        for n in after:
+            if not(isinstance(n, TaskNode)):
+                raise ValueError("after must be a list of TaskNodes.")
+        node = TaskNode(f, args, kwargs, after,
+                        "%s-%d" % (f.__name__, len(self.nodes)))
+        self.nodes.append(node)
+        return node
+
+    def run(self):
+        """Run all the tasks, and return their results.
+
+        Blocks until every task has either finished, failed, or been
+        skipped because one of its dependencies failed.
+        """
+        deps = dict([(n, n.dependencies()) for n in self.nodes])
+        for n in self.nodes:
+            if not(deps[n] <= set(self.nodes)):
+                raise ValueError("Task %s depends on a task from another workflow." % n.name)
+        if self.lims == None:
+            lims_path = None
+        else:
+            lims_path = self.lims.db_path
+        results = {}
+        failed = {}
+        skipped = []
+        pending = list(self.nodes)
+        running = {}
+        if self.kind == 'thread':
+            queue = Queue.Queue()
+        else:
+            queue = multiprocessing.Queue()
+        while pending != [] or running != {}:
+            for n in list(pending):
+                if any([d in failed or d in skipped for d in deps[n]]):
+                    pending.remove(n)
+                    skipped.append(n)
+                elif len(running) < self.max_concurrent and \
+                        all([d in results for d in deps[n]]):
+                    pending.remove(n)
+                    try:
+                        args = _resolve_task_outputs(n.args, self.lims, results)
+                        kwargs = _resolve_task_outputs(n.kwargs, self.lims, results)
+                    except ValueError:
+                        failed[n] = traceback.format_exc()
+                        continue
+                    worker_args = (self.nodes.index(n), n.f, lims_path,
+                                   args, kwargs, queue)
+                    if self.kind == 'thread':
+                        p = threading.Thread(target=_run_task_in_child,
+                                             args=worker_args + (False,))
+                    else:
+                        p = multiprocessing.Process(target=_run_task_in_child,
+                                                    args=worker_args)
+                    p.start()
+                    running[n] = p
+            if running == {}:
+                if pending != []:
+                    raise ValueError("Workflow contains a dependency cycle among %s." % \
+                                         ", ".join([n.name for n in pending]))
+                break
+            try:
+                (index, succeeded, payload) = queue.get(timeout=1)
+            except Queue.Empty:
+                # A worker which died without reporting (killed, or
+                # crashed in C code) would otherwise block us forever.
+                # Threads always report.
+                for n,p in running.items():
+                    if self.kind == 'process' and not(p.is_alive()) and p.exitcode != 0:
+                        p.join()
+                        del running[n]
+                        failed[n] = "Worker process exited with code %s.\n" % p.exitcode
+                continue
+            n = self.nodes[index]
+            running.pop(n).join()
+            if succeeded:
+                results[n] = pickle.loads(payload)
+            else:
+                failed[n] = payload
+        if failed != {}:
+            raise WorkflowFailed(results, failed, skipped)
+        return results
@@ -0,0 +1,88 @@
+# bein/fsck.py
+# Copyright 2010, BBCF
+
+# This file is part of bein.
+
+# Bein is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# Bein is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with bein.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+:mod:`bein.fsck` -- Check a MiniLIMS repository from the shell
+==============================================================
+
+.. module:: bein.fsck
+   :platform: Unix
+   :synopsis: Command line front end to MiniLIMS.fsck
+
+Run as::
+
+    python -m bein.fsck [--repair] [--full] [--workers N] [--state FILE]
+                        [--min-age SECONDS] /path/to/lims
+
+It prints progress to stderr, a report of missing, corrupted and
+orphaned files to stdout, and exits with status 1 if it found any
+problem it did not repair.  See ``MiniLIMS.fsck`` for what is checked.
+"""
+
+import os
+import sys
+from optparse import OptionParser
+
+from bein import MiniLIMS
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] lims")
+    parser.add_option("--repair", action="store_true", default=False,
+                      help="Quarantine orphans and refresh stale sizes and times")
+    parser.add_option("--full", action="store_true", default=False,
+                      help="Hash every file, even those which look unchanged")
+    parser.add_option("--workers", type="int", default=4,
+                      help="Files checked in parallel [default: %default]")
+    parser.add_option("--batch-size", type="int", default=1000,
+                      help="Files read from the database at once [default: %default]")
+    parser.add_option("--state", default=None,
+                      help="File to save progress to, and resume from")
+    parser.add_option("--min-age", type="int", default=3600,
+                      help="Seconds since a blob was last modified before it "
+                           "can be an orphan [default: %default]")
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Give exactly one MiniLIMS.")
+    if not(os.path.exists(args[0] + '.files')):
+        parser.error("No MiniLIMS at %s." % args[0])
+
+    def progress(checked, total):
+        print >>sys.stderr, "\rChecked %d of %d files" % (checked, total),
+    report = MiniLIMS(args[0]).fsck(repair=options.repair, full=options.full,
+                                    workers=options.workers,
+                                    batch_size=options.batch_size,
+                                    progress=progress, state_file=options.state,
+                                    min_age=options.min_age)
+    print >>sys.stderr
+    print "%d files checked." % report['checked']
+    for k in ['missing', 'corrupted', 'unverified', 'refreshed']:
+        if report[k] != []:
+            print "%d %s: %s" % (len(report[k]), k, " ".join([str(i) for i in report[k]]))
+    if report['orphans'] != []:
+        print "%d orphans: %s" % (len(report['orphans']), " ".join(report['orphans']))
+    if report['quarantined'] != []:
+        print "%d quarantined to %s.quarantine" % (len(report['quarantined']), args[0])
+    unrepaired = report['missing'] + report['corrupted'] + \
+        [f for f in report['orphans'] if not(f in report['quarantined'])]
+    if unrepaired != []:
+        return 1
+    else:
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,259 @@
+# bein/metrics.py
+# Copyright 2010, BBCF
+
+# This file is part of bein.
+
+# Bein is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# Bein is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with bein.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+:mod:`bein.metrics` -- Instrumentation of bein's internals
+==========================================================
+
+.. module:: bein.metrics
+   :platform: Unix
+   :synopsis: Counters, timers and histograms for bein's hot paths
+
+Bein reports how long its own work takes (copying files into and out
+of the repository, writing executions, searching, launching programs)
+as metrics.  Nothing is measured until a sink is registered to receive
+them, so when metrics are not in use they cost bein one function call
+per instrumented operation.
+
+There are three kinds of metrics:
+
+counters
+    Something happened *value* times (``increment``).
+
+timers
+    An operation took some number of seconds (``timer``).
+
+histograms
+    A distribution of values, such as the sizes of copied files
+    (``observe``).
+
+To see where time goes, register a sink, run your code, and look at
+what the sink collected::
+
+    from bein import metrics
+    sink = metrics.MemorySink()
+    metrics.add_sink(sink)
+    ... run some executions ...
+    print sink.summary()
+
+``StatsdSink`` sends metrics to a StatsD daemon over UDP, and
+``LogSink`` appends them to a file.  Any object with ``counter``,
+``timing`` and ``histogram`` methods taking a name and a value can be
+used as a sink.
+
+Metric names used by bein:
+
+* ``lims.import_copy`` (timer), ``lims.import_bytes`` (histogram):
+  copying a file into the repository.
+* ``lims.import_move`` (timer): moving a file into the repository.
+* ``lims.stage_copy`` (timer): copying a file to the staging area
+  during an execution.
+* ``lims.export_copy`` (timer), ``lims.export_bytes`` (histogram):
+  copying a file out of the repository.
+* ``lims.write`` (timer): writing an execution to the MiniLIMS.
+* ``lims.search_files``, ``lims.search_executions`` (timers): queries.
+* ``unique_filename_in`` (timer): choosing a fresh filename.
+* ``program.launch`` (timer): starting an external program.
+* ``program.run`` (timer): running it, from start to finish.
+* ``program.runs`` (counter): programs run.
+"""
+
+import functools
+import socket
+import sys
+import threading
+import time
+
+_sinks = []
+
+class _NullTimer(object):
+    """What ``timer`` returns when no sink is registered."""
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        for s in list(_sinks):
+            s.timing(self.name, elapsed)
+        return False
+
+def add_sink(sink):
+    """Start sending all metrics to *sink*."""
+    _sinks.append(sink)
+
+def remove_sink(sink):
+    """Stop sending metrics to *sink*."""
+    _sinks.remove(sink)
+
+def enabled():
+    """Is any sink registered?"""
+    return _sinks != []
+
+def increment(name, value=1):
+    """Add *value* to the counter *name*."""
+    if _sinks:
+        for s in list(_sinks):
+            s.counter(name, value)
+
+def observe(name, value):
+    """Record *value* in the histogram *name*."""
+    if _sinks:
+        for s in list(_sinks):
+            s.histogram(name, value)
+
+def timing(name, seconds):
+    """Record that something measured elsewhere took *seconds* as the timer *name*."""
+    if _sinks:
+        for s in list(_sinks):
+            s.timing(name, seconds)
+
+def timer(name):
+    """Time the body of a ``with`` statement as the timer *name*::
+
+        with metrics.timer('lims.write'):
+            ...
+    """
+    if _sinks:
+        return _Timer(name)
+    else:
+        return _null_timer
+
+def timed(name):
+    """Decorator timing every call of a function as the timer *name*."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _sinks:
+                with _Timer(name):
+                    return f(*args, **kwargs)
+            else:
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MemorySink(object):
+    """Keep all metrics in memory.
+
+    *counters* maps names to their totals, and *timings* and
+    *histograms* map names to lists of all the values recorded.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.histograms = {}
+
+    def counter(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self.lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def histogram(self, name, value):
+        with self.lock:
+            self.histograms.setdefault(name, []).append(value)
+
+    def summary(self):
+        """Return a table of count, total, mean and maximum per metric."""
+        with self.lock:
+            lines = ["%-30s %10s %12s %12s %12s" % ('name', 'count', 'total',
+                                                     'mean', 'max')]
+            for (name, n) in sorted(self.counters.items()):
+                lines.append("%-30s %10d" % (name, n))
+            for d in [self.timings, self.histograms]:
+                for (name, values) in sorted(d.items()):
+                    lines.append("%-30s %10d %12.6g %12.6g %12.6g" % \
+                                     (name, len(values), sum(values),
+                                      sum(values)/float(len(values)), max(values)))
+        return "\n".join(lines)
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self.lock:
+            self.counters = {}
+            self.timings = {}
+            self.histograms = {}
+
+
+class StatsdSink(object):
+    """Send metrics to a StatsD daemon at *host*:*port* over UDP.
+
+    Metric names are prefixed with *prefix* and a dot.  Timings are
+    sent in milliseconds.  Packets which cannot be sent are dropped,
+    as StatsD clients usually do.
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='bein'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind):
+        try:
+            self.socket.sendto("%s.%s:%s|%s" % (self.prefix, name, value, kind),
+                               self.address)
+        except socket.error:
+            pass
+
+    def counter(self, name, value):
+        self._send(name, value, 'c')
+
+    def timing(self, name, seconds):
+        self._send(name, "%.3f" % (seconds*1000), 'ms')
+
+    def histogram(self, name, value):
+        self._send(name, value, 'h')
+
+
+class LogSink(object):
+    """Append metrics to *log*, a filename or a file object.
+
+    Each metric is one line of the form ``timestamp kind name value``,
+    with timings in seconds.
+    """
+    def __init__(self, log=sys.stderr):
+        if isinstance(log, str):
+            log = open(log, 'a')
+        self.log = log
+        self.lock = threading.Lock()
+
+    def _write(self, kind, name, value):
+        with self.lock:
+            self.log.write("%.6f %s %s %s\n" % (time.time(), kind, name, value))
+            self.log.flush()
+
+    def counter(self, name, value):
+        self._write('counter', name, value)
+
+    def timing(self, name, seconds):
+        self._write('timing', name, "%.6f" % seconds)
+
+    def histogram(self, name, value):
+        self._write('histogram', name, value)
@@ -0,0 +1,370 @@
+# bein/server.py
+# Copyright 2010, BBCF
+
+# This file is part of bein.
+
+# Bein is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# Bein is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with bein.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+:mod:`bein.server` -- Share a MiniLIMS between machines
+=======================================================
+
+.. module:: bein.server
+   :platform: Unix
+   :synopsis: A metadata server owning a MiniLIMS database, and its client
+
+When executions on many cluster nodes write to the same MiniLIMS, each
+node opening the SQLite database over NFS is slow (file locking over
+NFS is) and can corrupt it.  Instead, run a server owning the database
+on one machine::
+
+    python -m bein.server [--host HOST] [--port PORT] /path/to/lims
+
+and use a ``RemoteMiniLIMS`` everywhere else in place of the
+``MiniLIMS``::
+
+    from bein.server import RemoteMiniLIMS
+    M = RemoteMiniLIMS('http://limshost:8421')
+    with execution(M) as ex:
+        ...
+
+Only metadata goes through the server: clients read and write the
+files of the repository directly, so the repository's ``.files``
+directory must be on a filesystem shared by the server and all the
+clients, mounted at the same path everywhere.  The server handles
+calls one at a time on its own connection to the database.  A whole
+execution, with all its programs and files, is recorded by one call
+in one transaction, and several calls can be sent in one request with
+``RemoteMiniLIMS.batch``.
+
+The protocol is JSON over HTTP.  ``GET /`` describes the repository.
+``POST /`` takes a list of calls, each ``{"method": name, "args":
+[...], "kwargs": {...}}``, runs them in order, and answers
+``{"results": [...]}``, or ``{"error": {"type": ..., "message": ...,
+"call": i}}`` if the *i*-th call raised an exception (the calls before
+it stay done).  Tuples are sent as ``{"__tuple__": [...]}``.  There is
+no authentication, so only listen on trusted networks.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import httplib
+import json
+import os
+import select
+import sqlite3
+import sys
+import threading
+import urlparse
+from optparse import OptionParser
+
+from bein import MiniLIMS, __version__, _deletion_listeners
+
+# The MiniLIMS methods clients may call.  The private ones are the
+# parts of write, import_files, path_to_file and the deletions which
+# touch the database.
+exported_methods = ['search_files', 'search_executions', 'fetch_file',
+                    'fetch_execution', 'verify_file', 'gc', 'copy_file',
+                    'resolve_alias', 'add_alias', 'delete_alias',
+                    'associated_files_of', 'associate_file',
+                    'delete_file_association', '_blob_of', '_make_writable',
+                    '_record_execution', '_record_imports', '_delete']
+
+# Exceptions raised on the client as themselves.  Others are raised as
+# RemoteError.
+_exceptions = dict([(e.__name__, e) for e in
+                    [ValueError, KeyError, IOError, OSError, TypeError,
+                     NotImplementedError, sqlite3.IntegrityError]])
+
+def _encode(value):
+    """Return *value* with its tuples marked, so they survive JSON."""
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode(v) for v in value]}
+    elif isinstance(value, list):
+        return [_encode(v) for v in value]
+    elif isinstance(value, dict):
+        return dict([(k, _encode(v)) for (k, v) in value.iteritems()])
+    else:
+        return value
+
+def _decode(value):
+    """Undo ``_encode`` on *value* as read by ``json``.
+
+    Also turns ASCII strings back into ``str``, which bein expects
+    (for aliases, for instance).  Others stay ``unicode``, as SQLite
+    would give them.
+    """
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    elif isinstance(value, list):
+        return [_decode(v) for v in value]
+    elif isinstance(value, dict):
+        if value.keys() == ['__tuple__']:
+            return tuple(_decode(value['__tuple__']))
+        return dict([(_decode(k), _decode(v)) for (k, v) in value.iteritems()])
+    else:
+        return value
+
+def _dumps(value):
+    return json.dumps(_encode(value))
+
+def _loads(text):
+    return _decode(json.loads(text))
+
+
+def _dropped(connection):
+    """Has the server closed the kept-alive *connection*?
+
+    An idle connection the server still holds open has nothing to
+    read; one it closed reads as the end of the stream.
+    """
+    if connection.sock == None:
+        return False
+    return select.select([connection.sock], [], [], 0)[0] != []
+
+
+class RemoteError(Exception):
+    """An exception raised by the server which has no counterpart here."""
+    pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections open between calls.
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, value):
+        body = _dumps(value)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        lims = self.server.lims
+        policy = lims.compression_policy
+        self._reply({'version': __version__,
+                     'file_path': lims.file_path,
+                     'digest_algorithm': lims.digest_algorithm,
+                     'compression_policy': not(callable(policy)) and policy or None})
+
+    def do_POST(self):
+        calls = _loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self._reply(self.server.call(calls))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class MiniLIMSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serve the MiniLIMS at *path* to ``RemoteMiniLIMS`` clients.
+
+    Listens on *host* and *port* (a free port if 0; see
+    *server_address* for which).  Call ``serve_forever`` to run it.
+    Connections are served by threads of their own, but calls are
+    run one at a time.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, path, host='127.0.0.1', port=8421, verbose=False):
+        self.lims = MiniLIMS(path)
+        self.verbose = verbose
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _Handler)
+
+    def call(self, calls):
+        """Run *calls* in order, and return the reply to send."""
+        results = []
+        with self.lims._lock:
+            for (i, c) in enumerate(calls):
+                try:
+                    if not(c['method'] in exported_methods):
+                        raise NotImplementedError("%s cannot be called remotely." % c['method'])
+                    method = getattr(self.lims, c['method'])
+                    results.append(method(*c.get('args', []), **c.get('kwargs', {})))
+                except Exception, e:
+                    # Whatever the call left uncommitted must not be
+                    # committed by the next client's call.
+                    self.lims.db.rollback()
+                    return {'error': {'type': e.__class__.__name__,
+                                      'message': str(e),
+                                      'call': i}}
+        return {'results': results}
+
+
+class RemoteMiniLIMS(MiniLIMS):
+    """A MiniLIMS served by a ``MiniLIMSServer`` at *url*.
+
+    It can be used in place of a ``MiniLIMS`` for executions, and
+    provides the same methods for searching, fetching, importing,
+    exporting, copying, aliasing, associating and deleting files and
+    executions, and ``verify_file`` and ``gc``.  The others (``fsck``,
+    ``browse_files``, ``browse_executions``, ``export_trace``,
+    ``last_id`` and resumable executions) need the database itself, so
+    run them on the server's machine.
+
+    Files are copied into and out of the repository directly, so its
+    directory must be mounted at the same path here as on the server.
+    """
+    def __init__(self, url):
+        parsed = urlparse.urlparse(url)
+        self.url = url
+        self.address = (parsed.hostname, parsed.port or 80)
+        self._connections = threading.local()
+        info = self._request('GET', None)
+        self.db_path = None
+        self.db = None
+        self.file_path = info['file_path']
+        self.checkpoint_path = os.path.join(self.file_path, '.checkpoints')
+        self.staging_path = os.path.join(self.file_path, '.staging')
+        self.digest_algorithm = info['digest_algorithm']
+        self.compression_policy = info['compression_policy']
+        self._reserve_lock = threading.Lock()
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        connection = httplib.HTTPConnection(*self.address)
+        self._connections.connection = connection
+        return connection
+
+    def _request(self, method, body):
+        """Send an HTTP request, and return the decoded reply.
+
+        A kept-alive connection which the server closed meanwhile is
+        replaced before sending, and the request is sent again on a new
+        connection if sending it on a kept-alive one fails.  Once sent,
+        it is never repeated, even if the reply is lost: the server may
+        have run it already.
+        """
+        connection = getattr(self._connections, 'connection', None)
+        if connection != None and _dropped(connection):
+            connection.close()
+            connection = None
+        reused = connection != None
+        if not(reused):
+            connection = self._connect()
+        headers = {'Content-Type': 'application/json'}
+        try:
+            try:
+                connection.request(method, '/', body, headers)
+            except (httplib.HTTPException, IOError):
+                if not(reused):
+                    raise
+                # The server closed the idle connection before any of
+                # this request reached it.
+                connection.close()
+                connection = self._connect()
+                connection.request(method, '/', body, headers)
+            response = connection.getresponse()
+            reply = response.read()
+        except:
+            connection.close()
+            self._connections.connection = None
+            raise
+        if response.status != 200:
+            raise RemoteError("%s answered %d %s" % (self.url, response.status,
+                                                     response.reason))
+        return _loads(reply)
+
+    def close(self):
+        """Close this thread's connection to the server.
+
+        A new one is opened by the next call.
+        """
+        connection = getattr(self._connections, 'connection', None)
+        if connection != None:
+            connection.close()
+            self._connections.connection = None
+
+    def batch(self, calls):
+        """Run several calls in one request, and return their results.
+
+        *calls* is a list of ``(method, args, kwargs)``, naming methods
+        of the MiniLIMS on the server.  They are run in order, with no
+        other calls in between.  If one raises an exception, it is
+        raised here, and the calls after it are not run.
+        """
+        reply = self._request('POST', _dumps([{'method': m, 'args': list(a), 'kwargs': k}
+                                              for (m, a, k) in calls]))
+        if 'error' in reply:
+            error = reply['error']
+            if error['type'] in _exceptions:
+                raise _exceptions[error['type']](error['message'])
+            else:
+                raise RemoteError("%s: %s" % (error['type'], error['message']))
+        return reply['results']
+
+    def _call(self, method, *args, **kwargs):
+        return self.batch([(method, args, kwargs)])[0]
+
+    def _delete(self, exids, fileids, workers):
+        files = self._call('_delete', list(exids), list(fileids), workers)
+        # The server's listeners were called there; caches here need
+        # to hear about it too.
+        for listener in list(_deletion_listeners):
+            listener(self, files)
+        return files
+
+    def _start_resumable(self, ex, description, resume=None):
+        raise NotImplementedError("Resumable executions need a local MiniLIMS.")
+
+    def remove(self):
+        raise NotImplementedError("Remove a MiniLIMS on the server's machine.")
+
+def _forward(name):
+    def method(self, *args, **kwargs):
+        return self._call(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(MiniLIMS, name).__doc__
+    return method
+
+for _name in exported_methods:
+    if _name != '_delete':
+        setattr(RemoteMiniLIMS, _name, _forward(_name))
+
+def _refuse(name):
+    def method(self, *args, **kwargs):
+        raise NotImplementedError("%s needs the database; run it on the server's machine." % name)
+    method.__name__ = name
+    return method
+
+for _name in ['fsck', 'browse_files', 'browse_executions', 'export_trace', 'last_id']:
+    setattr(RemoteMiniLIMS, _name, _refuse(_name))
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] lims")
+    parser.add_option("--host", default="127.0.0.1",
+                      help="Address to listen on [default: %default]")
+    parser.add_option("--port", type="int", default=8421,
+                      help="Port to listen on [default: %default]")
+    parser.add_option("--verbose", action="store_true", default=False,
+                      help="Log every request to stderr")
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Give exactly one MiniLIMS.")
+    server = MiniLIMSServer(args[0], options.host, options.port, options.verbose)
+    print >>sys.stderr, "Serving %s on http://%s:%d/" % ((args[0],) + server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -31,14 +31,22 @@ analysis of high throughput sequencing data, but if you have useful
 functions for a different domain, please contribute them.
 """
 
-import pickle
+import cPickle
+import collections
 import re
 import sys
 import os
+import io
+import gzip
+import random
+import itertools
 import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from contextlib import contextmanager
 
 from bein import *
+from bein import _current_directory
 
 # Basic utilities
 
@@ -78,15 +86,15 @@ def pause():
 def first_n_lines(input_file, n, output_file = None):
     """Writes the first *n* lines of *input_file* to another file.
 
-    If *output_file* is ``None``, then the output is written to a randomly named file.
+    If *output_file* is ``None``, then the output is written to a
+    randomly named file.  *input_file* may be gzipped.
     """
     if output_file == None:
         output_file = unique_filename_in()
-    with open(input_file, 'r') as inf:
-        with open(output_file, 'w') as outf:
-            for i in xrange(n):
-                l = inf.readline()
-                outf.write(l)
+    directory = _current_directory()
+    with _open_input(os.path.join(directory, input_file)) as inf:
+        with open(os.path.join(directory, output_file), 'wb', 1024*1024) as outf:
+            outf.writelines(itertools.islice(inf, n))
     return output_file
 
 
@@ -111,8 +119,7 @@ def remove_lines_matching(pattern, filename):
 
 
 @program
-def md5sum(filename):
-    """Calculate the MD5 sum of *filename* and return it as a string."""
+def _openssl_md5(filename):
     def parse_output(p):
         m = re.search(r'=\s*([a-f0-9A-F]+)\s*$',
                       ''.join(p.stdout))
@@ -120,6 +127,31 @@ def md5sum(filename):
     return {"arguments": ["openssl","md5",filename],
             "return_value": parse_output}
 
+def md5sum(ex, filename, record=False):
+    """Calculate the MD5 sum of *filename* and return it as a string.
+
+    *filename* is relative to the working directory of the execution
+    *ex*.  The file is hashed in process with ``hashlib``, so this is
+    not recorded as a program in the execution.  Use
+    ``bein.checksums`` to hash many files in parallel.
+
+    With *record*, ``openssl md5`` is run as a program instead, and
+    recorded in *ex* like any other.  ``md5sum.nonblocking`` does the
+    same when given *via* or any other argument of a program's
+    ``nonblocking``.
+    """
+    if record:
+        return _openssl_md5(ex, filename)
+    if isinstance(ex, Execution):
+        filename = os.path.join(ex.working_directory, filename)
+    return checksum(filename, 'md5')
+
+def _md5sum_nonblocking(ex, filename, record=False, **kwargs):
+    if record or kwargs:
+        return _openssl_md5.nonblocking(ex, filename, **kwargs)
+    return background(md5sum, ex, filename)
+md5sum.nonblocking = _md5sum_nonblocking
+
 
 
 @program
@@ -129,16 +161,95 @@ def sleep(n):
             "return_value": n}
 
 
+def _count_newlines(args):
+    """Count the newlines in bytes *start* to *end* of *path*.
+
+    Takes a single tuple ``(path, start, end, buffer_size)`` so it can
+    be mapped over a ``multiprocessing`` pool.  *end* may be ``None``
+    for the end of the file.
+    """
+    (path, start, end, buffer_size) = args
+    n = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        left = end == None and -1 or end - start
+        while left != 0:
+            if left < 0:
+                block = f.read(buffer_size)
+            else:
+                block = f.read(min(buffer_size, left))
+                left -= len(block)
+            if not block:
+                break
+            n += block.count('\n')
+    return n
+
+def _pool_map(f, xs, workers):
+    """Map *f* over *xs* in a pool of *workers* processes."""
+    if workers <= 1 or len(xs) <= 1:
+        return map(f, xs)
+    pool = multiprocessing.Pool(min(workers, len(xs)))
+    try:
+        return pool.map(f, xs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
 @program
-def count_lines(filename):
-    """Count the number of lines in *filename* (equivalent to ``wc -l``)."""
+def _wc_l(filename):
     def parse_output(p):
-        m = re.search(r'^\s*(\d+)\s+' + filename + r'\s*$',
-                      ''.join(p.stdout))
+        m = re.search(r'^\s*(\d+)\s+' + re.escape(filename) + r'\s*$',
+                      ''.join(p.stdout), re.M)
         return int(m.groups()[-1]) # in case of a weird line in LSF
     return {"arguments": ["wc","-l",filename],
             "return_value": parse_output}
 
+def count_lines(ex, filename, workers=1, record=False,
+                min_range=64*1024*1024, buffer_size=1024*1024):
+    """Count the number of lines in *filename* (equivalent to ``wc -l``).
+
+    *filename* is relative to the working directory of the execution
+    *ex*.  As with ``wc -l``, it is newlines which are counted, so a
+    last line without one is not.  The file is read in process in
+    blocks of *buffer_size* bytes, and is not recorded as a program in
+    the execution.  With *workers* greater than 1, a file of at least
+    twice *min_range* bytes is cut into byte ranges which are counted
+    by that many processes.
+
+    With *record*, ``wc -l`` is run as a program instead, and
+    recorded in *ex* like any other.  ``count_lines.nonblocking`` does
+    the same when given *via*, taking the other arguments of a
+    program's ``nonblocking``.  Use ``count_lines_in_files`` to count
+    lines of many files at once.
+    """
+    if record:
+        return _wc_l(ex, filename)
+    if isinstance(ex, Execution):
+        filename = os.path.join(ex.working_directory, filename)
+    size = os.path.getsize(filename)
+    n_ranges = max(1, min(workers, size // min_range))
+    step = size // n_ranges + 1
+    ranges = [(filename, i, min(i + step, size), buffer_size)
+              for i in range(0, size, step)]
+    return sum(_pool_map(_count_newlines, ranges, workers))
+
+def _count_lines_nonblocking(ex, filename, record=False, via=None, **kwargs):
+    if record or via != None:
+        return _wc_l.nonblocking(ex, filename, via=via or 'local', **kwargs)
+    return background(count_lines, ex, filename, **kwargs)
+count_lines.nonblocking = _count_lines_nonblocking
+
+def count_lines_in_files(ex, filenames, workers=4, buffer_size=1024*1024):
+    """Count the lines in each of *filenames*, and return the counts in order.
+
+    Like ``count_lines``, but the files are counted by a pool of
+    *workers* processes, each file whole.
+    """
+    if isinstance(ex, Execution):
+        filenames = [os.path.join(ex.working_directory, f) for f in filenames]
+    return _pool_map(_count_newlines, [(f, 0, None, buffer_size) for f in filenames],
+                     workers)
+
 
 @program
 def split_file(filename, n_lines = 1000, prefix = None, suffix_length = 3):
@@ -149,34 +260,371 @@ def split_file(filename, n_lines = 1000, prefix = None, suffix_length = 3):
     each file, *prefix* is the file prefix to use (which is set to a
     unique, randomly chosen string if not specified), and
     *suffix_length* is the number of positions to use after the prefix
-    to label the files.
+    to label the files.  The names are returned in the order of the
+    pieces in *filename*.
     """
     if prefix == None:
         prefix = unique_filename_in()
+    directory = _current_directory()
     def extract_filenames(p):
-        return [x for x in os.listdir('.') if x.startswith(prefix)]
+        # split's suffixes sort in the order of the pieces.
+        return sorted([x for x in os.listdir(directory) if x.startswith(prefix)])
     return {"arguments": ["split", "-a", str(suffix_length),
                           "-l", str(n_lines), filename, prefix],
             "return_value": extract_filenames}
 
 
-def use_pickle(ex_or_lims, id_or_alias):
-    """Loads *id_or_alias* as a pickle file and returns the pickled objects.
+@program
+def concatenate(filenames):
+    """Equivalent to shell: ``cat filenames...``
 
-    *ex_or_lims* may be either an execution object or a MiniLIMS object.
+    Pass ``stdout`` to write the concatenation to a file.
+    """
+    return {"arguments": ["cat"] + list(filenames),
+            "return_value": None}
+
+
+def scatter_gather(ex, prog, filename, args=(), kwargs=None, n_lines=None,
+                   n_chunks=None, via='local', max_concurrent=4, merge=None,
+                   output=None, capture_stdout=False):
+    """Run *prog* on pieces of *filename* in parallel, and merge the results.
+
+    *filename* is split with ``split_file``, either into pieces of
+    *n_lines* lines or into *n_chunks* pieces of (nearly) equal
+    numbers of lines.  Then the ``@program`` *prog* is run on each
+    piece as ``prog.nonblocking(ex, piece, *args, via=via,
+    **kwargs)``, at most *max_concurrent* at a time (``None`` runs
+    them all at once).  *prog* should return the name of the file it
+    wrote.  If it writes its result to stdout instead, set
+    *capture_stdout* and each piece's stdout is sent to a file of its
+    own.
+
+    By default the results are concatenated, in the order of the
+    pieces, into *output* (a unique filename if ``None``) by ``cat``,
+    and *output* is returned.  If *merge* is given, it is called as
+    ``merge(ex, results)`` instead, with the list of results in order,
+    and its value is returned.  The split, every run of *prog*, and
+    the concatenation are all programs recorded in *ex*::
+
+        with execution(M) as ex:
+            sam = scatter_gather(ex, bowtie, 'reads.fastq', args=(index,),
+                                 n_chunks=16, via='lsf', max_concurrent=None)
+
+    If any run of *prog* fails, ``ProgramFailed`` is raised once all
+    the runs already started have finished.
     """
+    if (n_lines == None) == (n_chunks == None):
+        raise ValueError("Give exactly one of n_lines and n_chunks.")
+    if kwargs == None:
+        kwargs = {}
+    if n_chunks != None:
+        total = count_lines(ex, filename, record=True)
+        n_lines = max(1, (total + n_chunks - 1) // n_chunks)
+    pieces = split_file(ex, filename, n_lines=n_lines)
+
+    results = [None]*len(pieces)
+    failures = []
+    pending = []
+    def finish():
+        (i, stdout, future) = pending.pop(0)
+        try:
+            v = future.wait()
+        except Exception, e:
+            failures.append(e)
+            return
+        if future.program_output.return_code != 0:
+            failures.append(ProgramFailed(future.program_output))
+        elif capture_stdout:
+            results[i] = stdout
+        else:
+            results[i] = v
+    for (i, piece) in enumerate(pieces):
+        if max_concurrent != None and len(pending) >= max_concurrent:
+            finish()
+        if failures != []:
+            break
+        kw = dict(kwargs, via=via)
+        stdout = None
+        if capture_stdout:
+            stdout = unique_filename_in(ex.working_directory)
+            kw['stdout'] = stdout
+        pending.append((i, stdout, prog.nonblocking(ex, piece, *args, **kw)))
+    while pending != []:
+        finish()
+    if failures != []:
+        raise failures[0]
+
+    if merge != None:
+        return merge(ex, results)
+    if output == None:
+        output = unique_filename_in(ex.working_directory)
+    if results == []:
+        # cat with no arguments would read stdin.
+        open(os.path.join(ex.working_directory, output), 'w').close()
+    else:
+        concatenate(ex, results, stdout=output)
+    return output
+
+
+# Sequencing reads
+
+def _open_input(path):
+    """Open *path* for reading in large blocks, gunzipping it if it is gzipped."""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == '\x1f\x8b':
+        return io.BufferedReader(gzip.GzipFile(path, 'rb'), 1024*1024)
+    else:
+        return io.open(path, 'rb', buffering=1024*1024)
+
+def _fastq_records(f):
+    while True:
+        header = f.readline()
+        if not header:
+            return
+        if not header.startswith('@'):
+            raise ValueError("Expected a FASTQ record, found %r" % header)
+        yield header + f.readline() + f.readline() + f.readline()
+
+def _fasta_records(f):
+    record = []
+    for line in f:
+        if line.startswith('>') and record != []:
+            yield "".join(record)
+            record = []
+        record.append(line)
+    if record != []:
+        yield "".join(record)
+
+def read_records(path, format=None):
+    """Iterate over the FASTQ or FASTA records in *path*, as strings.
+
+    *path* may be gzipped.  *format* is ``'fastq'`` or ``'fasta'``, or
+    ``None`` to guess from the first character of the file.  Each
+    record is a string holding all its lines, including the header
+    line.  Records are read as they are needed, so files of any size
+    can be read.
+    """
+    f = _open_input(path)
+    try:
+        if format == None:
+            first = f.peek(1)[:1]
+            format = {'@': 'fastq', '>': 'fasta', '': 'fastq'}.get(first)
+            if format == None:
+                raise ValueError("%s is neither FASTQ nor FASTA." % path)
+        if format == 'fastq':
+            records = _fastq_records(f)
+        elif format == 'fasta':
+            records = _fasta_records(f)
+        else:
+            raise ValueError("Unknown format %s; use 'fastq' or 'fasta'." % format)
+        for r in records:
+            yield r
+    finally:
+        f.close()
+
+def _path_in(ex, filename):
+    if isinstance(ex, Execution):
+        return os.path.join(ex.working_directory, filename)
+    else:
+        return filename
 
+def _open_output(ex, filename, compress):
+    if compress:
+        return gzip.GzipFile(_path_in(ex, filename), 'wb', mtime=0)
+    else:
+        return open(_path_in(ex, filename), 'wb', 1024*1024)
+
+def split_records(ex, filename, n_records=None, n_bytes=None, format=None,
+                  prefix=None, compress=False):
+    """Split the FASTQ or FASTA file *filename* into pieces of whole records.
+
+    Each piece holds *n_records* records, or as many records as fit in
+    *n_bytes* bytes (at least one).  *filename* is relative to the
+    working directory of *ex*, and may be gzipped.  The pieces are
+    named *prefix* (a unique name if ``None``) followed by a number,
+    and are written uncompressed unless *compress* is set.  Returns
+    the names of the pieces, in order.
+
+    Unlike ``split_file``, this runs in process and is not recorded as
+    a program in *ex*.  Only one record is held in memory at a time.
+    """
+    if (n_records == None) == (n_bytes == None):
+        raise ValueError("Give exactly one of n_records and n_bytes.")
+    if prefix == None:
+        prefix = unique_filename_in(_path_in(ex, '.'))
+    pieces = []
+    out = None
+    try:
+        for record in read_records(_path_in(ex, filename), format):
+            if out == None or (n_records != None and count >= n_records) or \
+                    (n_bytes != None and size + len(record) > n_bytes):
+                if out != None:
+                    out.close()
+                pieces.append("%s%04d%s" % (prefix, len(pieces), compress and '.gz' or ''))
+                out = _open_output(ex, pieces[-1], compress)
+                count = 0
+                size = 0
+            out.write(record)
+            count += 1
+            size += len(record)
+    finally:
+        if out != None:
+            out.close()
+    return pieces
+
+def head_records(ex, filename, n, format=None, output=None, compress=False):
+    """Write the first *n* records of *filename* to *output*, and return *output*.
+
+    *filename* may be a gzipped FASTQ or FASTA file.  If *output* is
+    ``None``, a unique filename is chosen.  Reading stops after the
+    *n*-th record.
+    """
+    if output == None:
+        output = unique_filename_in(_path_in(ex, '.'))
+    with _open_output(ex, output, compress) as out:
+        out.writelines(itertools.islice(read_records(_path_in(ex, filename), format), n))
+    return output
+
+def sample_records(ex, filename, n, format=None, output=None, compress=False,
+                   seed=None):
+    """Write *n* records of *filename* chosen uniformly at random to *output*.
+
+    Uses reservoir sampling, so *filename* (which may be gzipped) is
+    read once, and only the *n* chosen records are held in memory.
+    The records are written in the order they appear in *filename*.
+    Pass *seed* to get the same sample every time.  Returns *output*,
+    which is a unique filename if ``None``.
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for (i, record) in enumerate(read_records(_path_in(ex, filename), format)):
+        if i < n:
+            reservoir.append((i, record))
+        else:
+            j = rng.randint(0, i)
+            if j < n:
+                reservoir[j] = (i, record)
+    reservoir.sort()
+    if output == None:
+        output = unique_filename_in(_path_in(ex, '.'))
+    with _open_output(ex, output, compress) as out:
+        out.writelines([r for (i, r) in reservoir])
+    return output
+
+
+class PickleCache(object):
+    """Least recently used cache of unpickled repository files.
+
+    Holds the values of pickles whose files add up to at most
+    *max_bytes* bytes on disk; the least recently used are dropped to
+    make room.  Entries are keyed by MiniLIMS and file ID, and also
+    remember the blob's inode, size and mtime, so a file modified
+    through ``path_to_file(writable=True)`` is loaded again.  Deleted
+    files are dropped as soon as they are deleted.
+    """
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+        add_deletion_listener(self._deleted)
+
+    def clear(self):
+        """Drop every cached value."""
+        with self.lock:
+            self.entries = collections.OrderedDict()
+            self.bytes = 0
+
+    def get(self, key, stamp):
+        """Return the value cached for *key* if it was cached for *stamp*, or raise ``KeyError``."""
+        with self.lock:
+            (cached_stamp, size, value) = self.entries.pop(key)
+            if cached_stamp != stamp:
+                self.bytes -= size
+                raise KeyError(key)
+            self.entries[key] = (cached_stamp, size, value)
+            return value
+
+    def put(self, key, stamp, size, value):
+        """Cache *value* for *key* and *stamp*, counting *size* bytes."""
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            while self.entries and self.bytes + size > self.max_bytes:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.entries[key] = (stamp, size, value)
+            self.bytes += size
+
+    def _deleted(self, lims, fileids):
+        with self.lock:
+            for fileid in fileids:
+                entry = self.entries.pop((lims.file_path, fileid), None)
+                if entry != None:
+                    self.bytes -= entry[1]
+
+pickle_cache = PickleCache()
+
+def _lims_of(ex_or_lims):
     if isinstance(ex_or_lims, MiniLIMS):
-        lims = ex_or_lims
+        return ex_or_lims
     elif isinstance(ex_or_lims, Execution):
-        lims = ex_or_lims.lims
+        return ex_or_lims.lims
     else:
         raise ValueError("ex_or_lims must be a MiniLIMS or Execution.")
 
-    f = lims.path_to_file(id_or_alias)
-    with open(f) as q:
-        d = pickle.load(q)
-    return d
+def use_pickle(ex_or_lims, id_or_alias, cache=True):
+    """Loads *id_or_alias* as a pickle file and returns the pickled objects.
+
+    *ex_or_lims* may be either an execution object or a MiniLIMS object.
+
+    Unpickled values are kept in ``pickle_cache``, so loading the same
+    file again costs no more than checking that it has not changed.
+    Every caller then gets the same object, which must not be
+    modified.  Pass *cache=False* to unpickle a private copy.  The
+    cache's size is set by ``pickle_cache.max_bytes``.
+    """
+
+    lims = _lims_of(ex_or_lims)
+    fileid = lims.resolve_alias(id_or_alias)
+    f = lims.path_to_file(fileid)
+    if not(cache):
+        with open(f, 'rb') as q:
+            return cPickle.load(q)
+    st = os.stat(f)
+    key = (lims.file_path, fileid)
+    stamp = (st.st_ino, st.st_size, st.st_mtime)
+    try:
+        return pickle_cache.get(key, stamp)
+    except KeyError:
+        with open(f, 'rb') as q:
+            d = cPickle.load(q)
+        pickle_cache.put(key, stamp, st.st_size, d)
+        return d
+
+_shared_pools = {}
+_shared_pools_lock = threading.Lock()
+
+def shared_pool(kind='thread'):
+    """Return the pool of workers shared by ``background`` calls in this process.
+
+    *kind* is ``'thread'`` or ``'process'``.  Each pool is created the
+    first time it is asked for, with one worker per CPU, and lives as
+    long as the process.
+    """
+    if not(kind in ('thread', 'process')):
+        raise ValueError("kind must be 'thread' or 'process', not %s" % (kind,))
+    with _shared_pools_lock:
+        # A forked child inherits the dictionary, but not the workers.
+        (pid, pool) = _shared_pools.get(kind, (None, None))
+        if pid != os.getpid():
+            if kind == 'thread':
+                pool = ThreadPool(multiprocessing.cpu_count())
+            else:
+                pool = multiprocessing.Pool(multiprocessing.cpu_count())
+            _shared_pools[kind] = (os.getpid(), pool)
+        return pool
 
 def background(fun, *args, **kwargs):
     """Run a function, but return a Future object instead of blocking.
@@ -195,27 +643,92 @@ def background(fun, *args, **kwargs):
         a = sqrt(0)
 
     except that in the first case, sqrt is run in a separate thread.
+    If the function raises an exception, wait() raises it.
 
     The argument list after *fun* is exactly what you would pass to
     *fun* if you were calling it directly, including keyword
-    arguments.
+    arguments, except for the keyword argument *executor*.  By
+    default each call gets a thread of its own.  Pass ``'thread'`` or
+    ``'process'`` to run the function in the pool ``shared_pool``
+    returns for that kind instead, which bounds how many run at once,
+    or pass any pool with an ``apply_async`` method, such as a
+    ``multiprocessing.Pool``.  A process pool needs *fun* and its
+    arguments to be picklable.
     """
+    executor = kwargs.pop('executor', None)
+    if isinstance(executor, str):
+        executor = shared_pool(executor)
+    if executor != None:
+        result = executor.apply_async(fun, args, kwargs)
+        class PoolFuture(object):
+            def wait(self):
+                return result.get()
+        return PoolFuture()
+
     class Future(object):
         def __init__(self):
             self.return_value = None
+            self.exc_info = None
 
         def wait(self):
             v.wait()
+            if self.exc_info != None:
+                raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
             return self.return_value
     future = Future()
     v = threading.Event()
     def g():
-        future.return_value = fun(*args, **kwargs)
+        try:
+            future.return_value = fun(*args, **kwargs)
+        except:
+            future.exc_info = sys.exc_info()
         v.set()
     a = threading.Thread(target=g)
     a.start()
     return(future)
 
+def background_map(fun, iterable, workers=None, kind='thread', ordered=True,
+                   pool=None):
+    """Map *fun* over *iterable* in a pool of workers, yielding the results.
+
+    *kind* is ``'thread'`` or ``'process'``.  Threads suit functions
+    which wait on I/O or release the interpreter lock; CPU heavy
+    Python needs processes to use several cores, and then *fun* and
+    the items must be picklable.  With *ordered*, results come back in
+    the order of *iterable*, otherwise in the order they finish.
+    Results are yielded as soon as they are available.  If *fun*
+    raises an exception, it is raised when its result would have been
+    yielded.
+
+    By default the map runs in the pool ``shared_pool`` returns for
+    *kind*, so concurrent maps share its workers rather than each
+    starting their own; *fun* must then not itself wait on work in
+    that pool.  Pass another *pool* to use it instead, or a number of
+    *workers* to run the map in a pool of its own, which is shut down
+    when the map finishes or is abandoned.
+    """
+    if not(kind in ('thread', 'process')):
+        raise ValueError("kind must be 'thread' or 'process', not %s" % (kind,))
+    own = pool == None and workers != None
+    if own:
+        if kind == 'thread':
+            pool = ThreadPool(workers)
+        else:
+            pool = multiprocessing.Pool(workers)
+    elif pool == None:
+        pool = shared_pool(kind)
+    try:
+        if ordered:
+            results = pool.imap(fun, iterable)
+        else:
+            results = pool.imap_unordered(fun, iterable)
+        for r in results:
+            yield r
+    finally:
+        if own:
+            pool.terminate()
+            pool.join()
+
 def deepmap(f, st):
     """Map function *f* over a structure *st*.
 
@@ -254,15 +767,65 @@ def add_pickle(execution, val, description="", alias=None):
     add_pickle lets you dump almost any Python value to a file in the
     MiniLIMS repository.  It is useful to keep track of intermediate
     calculations.  *description* will be set as the pickle file's
-    description.
+    description.  It is written with the highest pickle protocol,
+    which is binary and much faster to load than the default.
     """
     if isinstance(description,dict): description = str(description)
-    filename = unique_filename_in()
-    with open(filename, 'wb') as f:
-        pickle.dump(val, f)
+    filename = unique_filename_in(execution.working_directory)
+    with open(os.path.join(execution.working_directory, filename), 'wb') as f:
+        cPickle.dump(val, f, cPickle.HIGHEST_PROTOCOL)
     execution.add(filename, description=description, alias=alias)
     return filename
 
+try:
+    import numpy
+    def add_array(ex, array, description="", alias=None, compress=False):
+        """Save the NumPy array *array* as a ``.npy`` file, and add it to the repository.
+
+        Unlike a pickle, a ``.npy`` file can be memory-mapped by
+        ``use_array``.  It is stored uncompressed unless *compress*
+        says otherwise, since a compressed file must be decompressed
+        to a cache before it can be mapped.  Returns the filename in
+        the working directory.
+        """
+        if isinstance(description,dict): description = str(description)
+        filename = unique_filename_in(ex.working_directory) + '.npy'
+        numpy.save(os.path.join(ex.working_directory, filename),
+                   numpy.asanyarray(array))
+        ex.add(filename, description=description, alias=alias, compress=compress)
+        return filename
+
+    def add_arrays(ex, arrays, description="", alias=None, compress=False):
+        """Save the dictionary of named NumPy arrays *arrays* as a ``.npz`` file.
+
+        The file is added to the repository, and its filename in the
+        working directory returned.  ``use_array`` on it returns an
+        object mapping the names to the arrays, each read when it is
+        first asked for.  Arrays in a ``.npz`` file cannot be
+        memory-mapped; use ``add_array`` for each if they must be.
+        """
+        if isinstance(description,dict): description = str(description)
+        filename = unique_filename_in(ex.working_directory) + '.npz'
+        numpy.savez(os.path.join(ex.working_directory, filename), **arrays)
+        ex.add(filename, description=description, alias=alias, compress=compress)
+        return filename
+
+    def use_array(ex_or_lims, id_or_alias, mmap=True):
+        """Load the array (or arrays) in the ``.npy`` or ``.npz`` file *id_or_alias*.
+
+        *ex_or_lims* may be either an execution object or a MiniLIMS
+        object.  With *mmap*, a ``.npy`` file is memory-mapped read
+        only instead of read into memory, so only the parts of the
+        array actually used are read, and processes mapping the same
+        file share its pages.  Such an array cannot be modified; copy
+        it first.  A ``.npz`` file gives an object mapping names to
+        arrays, as ``numpy.load`` does.
+        """
+        f = _lims_of(ex_or_lims).path_to_file(id_or_alias)
+        return numpy.load(f, mmap_mode=mmap and 'r' or None)
+except:
+    print >>sys.stderr, "Could not import numpy.  Skipping add_array."
+
 try:
     import pylab
     @contextmanager
@@ -281,8 +844,8 @@ try:
         if isinstance(description,dict): description = str(description)
         f = pylab.figure(figsize=figure_size)
         yield f
-        filename = unique_filename_in() + '.' + figure_type
-        f.savefig(filename)
+        filename = unique_filename_in(ex.working_directory) + '.' + figure_type
+        f.savefig(os.path.join(ex.working_directory, filename))
         ex.add(filename, description=description, alias=alias)
 except:
     print >>sys.stderr, "Could not import matplotlib.  Skipping add_figure."
@@ -291,16 +854,73 @@ except:
 
 try:
     import tables as h5
+    def _open_hdf5(path, mode, **kwargs):
+        # PyTables 3 renamed openFile to open_file.
+        if hasattr(h5, 'open_file'):
+            return h5.open_file(path, mode, **kwargs)
+        else:
+            return h5.openFile(path, mode, **kwargs)
+
     @contextmanager
-    def add_hdf5(ex, description='', alias=None):
+    def add_hdf5(ex, description='', alias=None, complevel=5, complib='zlib',
+                 shuffle=True, filters=None, **kwargs):
+        """Create an HDF5 file with PyTables and add it to the repository.
+
+        Use this as a with statement, which gives the open PyTables
+        file::
+
+            with add_hdf5(ex, description='coverage') as h5file:
+                a = h5file.createEArray('/', 'coverage', tables.Float64Atom(),
+                                        (0,), chunkshape=(65536,))
+                for block in blocks:
+                    a.append(block)
+
+        The file is closed and added when the block ends, unless it
+        raised an exception.  Arrays and tables are compressed by
+        default with *complib* at level *complevel* (0 for none),
+        after a byte *shuffle*; pass a ``tables.Filters`` as *filters*
+        to set them all at once.  Extendable arrays and tables are
+        stored in chunks and can be written a block at a time; pass
+        *chunkshape* to the functions creating them to choose the
+        chunks.  Other keyword arguments, such as the chunk cache's
+        ``CHUNK_CACHE_SIZE``, are passed on to PyTables when the file
+        is opened.  The file is stored uncompressed in the repository,
+        since HDF5 compresses it internally, so ``use_hdf5`` can read
+        it in place.
+        """
         if isinstance(description,dict): description = str(description)
-        h5filename = unique_filename_in()
-        db = h5.openFile(h5filename, 'w', title=description)
+        if filters == None:
+            filters = h5.Filters(complevel=complevel, complib=complib, shuffle=shuffle)
+        h5filename = unique_filename_in(ex.working_directory)
+        db = _open_hdf5(os.path.join(ex.working_directory, h5filename), 'w',
+                        title=description, filters=filters, **kwargs)
+        try:
+            yield db
+        finally:
+            db.close()
+        ex.add(h5filename, description=description, alias=alias, compress=False)
+
+    @contextmanager
+    def use_hdf5(ex_or_lims, id_or_alias, **kwargs):
+        """Open the HDF5 file *id_or_alias* read only with PyTables.
+
+        *ex_or_lims* may be either an execution object or a MiniLIMS
+        object.  Use this as a with statement, which gives the open
+        PyTables file and closes it at the end::
+
+            with use_hdf5(M, 'coverage') as h5file:
+                chunk = h5file.root.coverage[1000000:2000000]
+
+        The file is opened where it is in the repository, without
+        copying it, and only the parts sliced are read, so any number
+        of processes can read large files at once.  Keyword arguments
+        are passed on to PyTables.
+        """
+        db = _open_hdf5(_lims_of(ex_or_lims).path_to_file(id_or_alias), 'r', **kwargs)
         try:
             yield db
         finally:
             db.close()
-            ex.add(db, description=description, alias=alias)
 except:
     print >>sys.stderr, "PyTables not found.  Skipping."
 
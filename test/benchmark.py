@@ -0,0 +1,258 @@
+"""Benchmarks for MiniLIMS and program dispatch on large repositories.
+
+Builds synthetic MiniLIMS repositories holding N files and N
+executions for each size given, times the common operations on each,
+and writes the results as JSON.  If a baseline from an earlier run is
+given, every timing more than a tolerance slower than the baseline is
+reported as a regression, and the script exits with status 1.
+
+    python benchmark.py --sizes 1000,10000 --output new.json
+    python benchmark.py --sizes 1000,10000 --baseline new.json
+
+Timings are seconds per operation, the median over --repeat runs of
+--ops operations each.  Building repositories of 10^6 files takes a
+while; pass --workdir to keep them between runs.
+"""
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import platform
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bein
+from bein import *
+
+@program
+def true():
+    return {'arguments': ['true'],
+            'return_value': None}
+
+def make_repository(path, n):
+    """Create a MiniLIMS at *path* with *n* files and *n* executions.
+
+    Rows are inserted directly, and blobs are empty files, so building
+    even large repositories is mostly bound by creating the blobs.
+    Every execution ran one program.  Half the files were created by
+    the first half of the executions, one each, and the rest were
+    imported.  A quarter of the files have dictionary descriptions.
+    """
+    M = MiniLIMS(path)
+    if M.db.execute("select count(*) from file").fetchone()[0] >= n:
+        return M
+    now = int(time.time())
+    M.db.executemany("""insert into execution(id,started_at,finished_at,
+                                              working_directory,description)
+                        values (?,?,?,?,?)""",
+                     ((i, now, now, '/scratch/ex%d' % i, 'synthetic execution %d' % i)
+                      for i in xrange(1, n+1)))
+    M.db.executemany("""insert into program(pos,execution,pid,return_code,stdout,stderr)
+                        values (0,?,?,0,'','')""",
+                     ((i, i) for i in xrange(1, n+1)))
+    M.db.executemany("""insert into argument(pos,program,execution,argument)
+                        values (0,0,?,?)""",
+                     ((i, 'tool%d' % i) for i in xrange(1, n+1)))
+    def description(i):
+        if i % 4 == 0:
+            return str({'sample': i, 'kind': 'fastq'})
+        else:
+            return 'synthetic file %d' % i
+    M.db.executemany("""insert into file(id,external_name,repository_name,
+                                         description,origin,origin_value)
+                        values (?,?,?,?,?,?)""",
+                     ((i, 'file%d' % i, 'syn%08d' % i, description(i),
+                       i % 2 and 'execution' or 'import', i % 2 and (i+1)/2 or None)
+                      for i in xrange(1, n+1)))
+    M.db.commit()
+    for i in xrange(1, n+1):
+        open(os.path.join(M.file_path, 'syn%08d' % i), 'w').close()
+    return M
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)/2]
+
+def timed(f, setup, ops, repeat):
+    """Median seconds per operation of *f* over *repeat* runs of *ops* operations.
+
+    *setup* is called before each run and its value passed to *f*;
+    only *f* is timed.
+    """
+    runs = []
+    for r in range(repeat):
+        state = setup()
+        start = time.time()
+        f(state)
+        runs.append((time.time() - start) / ops)
+    return median(runs)
+
+def run_benchmarks(M, n, ops, repeat, scratch):
+    """Time each operation on the MiniLIMS *M* holding *n* files."""
+    results = {}
+    source = os.path.join(scratch, 'source')
+    with open(source, 'w') as f:
+        f.write('x' * 4096)
+    def nothing():
+        return None
+
+    imported = []
+    def import_files(state):
+        for i in range(ops):
+            imported.append(M.import_file(source))
+    results['import_file'] = timed(import_files, nothing, ops, repeat)
+
+    def use_files(state):
+        # Not execution(M): recording the uses would make the
+        # imported files immutable, and they could not be deleted.
+        with execution(None) as ex:
+            ex.lims = M
+            for i in imported[:ops]:
+                ex.use(i)
+    results['use'] = timed(use_files, nothing, ops, repeat)
+
+    written = []
+    def write_execution(state):
+        with execution(M) as ex:
+            for i in range(ops):
+                name = unique_filename_in()
+                shutil.copyfile(source, name)
+                ex.add(name)
+        written.append(ex.id)
+    results['write'] = timed(write_execution, nothing, ops, repeat)
+
+    def fetch_executions(ids):
+        for i in ids:
+            M.fetch_execution(i)
+    results['fetch_execution'] = timed(fetch_executions,
+                                       lambda: [random.randint(1, n) for i in range(ops)],
+                                       ops, repeat)
+
+    def search_files_text(state):
+        for i in range(ops):
+            M.search_files(with_text='file%d' % random.randint(1, n))
+    results['search_files'] = timed(search_files_text, nothing, ops, repeat)
+
+    def search_files_dict(state):
+        for i in range(ops):
+            M.search_files(with_description={'sample': 4*random.randint(1, n/4 or 1)})
+    results['search_files_dict'] = timed(search_files_dict, nothing, ops, repeat)
+
+    def search_executions(state):
+        for i in range(ops):
+            M.search_executions(with_text='tool%d' % random.randint(1, n))
+    results['search_executions'] = timed(search_executions, nothing, ops, repeat)
+
+    def make_executions():
+        ids = []
+        for i in range(ops):
+            with execution(M) as ex:
+                name = unique_filename_in()
+                shutil.copyfile(source, name)
+                ex.add(name)
+            ids.append(ex.id)
+        return ids
+    def delete_executions(ids):
+        for i in ids:
+            M.delete_execution(i)
+    results['delete_execution'] = timed(delete_executions, make_executions, ops, repeat)
+    results['delete_executions'] = timed(M.delete_executions, make_executions, ops, repeat)
+
+    def fan_out(state):
+        with execution(None) as ex:
+            futures = [true.nonblocking(ex) for i in range(ops)]
+            for f in futures:
+                f.wait()
+    results['nonblocking'] = timed(fan_out, nothing, ops, repeat)
+
+    M.delete_executions(written)
+    M.delete_files(imported)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Return the (size, operation, baseline, new) which got slower than *tolerance* allows."""
+    regressions = []
+    for size, timings in sorted(results['results'].items()):
+        for operation, t in sorted(timings.items()):
+            try:
+                b = baseline['results'][size][operation]
+            except KeyError:
+                continue
+            if t > b * (1 + tolerance):
+                regressions.append((size, operation, b, t))
+    return regressions
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default="1000",
+                      help="Comma separated repository sizes [default: %default]")
+    parser.add_option("--ops", type="int", default=20,
+                      help="Operations timed per run [default: %default]")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="Runs per benchmark; the median is kept [default: %default]")
+    parser.add_option("--output", default="bench_output.json",
+                      help="Where to write the results [default: %default]")
+    parser.add_option("--baseline", default=None,
+                      help="Earlier results to compare against")
+    parser.add_option("--tolerance", type="float", default=0.25,
+                      help="Allowed slowdown relative to the baseline [default: %default]")
+    parser.add_option("--workdir", default=None,
+                      help="Directory to build (and keep) the repositories in")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Random seed [default: %default]")
+    (options, args) = parser.parse_args(argv)
+
+    random.seed(options.seed)
+    if options.workdir == None:
+        workdir = tempfile.mkdtemp(prefix='bein-benchmark')
+    else:
+        workdir = os.path.abspath(options.workdir)
+        if not(os.path.exists(workdir)):
+            os.makedirs(workdir)
+    results = {'meta': {'bein': bein.__version__,
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+                        'ops': options.ops,
+                        'repeat': options.repeat},
+               'results': {}}
+    cwd = os.getcwd()
+    try:
+        for n in [int(x) for x in options.sizes.split(',')]:
+            scratch = os.path.join(workdir, 'scratch%d' % n)
+            if not(os.path.exists(scratch)):
+                os.mkdir(scratch)
+            os.chdir(scratch)
+            start = time.time()
+            M = make_repository(os.path.join(workdir, 'lims%d' % n), n)
+            print >>sys.stderr, "Repository of %d files ready in %.1fs." % (n, time.time()-start)
+            results['results'][str(n)] = run_benchmarks(M, n, options.ops,
+                                                        options.repeat, scratch)
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        if options.workdir == None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for size, timings in sorted(results['results'].items()):
+        for operation, t in sorted(timings.items()):
+            print "%10s %-20s %12.6f s/op" % (size, operation, t)
+
+    if options.baseline != None:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.tolerance)
+        for (size, operation, b, t) in regressions:
+            print "REGRESSION %s %s: %.6f -> %.6f s/op (%+.0f%%)" % \
+                (size, operation, b, t, 100*(t/b - 1))
+        if regressions != []:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,5 @@
 import os
+import time
 from unittest2 import TestCase, TestSuite, main, TestLoader
 
 from bein import *
@@ -16,6 +17,47 @@ def add_file(ex):
     touch(ex, "boris")
     ex.add("boris", description="test")
 
+@task
+def add_named(ex, name, contents):
+    with open(name, 'w') as f:
+        f.write(contents)
+    ex.add(name, description=name)
+    return time.time()
+
+@task
+def concatenate(ex, fileids):
+    parts = []
+    for i in fileids:
+        with open(ex.use(i)) as f:
+            parts.append(f.read())
+    return "".join(parts)
+
+@task
+def wait_then_fail(ex, seconds):
+    time.sleep(seconds)
+    raise ValueError("Failing on purpose.")
+
+@task
+def sleep_for(ex, seconds):
+    started = time.time()
+    time.sleep(seconds)
+    return (started, time.time())
+
+@task
+def add_named_here(ex, name, contents):
+    with open(os.path.join(ex.working_directory, name), 'w') as f:
+        f.write(contents)
+    ex.add(name, description=name)
+    return os.getcwd()
+
+@task
+def concatenate_here(ex, fileids):
+    parts = []
+    for i in fileids:
+        with open(os.path.join(ex.working_directory, ex.use(i))) as f:
+            parts.append(f.read())
+    return "".join(parts)
+
 class TestTask(TestCase):
 
     def test_is_in_subdir(self):
@@ -43,6 +85,60 @@ class TestTask(TestCase):
     def test_name_correct(self):
         self.assertEqual(path_is.__name__, "path_is")
 
+class TestWorkflow(TestCase):
+    def test_dependencies_resolved(self):
+        w = Workflow(M)
+        a = w.add(add_named, "a", "boris ")
+        b = w.add(add_named, "b", "hilda")
+        c = w.add(concatenate, [a.output("a"), b.output()])
+        results = w.run()
+        self.assertEqual(results[c]['value'], "boris hilda")
+
+    def test_independent_tasks_overlap(self):
+        w = Workflow(M, max_concurrent=2)
+        a = w.add(sleep_for, 1)
+        b = w.add(sleep_for, 1)
+        results = w.run()
+        (a_start, a_end) = results[a]['value']
+        (b_start, b_end) = results[b]['value']
+        self.assertTrue(a_start < b_end and b_start < a_end)
+
+    def test_concurrency_limit(self):
+        w = Workflow(M, max_concurrent=1)
+        a = w.add(sleep_for, 0.5)
+        b = w.add(sleep_for, 0.5)
+        results = w.run()
+        spans = sorted([results[a]['value'], results[b]['value']])
+        self.assertTrue(spans[0][1] <= spans[1][0])
+
+    def test_failure_skips_dependents(self):
+        w = Workflow(M)
+        bad = w.add(wait_then_fail, 0)
+        after_bad = w.add(sleep_for, 0, after=[bad])
+        good = w.add(add_named, "c", "meep")
+        try:
+            w.run()
+            self.fail("Workflow should have raised WorkflowFailed.")
+        except WorkflowFailed, wf:
+            self.assertEqual(wf.failed.keys(), [bad])
+            self.assertEqual(wf.skipped, [after_bad])
+            self.assertEqual(wf.results.keys(), [good])
+
+    def test_thread_workflow(self):
+        w = Workflow(M, kind='thread')
+        a = w.add(add_named_here, "a", "boris ")
+        b = w.add(add_named_here, "b", "hilda")
+        c = w.add(concatenate_here, [a.output("a"), b.output()])
+        results = w.run()
+        self.assertEqual(results[a]['value'], os.getcwd())
+        self.assertEqual(results[c]['value'], "boris hilda")
+
+    def test_cycle_detected(self):
+        w = Workflow(None)
+        a = w.add(sleep_for, 0)
+        a.after.append(a)
+        self.assertRaises(ValueError, w.run)
+
 if __name__ == '__main__':
     main()
 
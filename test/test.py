@@ -96,26 +96,26 @@ class TestProgramBinding(TestCase):
 class TestUniqueFilenameIn(TestCase):
     def test_state_determines_filename(self):
         with execution(None) as ex:
-            st = random.getstate()
+            st = ex.random.getstate()
             f = unique_filename_in()
-            random.setstate(st)
+            ex.random.setstate(st)
             g = unique_filename_in()
             self.assertEqual(f, g)
 
     def test_unique_filename_exact_match(self):
         with execution(None) as ex:
-            st = random.getstate()
+            st = ex.random.getstate()
             f = touch(ex)
-            random.setstate(st)
+            ex.random.setstate(st)
             g = touch(ex)
             self.assertNotEqual(f, g)
 
     def test_unique_filename_beginnings_match(self):
         with execution(None) as ex:
-            st = random.getstate()
+            st = ex.random.getstate()
             f = unique_filename_in()
             touch(ex, f + 'abcdefg')
-            random.setstate(st)
+            ex.random.setstate(st)
             g = touch(ex)
             self.assertNotEqual(f, g)
 
@@ -208,6 +208,19 @@ class TestMiniLIMS(TestCase):
         #self.assertIs(ex.id,ex_found)
         M.delete_execution(ex.id)
 
+    def test_fetch_executions_without_outputs(self):
+        ids = []
+        for i in range(3):
+            with execution(M) as ex:
+                pass
+            ids.append(ex.id)
+        try:
+            for i in ids:
+                self.assertFalse(M.fetch_execution(i)['immutable'])
+        finally:
+            for i in ids:
+                M.delete_execution(i)
+
 class TestExportFile(TestCase):
     def test_export_file(self):
         filea = M.import_file("../LICENSE")  #file ID
@@ -230,6 +243,13 @@ class TestExportFile(TestCase):
         os.remove(os.path.join(testdir, filename))
         os.remove(os.path.join(testdir, filename +".linked"))
 
+        # An associated file whose row disappeared meanwhile.
+        M.db.execute("delete from file where id=?", (fileb,))
+        M.db.commit()
+        self.assertRaises(ValueError, M.export_file, filea,
+                          os.path.join(testdir, "exportedfile"), with_associated=True)
+        os.remove(os.path.join(testdir, "exportedfile"))
+
 
 @program
 def echo(s):
@@ -358,6 +378,1158 @@ class TestAssociatePreservesFilenames(TestCase):
                 pass
 
 
+@program
+def append_to(marker, filename):
+    return {'arguments': ['sh', '-c', 'echo run >> %s; echo done > %s' % (marker, filename)],
+            'return_value': filename}
+
+@program
+def append_script(marker, filename):
+    return {'arguments': ['append_to', marker, filename],
+            'return_value': filename}
+
+class TestResumableExecution(TestCase):
+    def test_retry_skips_completed_programs(self):
+        marker = os.path.abspath(unique_filename_in())
+        def pipeline(ex, names, fail):
+            names.append(append_to(ex, marker, unique_filename_in()))
+            names.append(touch(ex))
+            if fail:
+                raise ValueError("Failing on purpose.")
+            ex.add(names[0], description="resumed output")
+        first = []
+        second = []
+        try:
+            try:
+                with execution(M, resumable=True) as ex1:
+                    pipeline(ex1, first, True)
+            except ValueError:
+                pass
+            with execution(M, resume=ex1.id) as ex2:
+                pipeline(ex2, second, False)
+            self.assertEqual(first, second)
+            with open(marker) as f:
+                self.assertEqual(f.readlines(), ['run\n'])
+            self.assertEqual(M.fetch_execution(ex2.id)['resumed_from'], ex1.id)
+            self.assertEqual(len(M.fetch_execution(ex2.id)['programs']), 2)
+            [fid] = M.search_files(source=('execution', ex2.id))
+            with open(M.path_to_file(fid)) as f:
+                self.assertEqual(f.read(), 'done\n')
+            self.assertEqual(M.db.execute("select count(*) from checkpoint").fetchone()[0], 0)
+        finally:
+            os.remove(marker)
+            M.delete_execution(ex2.id)
+            M.delete_execution(ex1.id)
+
+    def test_retry_skips_completed_lsf_programs(self):
+        # A stand-in for bsub which runs the job here, in its -cwd.
+        bin_directory = os.path.abspath(unique_filename_in())
+        os.mkdir(bin_directory)
+        with open(os.path.join(bin_directory, 'bsub'), 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'while [ $# -gt 1 ]; do\n'
+                    '    if [ "$1" = -cwd ]; then cd "$2"; fi\n'
+                    '    shift\n'
+                    'done\n'
+                    'exec bash -c "$1"\n')
+        # append_to's sh -c would not survive bsub's command line.  The
+        # runs are counted in a directory: a file would be an input
+        # which changes with each run.
+        with open(os.path.join(bin_directory, 'append_to'), 'w') as f:
+            f.write('#!/bin/sh\ntouch "$1/$$"; echo done > "$2"\n')
+        for f in ['bsub', 'append_to']:
+            os.chmod(os.path.join(bin_directory, f), 0755)
+        marker = os.path.abspath(unique_filename_in())
+        os.mkdir(marker)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_directory + os.pathsep + path
+        try:
+            try:
+                with execution(M, resumable=True) as ex1:
+                    append_script.nonblocking(ex1, marker, 'out', via='lsf').wait()
+                    raise ValueError("Failing on purpose.")
+            except ValueError:
+                pass
+            with execution(M, resume=ex1.id) as ex2:
+                append_script.nonblocking(ex2, marker, 'out', via='lsf').wait()
+                self.assertTrue(os.path.exists('out'))
+            self.assertEqual(len(os.listdir(marker)), 1)
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(bin_directory)
+            shutil.rmtree(marker)
+            M.delete_execution(ex2.id)
+            M.delete_execution(ex1.id)
+
+    def test_changed_input_is_rerun(self):
+        try:
+            try:
+                with execution(M, resumable=True) as ex1:
+                    with open('input', 'w') as f:
+                        f.write('a\n')
+                    count_lines(ex1, 'input')
+                    raise ValueError("Failing on purpose.")
+            except ValueError:
+                pass
+            with execution(M, resume=ex1.id) as ex2:
+                with open('input', 'w') as f:
+                    f.write('a\nb\n')
+                self.assertEqual(count_lines(ex2, 'input'), 2)
+        finally:
+            M.delete_execution(ex2.id)
+            M.delete_execution(ex1.id)
+
+    def test_global_random_is_left_alone(self):
+        try:
+            with execution(M, resumable=True) as ex:
+                seeded = random.Random(ex.seed).getstate()
+                self.assertEqual(ex.random.getstate(), seeded)
+                self.assertNotEqual(random.getstate(), seeded)
+        finally:
+            M.delete_execution(ex.id)
+
+
+class TestResourceAccounting(TestCase):
+    def test_resources_recorded(self):
+        try:
+            with execution(M) as ex:
+                echo(ex, "boris")
+                echo.nonblocking(ex, "hilda").wait()
+            exec_data = M.fetch_execution(ex.id)
+            for p in exec_data['programs']:
+                self.assertTrue(p['started_at'] <= p['finished_at'])
+                self.assertTrue(p['wall_time'] >= 0)
+                self.assertTrue(p['user_time'] >= 0)
+                self.assertTrue(p['max_rss'] > 0)
+            resources = exec_data['resources']
+            self.assertAlmostEqual(resources['wall_time'],
+                                   sum([p['wall_time'] for p in exec_data['programs']]))
+            self.assertEqual(resources['max_rss'],
+                             max([p['max_rss'] for p in exec_data['programs']]))
+        finally:
+            M.delete_execution(ex.id)
+
+    @skipIf(not(os.path.exists('/proc/self/io')), "No /proc/<pid>/io.")
+    def test_io_recorded(self):
+        try:
+            with execution(M) as ex:
+                echo(ex, "boris", stdout="out")
+            [p] = M.fetch_execution(ex.id)['programs']
+            self.assertEqual(p['write_bytes'], len("boris\n"))
+        finally:
+            M.delete_execution(ex.id)
+
+
+class TestExportTrace(TestCase):
+    def test_overlapping_programs_on_separate_slots(self):
+        from bein.util import sleep
+        import json
+        try:
+            with execution(M) as ex:
+                a = sleep.nonblocking(ex, 0.3)
+                b = sleep.nonblocking(ex, 0.3)
+                a.wait()
+                b.wait()
+                sleep(ex, 0)
+            trace_file = unique_filename_in()
+            M.export_trace(ex.id, trace_file)
+            with open(trace_file) as f:
+                events = json.load(f)['traceEvents']
+            os.remove(trace_file)
+            programs = [e for e in events if e['ph'] == 'X' and e['cat'] != 'execution']
+            self.assertEqual(len(programs), 3)
+            self.assertEqual(sorted([e['tid'] for e in programs]), [1, 1, 2])
+            self.assertEqual(sorted([e['cat'] for e in programs]),
+                             ['blocking', 'local', 'local'])
+        finally:
+            M.delete_execution(ex.id)
+
+
+class TestMetrics(TestCase):
+    def test_memory_sink_collects(self):
+        from bein import metrics
+        sink = metrics.MemorySink()
+        metrics.add_sink(sink)
+        try:
+            with execution(M) as ex:
+                touch(ex, "boris")
+                ex.add("boris")
+            M.search_files(source=('execution', ex.id))
+        finally:
+            metrics.remove_sink(sink)
+            M.delete_execution(ex.id)
+        self.assertEqual(sink.counters['program.runs'], 1)
+        for name in ['program.launch', 'program.run', 'lims.write',
+                     'lims.import_move', 'lims.search_files', 'unique_filename_in']:
+            self.assertTrue(name in sink.timings, name)
+        self.assertEqual(sink.histograms['lims.import_bytes'], [0])
+
+    def test_disabled_records_nothing(self):
+        from bein import metrics
+        sink = metrics.MemorySink()
+        metrics.add_sink(sink)
+        metrics.remove_sink(sink)
+        with execution(None) as ex:
+            touch(ex)
+        self.assertEqual(sink.timings, {})
+        self.assertFalse(metrics.enabled())
+
+    def test_log_sink(self):
+        from bein import metrics
+        from StringIO import StringIO
+        log = StringIO()
+        sink = metrics.LogSink(log)
+        metrics.add_sink(sink)
+        try:
+            metrics.increment('boris', 2)
+        finally:
+            metrics.remove_sink(sink)
+        self.assertTrue(log.getvalue().endswith(" counter boris 2\n"))
+
+
+class TestChecksums(TestCase):
+    def test_checksum_matches_hashlib(self):
+        import hashlib
+        with open('../LICENSE', 'rb') as f:
+            contents = f.read()
+        self.assertEqual(checksum('../LICENSE'), hashlib.md5(contents).hexdigest())
+        self.assertEqual(checksum('../LICENSE', 'sha256', buffer_size=100),
+                         hashlib.sha256(contents).hexdigest())
+
+    def test_checksums_keep_order(self):
+        files = ['../LICENSE', '../README', 'test.py']
+        self.assertEqual(checksums(files, 'sha1', workers=2),
+                         [checksum(f, 'sha1') for f in files])
+
+    def test_util_md5sum(self):
+        from bein.util import md5sum
+        with execution(None) as ex:
+            with open('boris', 'w') as f:
+                f.write('boris\n')
+            self.assertEqual(md5sum(ex, 'boris'), checksum('boris'))
+            self.assertEqual(md5sum.nonblocking(ex, 'boris').wait(), checksum('boris'))
+            self.assertEqual(ex.programs, [])
+            self.assertEqual(md5sum(ex, 'boris', record=True), checksum('boris'))
+            self.assertEqual(md5sum.nonblocking(ex, 'boris', via='local').wait(),
+                             checksum('boris'))
+            self.assertEqual([p.arguments[:2] for p in ex.programs],
+                             [['openssl', 'md5']] * 2)
+            self.assertRaises(TypeError, md5sum.nonblocking, ex, 'boris', bogus=1)
+
+    def test_digest_recorded_and_verified(self):
+        fid = M.import_file('../LICENSE')
+        try:
+            self.assertEqual(M.fetch_file(fid)['digest'], 'md5:' + checksum('../LICENSE'))
+            self.assertTrue(M.verify_file(fid))
+            self.assertTrue(M.verify_file(fid, full=True))
+            with open(M.path_to_file(fid), 'a') as f:
+                f.write('corruption')
+            self.assertFalse(M.verify_file(fid))
+        finally:
+            M.delete_file(fid)
+
+
+class TestFsck(TestCase):
+    def test_fsck_finds_and_repairs(self):
+        L = MiniLIMS("fsck_lims")
+        try:
+            good = L.import_file('../LICENSE')
+            missing = L.import_file('../README')
+            corrupted = L.import_file('test.py')
+            os.remove(L.path_to_file(missing))
+            with open(L.path_to_file(corrupted), 'a') as f:
+                f.write('corruption')
+            with open(os.path.join(L.file_path, 'orphan'), 'w') as f:
+                f.write('orphan')
+            os.utime(os.path.join(L.file_path, 'orphan'), (0, 0))
+            # Too young to be an orphan: it may be in flight.
+            with open(os.path.join(L.file_path, 'young'), 'w') as f:
+                f.write('young')
+            os.utime(L.path_to_file(good), (0, 0))
+            checked = []
+            report = L.fsck(full=True, batch_size=2,
+                            progress=lambda n, total: checked.append((n, total)))
+            self.assertEqual(checked, [(2, 3), (3, 3)])
+            self.assertEqual(report['missing'], [missing])
+            self.assertEqual(report['corrupted'], [corrupted])
+            self.assertEqual(report['orphans'], ['orphan'])
+            self.assertEqual(report['quarantined'], [])
+            report = L.fsck(repair=True)
+            self.assertEqual(report['refreshed'], [good])
+            self.assertEqual(report['quarantined'], ['orphan'])
+            self.assertTrue(os.path.exists('fsck_lims.quarantine/orphan'))
+            self.assertTrue(os.path.exists(os.path.join(L.file_path, 'young')))
+            self.assertEqual(L.fsck()['orphans'], [])
+            self.assertEqual(L.fsck(min_age=0)['orphans'], ['young'])
+        finally:
+            L.remove()
+            shutil.rmtree('fsck_lims.quarantine', ignore_errors=True)
+
+    def test_fsck_resumes_from_state_file(self):
+        import json
+        L = MiniLIMS("fsck_lims")
+        try:
+            ids = [L.import_file('../LICENSE') for i in range(3)]
+            os.remove(L.path_to_file(ids[0]))
+            with open('fsck_state', 'w') as f:
+                json.dump({'last_id': ids[1], 'checked': 2, 'missing': [ids[0]],
+                           'corrupted': [], 'unverified': [], 'refreshed': []}, f)
+            report = L.fsck(state_file='fsck_state')
+            self.assertEqual(report['checked'], 3)
+            self.assertEqual(report['missing'], [ids[0]])
+            self.assertFalse(os.path.exists('fsck_state'))
+        finally:
+            L.remove()
+
+    def test_moved_in_blobs_are_young(self):
+        from bein import fsck
+        L = MiniLIMS("fsck_lims")
+        try:
+            with open('old_output', 'w') as f:
+                f.write('old\n')
+            os.utime('old_output', (0, 0))
+            # Moved in, but its row not recorded yet.
+            (name, _, _, mtime, _) = L._import_blob('old_output', move=True)
+            self.assertFalse(os.path.exists('old_output'))
+            self.assertTrue(mtime > 0)
+            self.assertEqual(L.fsck(repair=True)['orphans'], [])
+            self.assertTrue(os.path.exists(os.path.join(L.file_path, name)))
+            self.assertEqual(fsck.main(['fsck_lims']), 0)
+            self.assertEqual(fsck.main(['--min-age', '0', 'fsck_lims']), 1)
+        finally:
+            L.remove()
+
+class TestCompression(TestCase):
+    def test_compressed_files_read_back_unchanged(self):
+        L = MiniLIMS("compression_lims")
+        try:
+            with open('../LICENSE') as f:
+                contents = f.read()
+            fid = L.import_file('../LICENSE', compress='gzip')
+            self.assertEqual(L.fetch_file(fid)['compression'], 'gzip')
+            self.assertTrue(os.path.getsize(os.path.join(L.file_path,
+                                                         L.fetch_file(fid)['repository_name'])) \
+                                < len(contents))
+            f = L.open_file(fid)
+            try:
+                self.assertEqual(f.read(), contents)
+            finally:
+                f.close()
+            with open(L.path_to_file(fid)) as f:
+                self.assertEqual(f.read(), contents)
+            L.export_file(fid, 'exported_license')
+            with open('exported_license') as f:
+                self.assertEqual(f.read(), contents)
+            self.assertTrue(L.verify_file(fid, full=True))
+            with execution(L) as ex:
+                with open(ex.use(fid)) as f:
+                    self.assertEqual(f.read(), contents)
+            copy = L.copy_file(fid)
+            self.assertEqual(L.fetch_file(copy)['compression'], 'gzip')
+            self.assertTrue(L.verify_file(copy, full=True))
+        finally:
+            L.remove()
+            if os.path.exists('exported_license'):
+                os.remove('exported_license')
+
+    def test_compression_policy(self):
+        L = MiniLIMS("compression_lims")
+        try:
+            L.compression_policy = {'.txt': 'gzip'}
+            with execution(L) as ex:
+                with open('policy.txt', 'w') as f:
+                    f.write('compress me\n')
+                with open('policy.dat', 'w') as f:
+                    f.write('leave me\n')
+                ex.add('policy.txt')
+                ex.add('policy.dat')
+                ex.add('policy.dat', compress='gzip')
+            [t] = L.search_files(source=('execution', ex.id), with_text='policy.txt')
+            ds = L.search_files(source=('execution', ex.id), with_text='policy.dat')
+            self.assertEqual(L.fetch_file(t)['compression'], 'gzip')
+            self.assertEqual(sorted([L.fetch_file(d)['compression'] for d in ds]),
+                             [None, 'gzip'])
+            self.assertRaises(ValueError, L.import_file, '../LICENSE', compress='lzma')
+        finally:
+            L.remove()
+
+
+class TestGc(TestCase):
+    def test_gc_removes_dangling_rows_and_orphans(self):
+        L = MiniLIMS("gc_lims")
+        try:
+            a = L.import_file('../LICENSE')
+            b = L.import_file('../README')
+            L.delete_file(a)
+            L.db.execute("""insert into file_association(fileid,associated_to,template)
+                            values (?,?,'%s.license')""", (a, b))
+            L.db.execute("insert into execution_use(execution,file) values (1000,?)", (b,))
+            L.db.commit()
+            with open(os.path.join(L.file_path, 'orphan'), 'w') as f:
+                f.write('x' * 1000)
+            with open(os.path.join(L.file_path, 'young'), 'w') as f:
+                f.write('x')
+            os.utime(os.path.join(L.file_path, 'orphan'), (0, 0))
+            report = L.gc()
+            self.assertEqual(report['file_association'], 1)
+            self.assertEqual(report['execution_use'], 1)
+            self.assertEqual(report['orphans'], ['orphan'])
+            self.assertEqual(report['blob_bytes'], 1000)
+            self.assertTrue(os.path.exists(os.path.join(L.file_path, 'young')))
+            self.assertEqual(L.db.execute("pragma auto_vacuum").fetchone()[0], 2)
+            self.assertTrue(os.path.exists(L.path_to_file(b)))
+            self.assertEqual(L.gc(min_age=0)['orphans'], ['young'])
+        finally:
+            L.remove()
+
+    def test_gc_shrinks_database(self):
+        L = MiniLIMS("gc_lims")
+        try:
+            ids = [L.import_file('../LICENSE', description='x' * 10000) for i in range(50)]
+            for i in ids:
+                L.delete_file(i)
+            report = L.gc()
+            self.assertTrue(report['database_bytes'] > 50*10000/2)
+            self.assertEqual(report['reclaimed_bytes'],
+                             report['database_bytes'] + report['blob_bytes'])
+        finally:
+            L.remove()
+
+
+class TestImportFiles(TestCase):
+    def test_import_files(self):
+        L = MiniLIMS("import_files_lims")
+        try:
+            paths = ['../LICENSE', '../README', 'test.py']
+            ids = L.import_files(paths, descriptions=['license', {'a': 1}, 'tests'],
+                                 aliases={'test.py': 'the tests'}, workers=2)
+            self.assertEqual(len(ids), 3)
+            self.assertEqual([L.fetch_file(i)['external_name'] for i in ids],
+                             ['LICENSE', 'README', 'test.py'])
+            self.assertEqual(L.fetch_file(ids[1])['description'], str({'a': 1}))
+            self.assertEqual(L.resolve_alias('the tests'), ids[2])
+            for (p, i) in zip(paths, ids):
+                self.assertEqual(L.fetch_file(i)['digest'], 'md5:' + checksum(p))
+        finally:
+            L.remove()
+
+    def test_import_files_is_all_or_nothing(self):
+        L = MiniLIMS("import_files_lims")
+        try:
+            self.assertRaises(IOError, L.import_files,
+                              ['../LICENSE', 'nonexistent', '../README'])
+            self.assertEqual(L.search_files(), [])
+            self.assertEqual(os.listdir(L.file_path), [])
+            L.add_alias(L.import_file('../LICENSE'), 'taken')
+            self.assertRaises(sqlite3.IntegrityError, L.import_files,
+                              ['../README', 'test.py'], aliases=['free', 'taken'])
+            self.assertEqual(len(L.search_files()), 1)
+            self.assertEqual(len(os.listdir(L.file_path)), 1)
+        finally:
+            L.remove()
+
+
+class TestBulkDelete(TestCase):
+    def test_delete_executions(self):
+        L = MiniLIMS("delete_lims")
+        try:
+            exids = []
+            for i in range(3):
+                with execution(L) as ex:
+                    touch(ex, "boris")
+                    ex.add("boris")
+                    touch(ex, "boris.idx")
+                    ex.add("boris.idx", associate_to_filename="boris", template="%s.idx")
+                exids.append(ex.id)
+            [used] = L.search_files(source=('execution', exids[0]), with_text='boris.idx')
+            with execution(L) as user:
+                user.use(used)
+            self.assertRaises(sqlite3.IntegrityError, L.delete_executions, exids)
+            self.assertEqual(len(L.search_files()), 6)
+            self.assertEqual(len(os.listdir(L.file_path)), 6)
+            # Deleting the execution which made them immutable with them.
+            L.delete_executions(exids + [user.id])
+            self.assertEqual(L.search_files(), [])
+            self.assertEqual(L.search_executions(), [])
+            self.assertEqual(os.listdir(L.file_path), [])
+            self.assertEqual(L.db.execute("select count(*) from file_association").fetchone()[0], 0)
+            self.assertEqual(L.db.execute("select count(*) from sqlite_master where type='trigger'").fetchone()[0], 9)
+        finally:
+            L.remove()
+
+    def test_delete_files_follows_associations(self):
+        L = MiniLIMS("delete_lims")
+        try:
+            a = L.import_file('../LICENSE')
+            b = L.import_file('../README')
+            c = L.import_file('test.py')
+            L.associate_file(b, a, '%s.b')
+            L.associate_file(c, b, '%s.c')
+            L.add_alias(c, 'c')
+            L.delete_files([a])
+            self.assertEqual(L.search_files(), [])
+            self.assertEqual(L.db.execute("select count(*) from file_alias").fetchone()[0], 0)
+        finally:
+            L.remove()
+
+
+class TestCopyOnWrite(TestCase):
+    def test_copies_share_blobs_until_written(self):
+        L = MiniLIMS("cow_lims")
+        try:
+            with open('../LICENSE') as f:
+                contents = f.read()
+            original = L.import_file('../LICENSE')
+            copy = L.copy_file(original)
+            self.assertEqual(L.fetch_file(copy)['origin'], ('copy', original))
+            self.assertEqual(L.path_to_file(copy), L.path_to_file(original))
+            self.assertEqual(len(os.listdir(L.file_path)), 1)
+            # Plain path_to_file must not be used to write to it.
+            self.assertEqual(os.stat(L.path_to_file(copy)).st_mode & 0222, 0)
+            with open(L.path_to_file(copy, writable=True), 'a') as f:
+                f.write('changed')
+            self.assertNotEqual(L.path_to_file(copy), L.path_to_file(original))
+            self.assertEqual(L.fetch_file(copy)['digest'], None)
+            with open(L.path_to_file(original)) as f:
+                self.assertEqual(f.read(), contents)
+            self.assertTrue(L.verify_file(original, full=True))
+            again = L.copy_file(original)
+            L.delete_file(original)
+            with open(L.path_to_file(again)) as f:
+                self.assertEqual(f.read(), contents)
+            # Shared no more, so writable in place.
+            path = L.path_to_file(again)
+            self.assertEqual(L.path_to_file(again, writable=True), path)
+            self.assertTrue(os.stat(path).st_mode & 0200)
+            L.delete_file(again)
+            self.assertEqual(len(os.listdir(L.file_path)), 1)
+        finally:
+            L.remove()
+
+    def test_copies_have_their_own_contents(self):
+        L = MiniLIMS("cow_lims")
+        try:
+            with open('../LICENSE') as f:
+                contents = f.read()
+            original = L.import_file('../LICENSE')
+            copy = L.copy_file(original, share=False)
+            self.assertEqual(L.fetch_file(copy)['origin'], ('copy', original))
+            self.assertNotEqual(L.path_to_file(copy), L.path_to_file(original))
+            self.assertTrue(L.verify_file(copy, full=True))
+            with open(L.path_to_file(copy), 'a') as f:
+                f.write('changed')
+            with open(L.path_to_file(original)) as f:
+                self.assertEqual(f.read(), contents)
+        finally:
+            L.remove()
+
+    def test_writable_compressed_file_leaves_no_blob_behind(self):
+        L = MiniLIMS("cow_lims")
+        try:
+            fid = L.import_file('../LICENSE', compress='gzip')
+            L.path_to_file(fid)
+            with open(L.path_to_file(fid, writable=True), 'a') as f:
+                f.write('changed')
+            self.assertEqual(L.fetch_file(fid)['compression'], None)
+            self.assertEqual([f for f in os.listdir(L.file_path) if not(f.startswith('.'))],
+                             [L.fetch_file(fid)['repository_name']])
+            self.assertEqual(os.listdir(os.path.join(L.file_path, '.cache')), [])
+        finally:
+            L.remove()
+
+    def test_immutable_files_are_not_writable(self):
+        L = MiniLIMS("cow_lims")
+        try:
+            fid = L.import_file('../LICENSE')
+            with execution(L) as ex:
+                ex.use(fid)
+            self.assertRaises(ValueError, L.path_to_file, fid, writable=True)
+            copy = L.copy_file(fid)
+            self.assertTrue(os.path.exists(L.path_to_file(copy, writable=True)))
+        finally:
+            L.remove()
+
+
+class TestExecutionsInThreads(TestCase):
+    def test_concurrent_executions_without_chdir(self):
+        import threading
+        from bein.util import add_pickle, use_pickle
+        cwd = os.getcwd()
+        results = {}
+        def run(name):
+            with execution(M, chdir=False) as ex:
+                filename = touch(ex)
+                self.assertTrue(os.path.exists(os.path.join(ex.working_directory, filename)))
+                ex.add(filename, description=name)
+                touch(ex, 'out', stdout='captured')
+                self.assertTrue(os.path.exists(os.path.join(ex.working_directory, 'captured')))
+                add_pickle(ex, name, description=name + ' pickle')
+                results[name] = ex
+        threads = [threading.Thread(target=run, args=('thread%d' % i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        try:
+            self.assertEqual(os.getcwd(), cwd)
+            self.assertEqual(sorted(results.keys()), ['thread%d' % i for i in range(4)])
+            for name, ex in results.items():
+                self.assertEqual(len(M.search_files(source=('execution', ex.id))), 2)
+                [p] = M.search_files(source=('execution', ex.id), with_text='pickle')
+                self.assertEqual(use_pickle(M, p), name)
+                self.assertFalse(os.path.exists(ex.working_directory))
+        finally:
+            M.delete_executions([ex.id for ex in results.values()])
+
+    def test_writes_wait_for_the_lock(self):
+        import threading
+        fid = M.import_file('../LICENSE')
+        other = M.import_file('../README')
+        try:
+            calls = [(M.add_alias, (fid, 'locked_alias')),
+                     (M.associate_file, (other, fid, '%s.locked')),
+                     (M.delete_file_association, (other, fid)),
+                     (M.delete_alias, ('locked_alias',))]
+            for (method, args) in calls:
+                with M._lock:
+                    t = threading.Thread(target=method, args=args)
+                    t.start()
+                    t.join(0.2)
+                    self.assertTrue(t.is_alive())
+                t.join()
+            self.assertEqual(M.associated_files_of(fid), [])
+        finally:
+            M.delete_files([fid, other])
+
+
+class TestFinalization(TestCase):
+    def test_added_files_are_moved(self):
+        with execution(M) as ex:
+            with open('moved', 'w') as f:
+                f.write('moved\n')
+            inode = os.stat('moved').st_ino
+            ex.add('moved')
+            ex.add('moved', description='second')
+        try:
+            fids = M.search_files(source=('execution', ex.id))
+            inodes = [os.stat(M.path_to_file(i)).st_ino for i in fids]
+            self.assertTrue(inode in inodes)
+            self.assertEqual(len(set(inodes)), 2)
+            for i in fids:
+                self.assertTrue(M.verify_file(i, full=True))
+        finally:
+            M.delete_execution(ex.id)
+
+    def test_working_directory_base(self):
+        os.mkdir('scratch_base')
+        base = os.path.abspath('scratch_base')
+        try:
+            with execution(None, working_directory_base='scratch_base') as ex:
+                self.assertEqual(os.path.dirname(ex.working_directory), base)
+                touch(ex, 'boris')
+            self.assertFalse(os.path.exists(ex.working_directory))
+            wait_for_cleanup()
+            self.assertEqual(os.listdir('scratch_base'), [])
+        finally:
+            shutil.rmtree('scratch_base')
+
+
+    def test_old_outputs_survive_gc_before_recording(self):
+        L = MiniLIMS("finalization_lims")
+        try:
+            os.mkdir('old_outputs')
+            ex = Execution(L, os.path.abspath('old_outputs'))
+            for f in ['output', 'output.idx']:
+                with open(os.path.join('old_outputs', f), 'w') as g:
+                    g.write(f + '\n')
+                os.utime(os.path.join('old_outputs', f), (0, 0))
+            ex.add('output')
+            ex.add('output.idx', associate_to_filename='output', template='%s.idx')
+            ex.finish()
+            blobs = L._store_blobs(ex, move=True)
+            # A gc between storing the blobs and recording them.
+            self.assertEqual(L.gc()['orphans'], [])
+            exid = L._record_execution(L._execution_record(ex, "", None, blobs))
+            for fid in L.search_files(source=('execution', exid)):
+                self.assertTrue(L.verify_file(fid))
+            self.assertEqual(L.gc()['orphans'], [])
+        finally:
+            shutil.rmtree('old_outputs')
+            L.remove()
+
+
+class TestStaging(TestCase):
+    def test_staged_files(self):
+        with execution(M, stage=True) as ex:
+            with open('compressed', 'w') as f:
+                f.write('compress me\n' * 100)
+            ex.add('compressed', description='compressed', compress='gzip')
+            with open('moved', 'w') as f:
+                f.write('moved\n')
+            ex.add('moved', description='moved')
+            with open('changed', 'w') as f:
+                f.write('before\n')
+            ex.add('changed', description='changed', compress='gzip')
+            # Let the staging copy finish before changing the file.
+            [entry] = [e for e in ex.files if e[0] == 'changed']
+            entry[7].wait()
+            self.assertEqual(len([f for f in os.listdir(M.staging_path)
+                                  if not(f.startswith('.'))]), 2)
+            time.sleep(1)
+            with open('changed', 'w') as f:
+                f.write('after, and longer\n')
+        try:
+            self.assertEqual(os.listdir(M.staging_path), [])
+            for (description, contents) in [('compressed', 'compress me\n' * 100),
+                                            ('moved', 'moved\n'),
+                                            ('changed', 'after, and longer\n')]:
+                [fid] = M.search_files(source=('execution', ex.id), with_text=description)
+                with open(M.path_to_file(fid)) as f:
+                    self.assertEqual(f.read(), contents)
+                self.assertTrue(M.verify_file(fid, full=True))
+        finally:
+            M.delete_execution(ex.id)
+
+    def test_gc_during_staged_execution(self):
+        with execution(M, stage=True) as ex:
+            with open('staged', 'w') as f:
+                f.write('staged\n' * 100)
+            ex.add('staged', description='staged during gc', compress='gzip')
+            ex.files[-1][7].wait()
+            # As if the execution had been running for a day.
+            [name] = [f for f in os.listdir(M.staging_path) if not(f.startswith('.'))]
+            for path in [os.path.join(M.staging_path, name),
+                         os.path.join(M.file_path, name)]:
+                os.utime(path, (0, 0))
+            # A lease left by an execution which died.
+            dead = os.path.join(M.staging_path, '.dead.lease')
+            with open(dead, 'w') as f:
+                f.write('nothing\n')
+            os.utime(dead, (0, 0))
+            self.assertEqual(M.gc()['orphans'], [])
+            self.assertFalse(os.path.exists(dead))
+            self.assertEqual(M.fsck()['orphans'], [])
+            self.assertTrue(os.path.exists(os.path.join(M.staging_path, name)))
+        try:
+            self.assertEqual(os.listdir(M.staging_path), [])
+            [fid] = M.search_files(source=('execution', ex.id), with_text='staged during gc')
+            self.assertEqual(M.fetch_file(fid)['repository_name'], name)
+            with open(M.path_to_file(fid)) as f:
+                self.assertEqual(f.read(), 'staged\n' * 100)
+            self.assertTrue(M.verify_file(fid, full=True))
+        finally:
+            M.delete_execution(ex.id)
+
+
+class TestScatterGather(TestCase):
+    def test_scatter_gather(self):
+        from bein.util import scatter_gather
+        @program
+        def prefix_lines(filename):
+            return {'arguments': ['sed', 's/^/x/', filename],
+                    'return_value': None}
+        with execution(None) as ex:
+            with open('input', 'w') as f:
+                f.write("".join(["%d\n" % i for i in range(10)]))
+            output = scatter_gather(ex, prefix_lines, 'input', n_lines=3,
+                                    capture_stdout=True, max_concurrent=2)
+            with open(output) as f:
+                self.assertEqual(f.read(), "".join(["x%d\n" % i for i in range(10)]))
+            # split, four pieces, cat
+            self.assertEqual(len(ex.programs), 6)
+            self.assertEqual(ex.programs[-1].arguments[0], 'cat')
+            lengths = scatter_gather(ex, prefix_lines, 'input', n_chunks=2,
+                                     capture_stdout=True,
+                                     merge=lambda ex, fs: [len(open(f).readlines())
+                                                           for f in fs])
+            self.assertEqual(lengths, [5, 5])
+
+    def test_failure(self):
+        from bein.util import scatter_gather
+        @program
+        def fail(filename):
+            return {'arguments': ['false'],
+                    'return_value': None}
+        with execution(None) as ex:
+            with open('input', 'w') as f:
+                f.write("a\nb\n")
+            self.assertRaises(ProgramFailed, scatter_gather, ex, fail, 'input',
+                              n_lines=1)
+
+
+class TestCountLines(TestCase):
+    def test_count_lines(self):
+        from bein import util
+        with execution(None) as ex:
+            with open('a+b.txt', 'w') as f:
+                f.write("line\n" * 1000 + "no newline")
+            with open('empty', 'w') as f:
+                pass
+            self.assertEqual(util.count_lines(ex, 'a+b.txt'), 1000)
+            self.assertEqual(util.count_lines(ex, 'a+b.txt', workers=3, min_range=100), 1000)
+            self.assertEqual(util.count_lines(ex, 'empty', workers=3), 0)
+            self.assertEqual(ex.programs, [])
+            self.assertEqual(util.count_lines(ex, 'a+b.txt', record=True), 1000)
+            self.assertEqual(len(ex.programs), 1)
+            self.assertEqual(util.count_lines.nonblocking(ex, 'a+b.txt').wait(), 1000)
+            self.assertEqual(len(ex.programs), 1)
+            self.assertEqual(util.count_lines.nonblocking(ex, 'a+b.txt', via='local').wait(),
+                             1000)
+            self.assertEqual([p.arguments[0] for p in ex.programs], ['wc', 'wc'])
+            self.assertEqual(util.count_lines_in_files(ex, ['a+b.txt', 'empty', 'a+b.txt'],
+                                                       workers=2),
+                             [1000, 0, 1000])
+
+
+class TestRecords(TestCase):
+    def test_fastq(self):
+        import gzip
+        from bein import util
+        records = ["@r%d\nACGT\n+\nIIII\n" % i for i in range(10)]
+        with execution(None) as ex:
+            f = gzip.GzipFile('reads.fastq.gz', 'wb')
+            f.write("".join(records))
+            f.close()
+            pieces = util.split_records(ex, 'reads.fastq.gz', n_records=4)
+            self.assertEqual([open(p).read() for p in pieces],
+                             ["".join(records[:4]), "".join(records[4:8]),
+                              "".join(records[8:])])
+            pieces = util.split_records(ex, 'reads.fastq.gz', n_bytes=50, compress=True)
+            self.assertEqual(len(pieces), 4)
+            self.assertEqual("".join([gzip.GzipFile(p).read() for p in pieces]),
+                             "".join(records))
+            head = util.head_records(ex, 'reads.fastq.gz', 3)
+            self.assertEqual(open(head).read(), "".join(records[:3]))
+            sample = util.sample_records(ex, 'reads.fastq.gz', 5, seed=1)
+            chosen = list(util.read_records(sample))
+            self.assertEqual(len(chosen), 5)
+            self.assertEqual(chosen, [r for r in records if r in chosen])
+            self.assertEqual(open(util.first_n_lines('reads.fastq.gz', 4)).read(),
+                             records[0])
+            self.assertEqual(ex.programs, [])
+
+    def test_fasta(self):
+        from bein import util
+        records = [">s1\nACGT\nACGT\n", ">s2\nTT\n", ">s3\nGGGG\nCC\nA\n"]
+        with execution(None) as ex:
+            with open('seqs.fa', 'w') as f:
+                f.write("".join(records))
+            self.assertEqual(list(util.read_records('seqs.fa')), records)
+            pieces = util.split_records(ex, 'seqs.fa', n_records=2)
+            self.assertEqual([open(p).read() for p in pieces],
+                             ["".join(records[:2]), records[2]])
+
+
+def _square(x):
+    return x*x
+
+class TestBackground(TestCase):
+    def test_exceptions_reach_wait(self):
+        from bein.util import background
+        def fail():
+            raise KeyError('boris')
+        self.assertRaises(KeyError, background(fail).wait)
+        self.assertRaises(KeyError, background(fail, executor='thread').wait)
+        self.assertEqual(background(_square, 3, executor='thread').wait(), 9)
+        self.assertEqual(background(_square, 4, executor='process').wait(), 16)
+
+    def test_background_map(self):
+        from bein.util import background_map
+        from multiprocessing.pool import ThreadPool
+        self.assertEqual(list(background_map(_square, range(20), workers=3)),
+                         [x*x for x in range(20)])
+        self.assertEqual(sorted(background_map(_square, range(20), kind='process',
+                                               ordered=False)),
+                         [x*x for x in range(20)])
+        def fail(x):
+            if x == 5:
+                raise ValueError(x)
+            return x
+        results = background_map(fail, range(10), workers=2)
+        self.assertEqual([results.next() for i in range(5)], range(5))
+        self.assertRaises(ValueError, results.next)
+        self.assertEqual(list(background_map(_square, range(20))),
+                         [x*x for x in range(20)])
+        pool = ThreadPool(2)
+        try:
+            self.assertEqual(list(background_map(_square, range(5), pool=pool)),
+                             [x*x for x in range(5)])
+            # A pool passed in is left running.
+            self.assertEqual(pool.apply(_square, (3,)), 9)
+        finally:
+            pool.close()
+
+
+# Where python_sum can be imported from, in other interpreters.
+test_directory = os.path.dirname(os.path.abspath(__file__))
+
+@pyprogram
+def python_sum(xs, scale=1):
+    print "summing", len(xs)
+    return sum(xs)*scale
+
+@pyprogram
+def python_fail():
+    raise ValueError('boris')
+
+@pyprogram
+def python_exit():
+    sys.exit(3)
+
+class TestPyprogram(TestCase):
+    def test_pyprogram(self):
+        with execution(None) as ex:
+            self.assertEqual(python_sum(ex, [1, 2, 3]), 6)
+            futures = [python_sum.nonblocking(ex, range(i), scale=2) for i in range(5)]
+            self.assertEqual([f.wait() for f in futures], [0, 0, 2, 6, 12])
+            self.assertRaises(ProgramFailed, python_fail, ex)
+            # The interpreter running the program must find bein and
+            # this module.
+            import bein
+            pythonpath = os.environ.get('PYTHONPATH')
+            os.environ['PYTHONPATH'] = os.pathsep.join(
+                [os.path.dirname(os.path.dirname(os.path.abspath(bein.__file__))),
+                 test_directory])
+            try:
+                via = python_sum._via(ex, 'local', [4])
+                self.assertEqual(via.wait(), 4)
+                self.assertEqual(via.wait(), 4)
+            finally:
+                if pythonpath == None:
+                    del os.environ['PYTHONPATH']
+                else:
+                    os.environ['PYTHONPATH'] = pythonpath
+        self.assertEqual(len(ex.programs), 8)
+        p = ex.programs[0]
+        self.assertEqual(p.arguments, ['test.python_sum', '[1, 2, 3]'])
+        self.assertEqual(p.stdout, ['summing 3\n'])
+        self.assertEqual(p.via, 'blocking')
+        self.assertNotEqual(p.pid, os.getpid())
+        self.assertTrue(p.finished_at >= p.started_at)
+        self.assertEqual(ex.programs[1].arguments[-1], 'scale=2')
+        failed = ex.programs[6]
+        self.assertEqual(failed.return_code, 1)
+        self.assertTrue('ValueError: boris' in "".join(failed.stderr))
+        self.assertEqual(ex.programs[7].arguments, ['test.python_sum', '[4]'])
+        # A zero count of bytes is still a count.
+        self.assertNotEqual(p.read_bytes, None)
+
+    def test_exit_and_repeated_wait(self):
+        with execution(None) as ex:
+            self.assertRaises(ProgramFailed, python_exit, ex)
+            f = python_sum.nonblocking(ex, [1])
+            self.assertEqual(f.wait(), 1)
+            self.assertEqual(f.wait(), 1)
+            # The worker survived the exit.
+            self.assertEqual(python_sum(ex, [2]), 2)
+        self.assertEqual(len(ex.programs), 3)
+        self.assertTrue('SystemExit' in "".join(ex.programs[0].stderr))
+
+    def test_recorded(self):
+        with execution(M) as ex:
+            python_sum(ex, [1])
+        try:
+            [p] = M.fetch_execution(ex.id)['programs']
+            self.assertEqual(p['arguments'], ['test.python_sum', '[1]'])
+            self.assertEqual(p['return_code'], 0)
+        finally:
+            M.delete_execution(ex.id)
+
+
+class TestPickleCache(TestCase):
+    def test_cache(self):
+        from bein.util import add_pickle, use_pickle, pickle_cache
+        with execution(M) as ex:
+            add_pickle(ex, {'a': range(100)}, description='cached pickle')
+        try:
+            [fid] = M.search_files(source=('execution', ex.id))
+            a = use_pickle(M, fid)
+            self.assertEqual(a, {'a': range(100)})
+            self.assertTrue(use_pickle(M, fid) is a)
+            self.assertFalse(use_pickle(M, fid, cache=False) is a)
+            self.assertTrue((M.file_path, fid) in pickle_cache.entries)
+            # Rewriting the file invalidates the entry.
+            import cPickle
+            with open(M.path_to_file(fid, writable=True), 'wb') as f:
+                cPickle.dump('rewritten', f, 2)
+            self.assertEqual(use_pickle(M, fid), 'rewritten')
+        finally:
+            M.delete_execution(ex.id)
+        self.assertFalse((M.file_path, fid) in pickle_cache.entries)
+
+    def test_bound(self):
+        from bein.util import PickleCache
+        c = PickleCache(max_bytes=100)
+        c.put('a', 1, 60, 'A')
+        c.put('b', 1, 30, 'B')
+        self.assertEqual(c.get('a', 1), 'A')
+        c.put('c', 1, 30, 'C')
+        self.assertRaises(KeyError, c.get, 'b', 1)
+        self.assertEqual(c.get('a', 1), 'A')
+        self.assertRaises(KeyError, c.get, 'a', 2)
+        self.assertRaises(KeyError, c.get, 'a', 1)
+        c.put('d', 1, 200, 'D')
+        self.assertRaises(KeyError, c.get, 'd', 1)
+        self.assertEqual(c.bytes, 30)
+        remove_deletion_listener(c._deleted)
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class TestArrays(TestCase):
+    @skipIf(numpy == None, "numpy is not installed")
+    def test_arrays(self):
+        from bein.util import add_array, add_arrays, use_array
+        a = numpy.arange(1000, dtype='float64').reshape((10, 100))
+        with execution(M) as ex:
+            add_array(ex, a, alias='test array')
+            add_arrays(ex, {'a': a, 'b': numpy.ones(3)}, alias='test arrays')
+        try:
+            arrays = use_array(M, 'test arrays')
+            self.assertTrue((arrays['a'] == a).all())
+            self.assertTrue((arrays['b'] == numpy.ones(3)).all())
+            fid = M.resolve_alias('test array')
+            mapped = use_array(M, fid)
+            self.assertTrue(isinstance(mapped, numpy.memmap))
+            self.assertTrue((mapped == a).all())
+            self.assertFalse(isinstance(use_array(M, fid, mmap=False), numpy.memmap))
+        finally:
+            M.delete_execution(ex.id)
+
+
+try:
+    import tables
+except ImportError:
+    tables = None
+
+class TestHdf5(TestCase):
+    @skipIf(tables == None, "PyTables is not installed")
+    def test_hdf5(self):
+        from bein.util import add_hdf5, use_hdf5
+        with execution(M) as ex:
+            with add_hdf5(ex, alias='test hdf5', complevel=1) as h5file:
+                if hasattr(h5file, 'create_earray'):
+                    a = h5file.create_earray('/', 'x', tables.Int32Atom(), (0,),
+                                             chunkshape=(100,))
+                else:
+                    a = h5file.createEArray('/', 'x', tables.Int32Atom(), (0,),
+                                            chunkshape=(100,))
+                for i in range(10):
+                    a.append(range(100*i, 100*(i+1)))
+        try:
+            with use_hdf5(M, 'test hdf5') as h5file:
+                self.assertEqual(list(h5file.root.x[250:253]), [250, 251, 252])
+                self.assertEqual(h5file.mode, 'r')
+        finally:
+            M.delete_execution(ex.id)
+
+
+class TestServer(TestCase):
+    def setUp(self):
+        import threading
+        from bein.server import MiniLIMSServer, RemoteMiniLIMS
+        self.server = MiniLIMSServer('server_lims', port=0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.remote = RemoteMiniLIMS('http://%s:%d' % self.server.server_address)
+
+    def tearDown(self):
+        self.remote.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.server.lims.remove()
+
+    def test_execution(self):
+        R = self.remote
+        self.assertEqual(R.file_path, self.server.lims.file_path)
+        with open('imported', 'w') as f:
+            f.write('imported\n')
+        try:
+            fid = R.import_file('imported', description='imported')
+        finally:
+            os.remove('imported')
+        R.add_alias(fid, 'remote alias')
+        with execution(R, description='remote') as ex:
+            used = ex.use('remote alias')
+            touch(ex, 'boris')
+            ex.report(ProgramOutput(0, 1, ['echo'], ['caf\xc3\xa9\n'], None))
+            ex.add('boris', description='touched')
+            ex.add(used, description='index', associate_to_filename='boris',
+                   template='%s.idx')
+        exinfo = R.fetch_execution(ex.id)
+        self.assertEqual(exinfo['description'], 'remote')
+        self.assertEqual(exinfo['programs'][0]['arguments'], ['touch', 'boris'])
+        self.assertEqual(exinfo['programs'][1]['stdout'], u'caf\xe9\n')
+        self.assertEqual(exinfo['used_files'], [fid])
+        [touched] = R.search_files(source=('execution', ex.id), with_text='touched')
+        self.assertEqual(R.fetch_file(touched)['origin'], ('execution', ex.id))
+        self.assertEqual(len(R.associated_files_of(touched)), 1)
+        with open(R.path_to_file('remote alias')) as f:
+            self.assertEqual(f.read(), 'imported\n')
+        # The server really recorded it.
+        self.assertEqual(self.server.lims.fetch_execution(ex.id)['description'], 'remote')
+        self.assertRaises(ValueError, R.fetch_file, 1000)
+        self.assertRaises(sqlite3.IntegrityError, R.delete_file, fid)
+        self.assertRaises(NotImplementedError, R.fsck)
+        [a, b] = R.batch([('resolve_alias', ('remote alias',), {}),
+                          ('search_files', (), {'with_text': 'imported'})])
+        self.assertEqual((a, b), (fid, [fid]))
+        R.delete_execution(ex.id)
+        R.delete_file(fid)
+        self.assertEqual(self.server.lims.search_files(), [])
+
+    def test_failed_write_is_rolled_back(self):
+        R = self.remote
+        try:
+            with execution(R) as ex:
+                touch(ex, 'boris')
+                touch(ex, 'index')
+                ex.add('boris')
+                ex.add('index', associate_to_filename='boris', template='no template')
+        except ValueError:
+            pass
+        with open('imported', 'w') as f:
+            f.write('imported\n')
+        try:
+            fid = R.import_file('imported')
+        finally:
+            os.remove('imported')
+        # The next call did not commit what the failed write left.
+        self.assertEqual(self.server.lims.search_files(), [fid])
+        self.assertEqual(self.server.lims.search_executions(), [])
+        R.delete_file(fid)
+
+    def test_sent_requests_are_not_repeated(self):
+        import httplib
+        from bein import server
+        calls = []
+        class LosingHandler(server._Handler):
+            def do_POST(self):
+                self.server.call(server._loads(self.rfile.read(int(self.headers['Content-Length']))))
+                calls.append(1)
+                # Drop the reply.
+                self.close_connection = 1
+        self.remote.search_files()
+        self.server.RequestHandlerClass = LosingHandler
+        self.remote.close()
+        self.assertRaises(httplib.HTTPException, self.remote.search_files)
+        self.assertEqual(calls, [1])
+        # A kept-alive connection the server closed is replaced.
+        class ClosingHandler(server._Handler):
+            def do_POST(self):
+                server._Handler.do_POST(self)
+                calls.append(2)
+                self.close_connection = 1
+        self.server.RequestHandlerClass = ClosingHandler
+        self.assertEqual(self.remote.search_files(), [])
+        self.assertEqual(self.remote.search_files(), [])
+        self.assertEqual(calls, [1, 2, 2])
+
+
 #def test_given(tests):
 #    module = sys.modules[__name__]
 #    if tests == None: